@@ -5,7 +5,8 @@ import signal
 
 from shop_bot.webhook_server.app import create_webhook_app
 from shop_bot.data_manager.scheduler import periodic_subscription_check
-from shop_bot.data_manager import database
+from shop_bot.data_manager import database, async_database
+from shop_bot.modules import xui_api
 from shop_bot.bot_controller import BotController
 
 def main():
@@ -26,6 +27,7 @@ def main():
         if bot_controller.get_status()["is_running"]:
             bot_controller.stop()
             await asyncio.sleep(2)
+        await xui_api.close_panels()
         tasks = [t for t in asyncio.all_tasks() if t is not asyncio.current_task()]
         if tasks:
             [task.cancel() for task in tasks]
@@ -57,6 +59,8 @@ def main():
     try:
         asyncio.run(start_services())
     finally:
+        async_database.shutdown()
+        database.close_connections()
         logger.info("Application is shutting down.")
 
 if __name__ == "__main__":
@@ -35,11 +35,15 @@ from aiogram.enums import ParseMode
 
 from shop_bot.bot import keyboards
 from shop_bot.modules import xui_api
-from shop_bot.data_manager.database import (
-    get_user, add_new_key, get_user_keys, update_user_stats,
-    register_user_if_not_exists, get_next_key_number, get_key_by_id,
-    update_key_info, set_trial_used, set_terms_agreed, get_setting, get_all_hosts,
-    get_plans_for_host, get_plan_by_id, log_transaction, get_referral_count, create_pending_transaction, get_all_users, grant_referral_bonus
+from shop_bot.data_manager.database import get_setting
+from shop_bot.data_manager.async_database import (
+    get_key_by_id, get_all_hosts,
+    get_plans_for_host, get_plan_by_id, log_transaction, get_referral_count, create_pending_transaction, get_user_count, iter_users, grant_referral_bonus
+)
+from shop_bot.bot.user_context import (
+    load_user, load_user_keys, add_new_key, update_user_stats,
+    register_user_if_not_exists, reserve_key_number,
+    update_key_info, set_trial_used, set_terms_agreed
 )
 
 from shop_bot.config import (
@@ -89,8 +93,8 @@ async def show_main_menu(
     delete_old: bool = True,   # 🔹 новое: удалять старое сообщение при возврате
 ):
     user_id = message.chat.id
-    user_db_data = get_user(user_id)
-    user_keys = get_user_keys(user_id)
+    user_db_data = await load_user(user_id)
+    user_keys = await load_user_keys(user_id)
     trial_available = not (user_db_data and user_db_data.get("trial_used"))
     is_admin = str(user_id) == ADMIN_ID
 
@@ -146,7 +150,7 @@ def registration_required(f):
     @wraps(f)
     async def decorated_function(event: types.Update, *args, **kwargs):
         user_id = event.from_user.id
-        user_data = get_user(user_id)
+        user_data = await load_user(user_id)
         if user_data:
             return await f(event, *args, **kwargs)
         else:
@@ -169,18 +173,19 @@ def get_user_router() -> Router:
         await callback.answer()
         await callback.message.delete()
         user_id = callback.from_user.id
-        user_db_data = get_user(user_id)
-        user_keys = get_user_keys(user_id)
+        user_db_data = await load_user(user_id)
+        user_keys = await load_user_keys(user_id)
         if not user_db_data:
             await callback.answer("Не удалось получить данные профиля.", show_alert=True)
             return
         username = html.bold(user_db_data.get('username', 'Пользователь'))
         total_spent, total_months = user_db_data.get('total_spent', 0), user_db_data.get('total_months', 0)
         now = datetime.now()
-        active_keys = [key for key in user_keys if datetime.fromisoformat(key['expiry_date']) > now]
+        now_ms = int(now.timestamp() * 1000)
+        active_keys = [key for key in user_keys if key['expiry_ms'] > now_ms]
         if active_keys:
-            latest_key = max(active_keys, key=lambda k: datetime.fromisoformat(k['expiry_date']))
-            latest_expiry_date = datetime.fromisoformat(latest_key['expiry_date'])
+            latest_key = max(active_keys, key=lambda k: k['expiry_ms'])
+            latest_expiry_date = datetime.fromtimestamp(latest_key['expiry_ms'] / 1000)
             time_left = latest_expiry_date - now
             vpn_status_text = get_vpn_active_text(time_left.days, time_left.seconds // 3600)
         elif user_keys: vpn_status_text = VPN_INACTIVE_TEXT
@@ -220,7 +225,7 @@ def get_user_router() -> Router:
         await callback.answer()
         await callback.message.delete()
         user_id = callback.from_user.id
-        user_keys = get_user_keys(user_id)
+        user_keys = await load_user_keys(user_id)
         await callback.message.answer(
             "Ваши ключи:" if user_keys else "У вас пока нет ключей.",
             reply_markup=keyboards.create_keys_management_keyboard(user_keys)
@@ -235,7 +240,7 @@ def get_user_router() -> Router:
         bot_username = (await callback.bot.get_me()).username
         
         referral_link = f"https://t.me/{bot_username}?start=ref_{user_id}"
-        referral_count = get_referral_count(user_id)
+        referral_count = await get_referral_count(user_id)
 
         text = (
             "🤝 <b>Реферальная программа</b>\n\n"
@@ -331,7 +336,7 @@ def get_user_router() -> Router:
         await callback.message.delete()
 
         host_name = callback.data[len("select_host_new_"):]
-        plans = get_plans_for_host(host_name)
+        plans = await get_plans_for_host(host_name)
 
         base_dir = os.path.dirname(os.path.abspath(__file__))
         photo_path = os.path.join(base_dir, "media", "tariffs.jpg")
@@ -353,7 +358,7 @@ def get_user_router() -> Router:
     async def buy_new_key_handler(callback: types.CallbackQuery):
         await callback.answer()
         await callback.message.delete()
-        hosts = get_all_hosts()
+        hosts = await get_all_hosts()
         if not hosts:
             await callback.message.answer("❌ В данный момент нет доступных серверов для покупки.")
             return
@@ -380,20 +385,16 @@ def get_user_router() -> Router:
             except (IndexError, ValueError):
                 logger.warning(f"Invalid referral code received: {command.args}")
                 
-        register_user_if_not_exists(user_id, username, referrer_id)
+        user_data, is_new_user = await register_user_if_not_exists(user_id, username, referrer_id)
         
         # Начисляем бонус рефереру, если новый пользователь пришёл по реферальной ссылке
-        if referrer_id:
+        if referrer_id and is_new_user:
             try:
                 await grant_referral_bonus(referrer_id)
                 logger.info(f"Referral bonus granted to user {referrer_id} for new referral {user_id}")
             except Exception as e:
                 logger.error(f"Error granting referral bonus to {referrer_id}: {e}", exc_info=True)
         
-        user_id = message.from_user.id
-        username = message.from_user.username or message.from_user.full_name
-        user_data = get_user(user_id)
-
         if user_data and user_data.get('agreed_to_terms'):
             await message.answer(
                 f"👋 Снова здравствуйте, {html.bold(message.from_user.full_name)}!",
@@ -407,7 +408,7 @@ def get_user_router() -> Router:
         channel_url = get_setting("channel_url")
 
         if not channel_url or not terms_url or not privacy_url:
-            set_terms_agreed(user_id)
+            await set_terms_agreed(user_id)
             await show_main_menu(message, with_photo=True)
             return
 
@@ -416,7 +417,7 @@ def get_user_router() -> Router:
         show_welcome_screen = (is_subscription_forced and channel_url) or (terms_url and privacy_url)
 
         if not show_welcome_screen:
-            set_terms_agreed(user_id)
+            await set_terms_agreed(user_id)
             await show_main_menu(message, with_photo=True)
             return
 
@@ -489,18 +490,19 @@ def get_user_router() -> Router:
     async def profile_handler_callback(callback: types.CallbackQuery):
         await callback.answer()
         user_id = callback.from_user.id
-        user_db_data = get_user(user_id)
-        user_keys = get_user_keys(user_id)
+        user_db_data = await load_user(user_id)
+        user_keys = await load_user_keys(user_id)
         if not user_db_data:
             await callback.answer("Не удалось получить данные профиля.", show_alert=True)
             return
         username = html.bold(user_db_data.get('username', 'Пользователь'))
         total_spent, total_months = user_db_data.get('total_spent', 0), user_db_data.get('total_months', 0)
         now = datetime.now()
-        active_keys = [key for key in user_keys if datetime.fromisoformat(key['expiry_date']) > now]
+        now_ms = int(now.timestamp() * 1000)
+        active_keys = [key for key in user_keys if key['expiry_ms'] > now_ms]
         if active_keys:
-            latest_key = max(active_keys, key=lambda k: datetime.fromisoformat(k['expiry_date']))
-            latest_expiry_date = datetime.fromisoformat(latest_key['expiry_date'])
+            latest_key = max(active_keys, key=lambda k: k['expiry_ms'])
+            latest_expiry_date = datetime.fromtimestamp(latest_key['expiry_ms'] / 1000)
             time_left = latest_expiry_date - now
             vpn_status_text = get_vpn_active_text(time_left.days, time_left.seconds // 3600)
         elif user_keys: vpn_status_text = VPN_INACTIVE_TEXT
@@ -625,14 +627,13 @@ def get_user_router() -> Router:
 
         await state.clear()
         
-        users = get_all_users()
-        logger.info(f"Broadcast: Starting to iterate over {len(users)} users.")
+        logger.info(f"Broadcast: Starting to iterate over {await get_user_count()} users.")
 
         sent_count = 0
         failed_count = 0
         banned_count = 0
 
-        for user in users:
+        async for user in iter_users(columns=("telegram_id", "is_banned")):
             user_id = user['telegram_id']
             if user.get('is_banned'):
                 banned_count += 1
@@ -674,7 +675,7 @@ def get_user_router() -> Router:
         bot_username = (await callback.bot.get_me()).username
         
         referral_link = f"https://t.me/{bot_username}?start=ref_{user_id}"
-        referral_count = get_referral_count(user_id)
+        referral_count = await get_referral_count(user_id)
 
         text = (
             "🤝 <b>Реферальная программа</b>\n\n"
@@ -738,7 +739,7 @@ def get_user_router() -> Router:
     async def manage_keys_handler(callback: types.CallbackQuery):
         await callback.answer()
         user_id = callback.from_user.id
-        user_keys = get_user_keys(user_id)
+        user_keys = await load_user_keys(user_id)
         await callback.message.edit_text(
             "Ваши ключи:" if user_keys else "У вас пока нет ключей.",
             reply_markup=keyboards.create_keys_management_keyboard(user_keys)
@@ -748,13 +749,13 @@ def get_user_router() -> Router:
     @registration_required
     async def trial_period_handler(callback: types.CallbackQuery, state: FSMContext):
         user_id = callback.from_user.id
-        user_db_data = get_user(user_id)
+        user_db_data = await load_user(user_id)
         if user_db_data and user_db_data.get('trial_used'):
             await callback.message.delete()
             await callback.answer("Вы уже использовали бесплатный пробный период.", show_alert=True)
             return
 
-        hosts = get_all_hosts()
+        hosts = await get_all_hosts()
         if not hosts:
             await callback.message.answer("❌ В данный момент нет доступных серверов для создания пробного ключа.")
             return
@@ -786,9 +787,14 @@ def get_user_router() -> Router:
             # Добавляем логирование перед вызовом API
             logger.info(f"DEBUG: Calling xui_api with days_to_add = {trial_days}")
             
+            key_number = await reserve_key_number(user_id)
+            if key_number is None:
+                logger.error(f"Could not reserve a key number for user {user_id}; trial key not created.")
+                await message.answer("❌ Не удалось создать пробный ключ. Попробуйте позже или обратитесь в поддержку.")
+                return
             result = await xui_api.create_or_update_key_on_host(
                 host_name=host_name,
-                email=f"user{user_id}-key{get_next_key_number(user_id)}-trial@telegram.bot",
+                email=f"user{user_id}-key{key_number}-trial@telegram.bot",
                 days_to_add=trial_days
             )
             
@@ -800,16 +806,17 @@ def get_user_router() -> Router:
                 await message.answer("❌ Не удалось создать пробный ключ. Ошибка на сервере.")
                 return
 
-            set_trial_used(user_id)
+            await set_trial_used(user_id)
             
-            new_key_id = add_new_key(
+            new_key_id = await add_new_key(
                 user_id=user_id,
                 email=f"user_{user_id}@trial.com",
                 host_name=host_name,
                 xui_client_uuid=result['client_uuid'],
                 days=trial_days,
                 key_email=result['email'],
-                expiry_timestamp_ms=result['expiry_timestamp_ms']
+                expiry_timestamp_ms=result['expiry_timestamp_ms'],
+                key_number=key_number
             )
             
             # Удаляем сообщение только после успешного создания ключа и его сохранения
@@ -822,7 +829,7 @@ def get_user_router() -> Router:
             # Добавляем логирование вычисленной даты
             logger.info(f"DEBUG: Calculated expiry date is {new_expiry_date.isoformat()}")
             
-            final_text = get_purchase_success_text("готов", get_next_key_number(user_id) -1, new_expiry_date, result['connection_string'])
+            final_text = get_purchase_success_text("готов", key_number, new_expiry_date, result['connection_string'])
             await message.answer(text=final_text, reply_markup=keyboards.create_key_info_keyboard(new_key_id))
 
         except Exception as e:
@@ -838,7 +845,7 @@ def get_user_router() -> Router:
         key_id_to_show = int(callback.data.split("_")[2])
         await callback.message.edit_text("Загружаю информацию о ключе...")
         user_id = callback.from_user.id
-        key_data = get_key_by_id(key_id_to_show)
+        key_data = await get_key_by_id(key_id_to_show)
 
         if not key_data or key_data['user_id'] != user_id:
             await callback.message.edit_text("❌ Ошибка: ключ не найден.")
@@ -851,13 +858,10 @@ def get_user_router() -> Router:
                 return
 
             connection_string = details['connection_string']
-            expiry_date = datetime.fromisoformat(key_data['expiry_date'])
+            expiry_date = datetime.fromtimestamp(key_data['expiry_ms'] / 1000)
             created_date = datetime.fromisoformat(key_data['created_date'])
             
-            all_user_keys = get_user_keys(user_id)
-            key_number = next((i + 1 for i, key in enumerate(all_user_keys) if key['key_id'] == key_id_to_show), 0)
-            
-            final_text = get_key_info_text(key_number, expiry_date, created_date, connection_string)
+            final_text = get_key_info_text(key_data.get('key_number'), expiry_date, created_date, connection_string)
             
             await callback.message.edit_text(
                 text=final_text,
@@ -873,7 +877,7 @@ def get_user_router() -> Router:
     async def show_qr_handler(callback: types.CallbackQuery):
         await callback.answer("Генерирую QR-код...")
         key_id = int(callback.data.split("_")[2])
-        key_data = get_key_by_id(key_id)
+        key_data = await get_key_by_id(key_id)
         if not key_data or key_data['user_id'] != callback.from_user.id: return
         
         try:
@@ -1036,7 +1040,7 @@ def get_user_router() -> Router:
             await callback.message.edit_text("❌ Произошла ошибка. Неверный формат ключа.")
             return
 
-        key_data = get_key_by_id(key_id)
+        key_data = await get_key_by_id(key_id)
 
         if not key_data or key_data['user_id'] != callback.from_user.id:
             await callback.message.edit_text("❌ Ошибка: Ключ не найден или не принадлежит вам.")
@@ -1047,7 +1051,7 @@ def get_user_router() -> Router:
             await callback.message.edit_text("❌ Ошибка: У этого ключа не указан сервер. Обратитесь в поддержку.")
             return
 
-        plans = get_plans_for_host(host_name)
+        plans = await get_plans_for_host(host_name)
 
         if not plans:
             await callback.message.edit_text(
@@ -1141,8 +1145,8 @@ def get_user_router() -> Router:
 
     async def show_payment_options(message: types.Message, state: FSMContext):
         data = await state.get_data()
-        user_data = get_user(message.chat.id)
-        plan = get_plan_by_id(data.get('plan_id'))
+        user_data = await load_user(message.chat.id)
+        plan = await get_plan_by_id(data.get('plan_id'))
         
         if not plan:
             await message.edit_text("❌ Ошибка: Тариф не найден.")
@@ -1195,10 +1199,10 @@ def get_user_router() -> Router:
         await callback.answer("Создаю ссылку на оплату...")
         
         data = await state.get_data()
-        user_data = get_user(callback.from_user.id)
+        user_data = await load_user(callback.from_user.id)
         
         plan_id = data.get('plan_id')
-        plan = get_plan_by_id(plan_id)
+        plan = await get_plan_by_id(plan_id)
 
         if not plan:
             await callback.message.answer("Произошла ошибка при выборе тарифа.")
@@ -1215,7 +1219,6 @@ def get_user_router() -> Router:
                 discount_amount = (base_price * discount_percentage / 100).quantize(Decimal("0.01"))
                 price_rub = base_price - discount_amount
 
-        plan_id = data.get('plan_id')
         customer_email = data.get('customer_email')
         host_name = data.get('host_name')
         action = data.get('action')
@@ -1224,12 +1227,6 @@ def get_user_router() -> Router:
         if not customer_email:
             customer_email = get_setting("receipt_email")
 
-        plan = get_plan_by_id(plan_id)
-        if not plan:
-            await callback.message.answer("Произошла ошибка при выборе тарифа.")
-            await state.clear()
-            return
-
         months = plan['months']
         user_id = callback.from_user.id
 
@@ -1281,7 +1278,7 @@ def get_user_router() -> Router:
         await callback.answer("Создаю счет в Crypto Pay...")
         
         data = await state.get_data()
-        user_data = get_user(callback.from_user.id)
+        user_data = await load_user(callback.from_user.id)
         
         plan_id = data.get('plan_id')
         user_id = data.get('user_id', callback.from_user.id)
@@ -1297,20 +1294,12 @@ def get_user_router() -> Router:
             await state.clear()
             return
 
-        plan = get_plan_by_id(plan_id)
+        plan = await get_plan_by_id(plan_id)
         if not plan:
             logger.error(f"Attempt to create Crypto Pay invoice failed for user {user_id}: Plan with id {plan_id} not found.")
             await callback.message.edit_text("❌ Произошла ошибка при выборе тарифа.")
             await state.clear()
             return
-        
-        plan_id = data.get('plan_id')
-        plan = get_plan_by_id(plan_id)
-
-        if not plan:
-            await callback.message.answer("Произошла ошибка при выборе тарифа.")
-            await state.clear()
-            return
 
         base_price = Decimal(str(plan['price']))
         price_rub = base_price
@@ -1370,8 +1359,8 @@ def get_user_router() -> Router:
         await callback.answer("Создаю счет Heleket...")
         
         data = await state.get_data()
-        plan = get_plan_by_id(data.get('plan_id'))
-        user_data = get_user(callback.from_user.id)
+        plan = await get_plan_by_id(data.get('plan_id'))
+        user_data = await load_user(callback.from_user.id)
         
         if not plan:
             await callback.message.edit_text("❌ Произошла ошибка при выборе тарифа.")
@@ -1379,13 +1368,6 @@ def get_user_router() -> Router:
             return
 
         plan_id = data.get('plan_id')
-        plan = get_plan_by_id(plan_id)
-
-        if not plan:
-            await callback.message.answer("Произошла ошибка при выборе тарифа.")
-            await state.clear()
-            return
-
         base_price = Decimal(str(plan['price']))
         price_rub_decimal = base_price
 
@@ -1422,7 +1404,7 @@ def get_user_router() -> Router:
         data = await state.get_data()
         user_id = callback.from_user.id
         wallet_address = get_setting("ton_wallet_address")
-        plan = get_plan_by_id(data.get('plan_id'))
+        plan = await get_plan_by_id(data.get('plan_id'))
         
         if not wallet_address or not plan:
             await callback.message.edit_text("❌ Оплата через TON временно недоступна.")
@@ -1451,7 +1433,7 @@ def get_user_router() -> Router:
             "host_name": data.get('host_name'), "plan_id": data.get('plan_id'),
             "customer_email": data.get('customer_email'), "payment_method": "TON Connect"
         }
-        create_pending_transaction(payment_id, user_id, float(price_rub), metadata)
+        await create_pending_transaction(payment_id, user_id, float(price_rub), metadata)
 
         transaction_payload = {
             'messages': [{'address': wallet_address, 'amount': str(amount_nanoton), 'payload': payment_id}],
@@ -1550,7 +1532,7 @@ async def _start_ton_connect_process(user_id: int, transaction_payload: dict) ->
 
 async def process_successful_onboarding(callback: types.CallbackQuery, state: FSMContext):
     await callback.answer("✅ Спасибо! Доступ предоставлен.")
-    set_terms_agreed(callback.from_user.id)
+    await set_terms_agreed(callback.from_user.id)
     await state.clear()
     await callback.message.delete()
     await callback.message.answer("Приятного использования!", reply_markup=keyboards.main_reply_keyboard)
@@ -1586,8 +1568,8 @@ async def notify_admin_of_purchase(bot: Bot, metadata: dict):
         plan_id = metadata.get('plan_id')
         payment_method = metadata.get('payment_method', 'Unknown')
         
-        user_info = get_user(user_id)
-        plan_info = get_plan_by_id(plan_id)
+        user_info = await load_user(user_id)
+        plan_info = await get_plan_by_id(plan_id)
 
         username = user_info.get('username', 'N/A') if user_info else 'N/A'
         plan_name = plan_info.get('plan_name', f'{months} мес.') if plan_info else f'{months} мес.'
@@ -1746,11 +1728,15 @@ async def process_successful_payment(bot: Bot, metadata: dict):
     try:
         email = ""
         if action == "new":
-            key_number = get_next_key_number(user_id)
+            key_number = await reserve_key_number(user_id)
+            if key_number is None:
+                logger.error(f"Could not reserve a key number for user {user_id}; key not created.")
+                await processing_message.edit_text("❌ Ошибка: не удалось создать ключ. Обратитесь в поддержку.")
+                return
             email = f"user{user_id}-key{key_number}@{host_name.replace(' ', '').lower()}.bot"
             logger.info(f"Generated email for new key: {email}")
         elif action == "extend":
-            key_data = get_key_by_id(key_id)
+            key_data = await get_key_by_id(key_id)
             if not key_data or key_data['user_id'] != user_id:
                 await processing_message.edit_text("❌ Ошибка: ключ для продления не найден.")
                 return
@@ -1829,14 +1815,15 @@ async def process_successful_payment(bot: Bot, metadata: dict):
             logger.info(f"Adding new key to database for user {user_id}, host {host_name}, email {email}")
             logger.info(f"Key data to be saved: user_id={user_id}, host_name={host_name}, client_uuid={result['client_uuid']}, email={result['email']}, expiry_timestamp_ms={result['expiry_timestamp_ms']}")
             try:
-                key_id = add_new_key(
+                key_id = await add_new_key(
                     user_id=user_id,
                     email=email,
                     xui_client_uuid=result['client_uuid'],
                     host_name=host_name,
                     days=days_to_add,
                     key_email=result['email'],
-                    expiry_timestamp_ms=result['expiry_timestamp_ms']
+                    expiry_timestamp_ms=result['expiry_timestamp_ms'],
+                    key_number=key_number
                 )
                 logger.info(f"New key added with ID: {key_id}")
             except Exception as db_error:
@@ -1857,7 +1844,7 @@ async def process_successful_payment(bot: Bot, metadata: dict):
             logger.info(f"Updating existing key in database with ID {key_id}")
             logger.info(f"Update data: client_uuid={result['client_uuid']}, expiry_timestamp_ms={result['expiry_timestamp_ms']}")
             try:
-                update_key_info(key_id, result['client_uuid'], result['expiry_timestamp_ms'])
+                await update_key_info(key_id, result['client_uuid'], result['expiry_timestamp_ms'])
                 logger.info(f"Key {key_id} updated successfully")
             except Exception as db_error:
                 logger.error(f"Database error when updating key {key_id} for user {user_id}: {db_error}", exc_info=True)
@@ -1877,9 +1864,9 @@ async def process_successful_payment(bot: Bot, metadata: dict):
         price = float(metadata.get('price'))
 
         # Начисляем реферальное вознаграждение за покупки
-        user = get_user(user_id)
+        user = await load_user(user_id)
         if user and user.get('referred_by'):
-            referrer = get_user(user['referred_by'])
+            referrer = await load_user(user['referred_by'])
             if referrer:
                 referral_percentage = get_setting("referral_percentage") or 0
                 bonus_amount = (price * float(referral_percentage)) / 100
@@ -1904,12 +1891,12 @@ async def process_successful_payment(bot: Bot, metadata: dict):
 
         logger.info(f"Updating user stats for user {user_id}, adding price {price}, months {months}")
         try:
-            update_user_stats(user_id, price, months)
+            await update_user_stats(user_id, price, months)
         except Exception as db_error:
             logger.error(f"Database error when updating user stats for user {user_id}: {db_error}", exc_info=True)
             # Продолжаем выполнение, так как это не критично для основного функционала
         
-        user_info = get_user(user_id)
+        user_info = await load_user(user_id)
         logger.info(f"User info retrieved: {user_info is not None}")
 
         internal_payment_id = str(uuid.uuid4())
@@ -1919,16 +1906,17 @@ async def process_successful_payment(bot: Bot, metadata: dict):
         log_amount_rub = float(price)
         log_method = metadata.get('payment_method', 'Unknown')
         
+        plan_info = await get_plan_by_id(metadata.get('plan_id')) if metadata.get('plan_id') else None
         log_metadata = json.dumps({
             "plan_id": metadata.get('plan_id'),
-            "plan_name": get_plan_by_id(metadata.get('plan_id')).get('plan_name', 'Unknown') if metadata.get('plan_id') and get_plan_by_id(metadata.get('plan_id')) else 'Unknown',
+            "plan_name": plan_info.get('plan_name', 'Unknown') if plan_info else 'Unknown',
             "host_name": metadata.get('host_name'),
             "customer_email": metadata.get('customer_email')
         })
 
         logger.info(f"Logging transaction with username={log_username}, payment_id={internal_payment_id}, user_id={user_id}, amount={log_amount_rub}, method={log_method}")
         try:
-            log_transaction(
+            await log_transaction(
                 username=log_username,
                 transaction_id=None,
                 payment_id=internal_payment_id,
@@ -1938,7 +1926,10 @@ async def process_successful_payment(bot: Bot, metadata: dict):
                 amount_currency=None,
                 currency_name=None,
                 payment_method=log_method,
-                metadata=log_metadata
+                metadata=log_metadata,
+                host_name=metadata.get('host_name'),
+                plan_name=plan_info.get('plan_name') if plan_info else None,
+                plan_id=metadata.get('plan_id')
             )
         except Exception as db_error:
             logger.error(f"Database error when logging transaction for user {user_id}: {db_error}", exc_info=True)
@@ -1953,8 +1944,8 @@ async def process_successful_payment(bot: Bot, metadata: dict):
         connection_string = result['connection_string']
         new_expiry_date = datetime.fromtimestamp(result['expiry_timestamp_ms'] / 1000)
         
-        all_user_keys = get_user_keys(user_id)
-        key_number = next((i + 1 for i, key in enumerate(all_user_keys) if key['key_id'] == key_id), len(all_user_keys))
+        if action != "new":
+            key_number = key_data.get('key_number')
 
         final_text = get_purchase_success_text(
             action="создан" if action == "new" else "продлен",
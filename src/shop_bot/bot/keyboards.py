@@ -1,4 +1,5 @@
 import logging
+import time
 
 from datetime import datetime
 
@@ -155,11 +156,12 @@ def create_payment_keyboard(payment_url: str) -> InlineKeyboardMarkup:
 def create_keys_management_keyboard(keys: list) -> InlineKeyboardMarkup:
     builder = InlineKeyboardBuilder()
     if keys:
-        for i, key in enumerate(keys):
-            expiry_date = datetime.fromisoformat(key['expiry_date'])
-            status_icon = "✅" if expiry_date > datetime.now() else "❌"
+        now_ms = int(time.time() * 1000)
+        for key in keys:
+            expiry_date = datetime.fromtimestamp(key['expiry_ms'] / 1000)
+            status_icon = "✅" if key['expiry_ms'] > now_ms else "❌"
             host_name = key.get('host_name', 'Неизвестный хост')
-            button_text = f"{status_icon} Ключ #{i+1} ({host_name}) (до {expiry_date.strftime('%d.%m.%Y')})"
+            button_text = f"{status_icon} Ключ #{key['key_number']} ({host_name}) (до {expiry_date.strftime('%d.%m.%Y')})"
             builder.button(text=button_text, callback_data=f"show_key_{key['key_id']}")
     builder.button(text="➕ Купить новый ключ", callback_data="buy_new_key")
     builder.button(text="⬅️ Назад в меню", callback_data="back_to_main_menu")
@@ -1,7 +1,32 @@
 from typing import Callable, Dict, Any, Awaitable
 from aiogram import BaseMiddleware
 from aiogram.types import TelegramObject, Message, CallbackQuery, Chat
-from shop_bot.data_manager.database import get_user
+from shop_bot.bot.user_context import UserContext, current_user_context
+from shop_bot.data_manager.database import is_user_banned
+
+class UserContextMiddleware(BaseMiddleware):
+    """
+    Outer update middleware: creates the per-update UserContext, exposes it
+    as data['user_context'] and makes it current for helpers further down.
+    """
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any]
+    ) -> Any:
+        user = data.get('event_from_user')
+        if not user:
+            return await handler(event, data)
+
+        context = UserContext(user.id)
+        data['user_context'] = context
+        token = current_user_context.set(context)
+        try:
+            return await handler(event, data)
+        finally:
+            current_user_context.reset(token)
 
 class BanMiddleware(BaseMiddleware):
     async def __call__(
@@ -14,13 +39,12 @@ class BanMiddleware(BaseMiddleware):
         if not user:
             return await handler(event, data)
 
-        user_data = get_user(user.id)
-        if user_data and user_data.get('is_banned'):
+        if is_user_banned(user.id):
             ban_message_text = "Вы заблокированы и не можете использовать этого бота."
             if isinstance(event, CallbackQuery):
                 await event.answer(ban_message_text, show_alert=True)
             elif isinstance(event, Message):
                 await event.answer(ban_message_text)
             return
-        
+
         return await handler(event, data)
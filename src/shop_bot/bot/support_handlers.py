@@ -1,11 +1,10 @@
 import logging
-import json
 
 from aiogram import Bot, Router, F, types
 from aiogram.filters import CommandStart
 from aiogram.enums import ParseMode
 
-from shop_bot.data_manager import database
+from shop_bot.data_manager import async_database
 
 logger = logging.getLogger(__name__)
 
@@ -14,8 +13,8 @@ SUPPORT_GROUP_ID = None
 router = Router()
 
 async def get_user_summary(user_id: int, username: str) -> str:
-    keys = database.get_user_keys(user_id)
-    latest_transaction = database.get_latest_transaction(user_id)
+    keys = await async_database.get_user_keys(user_id)
+    latest_transaction = await async_database.get_latest_transaction(user_id)
 
     summary_parts = [
         f"<b>Новый тикет от пользователя:</b> @{username} (ID: <code>{user_id}</code>)\n"
@@ -31,8 +30,7 @@ async def get_user_summary(user_id: int, username: str) -> str:
 
     if latest_transaction:
         summary_parts.append("\n<b>💸 Последняя транзакция:</b>")
-        metadata = json.loads(latest_transaction.get('metadata', '{}'))
-        plan_name = metadata.get('plan_name', 'N/A')
+        plan_name = latest_transaction.get('plan_name') or 'N/A'
         price = latest_transaction.get('amount_rub', 'N/A')
         date = latest_transaction.get('created_date', '').split(' ')[0]
         summary_parts.append(f"- {plan_name} за {price} RUB ({date})")
@@ -48,7 +46,7 @@ def get_support_router() -> Router:
         user_id = message.from_user.id
         username = message.from_user.username or message.from_user.full_name
         
-        thread_id = database.get_support_thread_id(user_id)
+        thread_id = await async_database.get_support_thread_id(user_id)
         
         if not thread_id:
             if not SUPPORT_GROUP_ID:
@@ -61,7 +59,7 @@ def get_support_router() -> Router:
                 new_thread = await bot.create_forum_topic(chat_id=SUPPORT_GROUP_ID, name=thread_name)
                 thread_id = new_thread.message_thread_id
                 
-                database.add_support_thread(user_id, thread_id)
+                await async_database.add_support_thread(user_id, thread_id)
                 
                 summary_text = await get_user_summary(user_id, username)
                 await bot.send_message(
@@ -82,7 +80,7 @@ def get_support_router() -> Router:
     @support_router.message(F.chat.type == "private")
     async def from_user_to_admin(message: types.Message, bot: Bot):
         user_id = message.from_user.id
-        thread_id = database.get_support_thread_id(user_id)
+        thread_id = await async_database.get_support_thread_id(user_id)
         
         if thread_id and SUPPORT_GROUP_ID:
             await bot.copy_message(
@@ -97,7 +95,7 @@ def get_support_router() -> Router:
     @support_router.message(F.chat.id == SUPPORT_GROUP_ID, F.message_thread_id)
     async def from_admin_to_user(message: types.Message, bot: Bot):
         thread_id = message.message_thread_id
-        user_id = database.get_user_id_by_thread(thread_id)
+        user_id = await async_database.get_user_id_by_thread(thread_id)
         
         if message.from_user.id == bot.id:
             return
@@ -0,0 +1,90 @@
+import functools
+from contextvars import ContextVar
+
+from shop_bot.data_manager import async_database
+
+class UserContext:
+    """
+    The current user's row and key list, loaded at most once per update.
+
+    Write helpers below drop the cached values, so a read after a write in
+    the same update goes back to the database.
+    """
+
+    _NOT_LOADED = object()
+
+    def __init__(self, user_id: int):
+        self.user_id = user_id
+        self._user = self._NOT_LOADED
+        self._keys = self._NOT_LOADED
+
+    async def get_user(self) -> dict | None:
+        if self._user is self._NOT_LOADED:
+            self._user = await async_database.get_user(self.user_id)
+        return self._user
+
+    async def get_keys(self) -> list[dict]:
+        if self._keys is self._NOT_LOADED:
+            self._keys = await async_database.get_user_keys(self.user_id)
+        return self._keys
+
+    def set_user(self, user: dict | None):
+        self._user = user
+
+    def invalidate(self):
+        self._user = self._NOT_LOADED
+        self._keys = self._NOT_LOADED
+
+current_user_context: ContextVar[UserContext | None] = ContextVar("current_user_context", default=None)
+
+def _context_for(user_id: int) -> UserContext | None:
+    context = current_user_context.get()
+    if context is not None and context.user_id == user_id:
+        return context
+    return None
+
+async def load_user(user_id: int) -> dict | None:
+    context = _context_for(user_id)
+    if context is None:
+        return await async_database.get_user(user_id)
+    return await context.get_user()
+
+async def load_user_keys(user_id: int) -> list[dict]:
+    context = _context_for(user_id)
+    if context is None:
+        return await async_database.get_user_keys(user_id)
+    return await context.get_keys()
+
+def invalidate_user_context():
+    context = current_user_context.get()
+    if context is not None:
+        context.invalidate()
+
+async def register_user_if_not_exists(telegram_id: int, username: str, referrer_id) -> tuple[dict | None, bool]:
+    user, is_new = await async_database.register_user_if_not_exists(telegram_id, username, referrer_id)
+    context = _context_for(telegram_id)
+    if context is not None:
+        context.invalidate()
+        if user is not None:
+            context.set_user(user)
+    return user, is_new
+
+def _invalidating(func):
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        try:
+            return await func(*args, **kwargs)
+        finally:
+            invalidate_user_context()
+    return wrapper
+
+# Writes that change a user row or key list; use these in handlers so the
+# per-update cache never serves stale data.
+set_trial_used = _invalidating(async_database.set_trial_used)
+set_terms_agreed = _invalidating(async_database.set_terms_agreed)
+update_user_stats = _invalidating(async_database.update_user_stats)
+reserve_key_number = _invalidating(async_database.reserve_key_number)
+add_new_key = _invalidating(async_database.add_new_key)
+update_key_info = _invalidating(async_database.update_key_info)
+delete_key_by_id = _invalidating(async_database.delete_key_by_id)
+delete_key_by_email = _invalidating(async_database.delete_key_by_email)
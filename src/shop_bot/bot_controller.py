@@ -8,7 +8,7 @@ from aiogram.enums import ParseMode
 
 from shop_bot.data_manager import database
 from shop_bot.bot.handlers import get_user_router
-from shop_bot.bot.middlewares import BanMiddleware
+from shop_bot.bot.middlewares import BanMiddleware, UserContextMiddleware
 from shop_bot.bot import handlers, support_handlers
 from shop_bot.bot.support_handlers import get_support_router
 
@@ -78,7 +78,9 @@ class BotController:
 
         try:
             self.shop_bot = Bot(token=token, default=DefaultBotProperties(parse_mode=ParseMode.HTML))
+            database.reload_banned_users()
             self.shop_dp = Dispatcher()
+            self.shop_dp.update.outer_middleware(UserContextMiddleware())
             self.shop_dp.update.middleware(BanMiddleware())
             self.shop_dp.include_router(get_user_router())
 
@@ -0,0 +1,113 @@
+import asyncio
+import functools
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+from shop_bot.data_manager import database
+
+logger = logging.getLogger(__name__)
+
+# Handlers run on the asyncio event loop, so a slow fsync or a lock wait in a
+# blocking sqlite3 call would stall every user's updates. The functions below
+# have the same names and arguments as their database counterparts but run
+# them on a dedicated pool of DB threads and return awaitables.
+_executor = ThreadPoolExecutor(max_workers=database.DB_POOL_SIZE, thread_name_prefix="db")
+
+def _offload(func):
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(_executor, functools.partial(func, *args, **kwargs))
+    return wrapper
+
+def _catalog_read(func):
+    """Serve a catalog lookup straight from memory once the snapshot is built."""
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        if database.is_catalog_loaded():
+            return func(*args, **kwargs)
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(_executor, functools.partial(func, *args, **kwargs))
+    return wrapper
+
+async def _iter_table(table: str, key_column: str, columns: tuple[str, ...], batch_size: int, where: str | None, params: tuple):
+    # database.iter_batches owns the keyset loop; each step (one batch query)
+    # is advanced on a DB thread.
+    batches = database.iter_batches(table, key_column, columns, batch_size, where, params)
+    next_batch = _offload(next)
+    while (batch := await next_batch(batches, None)) is not None:
+        for row in batch:
+            yield row
+
+def iter_users(batch_size: int = database.ITER_BATCH_SIZE, where: str | None = None, params: tuple = (), columns: tuple[str, ...] = database.USER_ITER_COLUMNS):
+    return _iter_table("users", "telegram_id", columns, batch_size, where, params)
+
+def iter_keys(batch_size: int = database.ITER_BATCH_SIZE, where: str | None = None, params: tuple = (), columns: tuple[str, ...] = database.KEY_ITER_COLUMNS):
+    return _iter_table("vpn_keys", "key_id", columns, batch_size, where, params)
+
+def shutdown():
+    _executor.shutdown(wait=True)
+    logger.info("Database executor has been shut down.")
+
+create_host = _offload(database.create_host)
+delete_host = _offload(database.delete_host)
+get_host = _catalog_read(database.get_host)
+get_all_hosts = _catalog_read(database.get_all_hosts)
+get_all_keys = _offload(database.get_all_keys)
+get_setting = _offload(database.get_setting)
+get_all_settings = _offload(database.get_all_settings)
+update_setting = _offload(database.update_setting)
+create_plan = _offload(database.create_plan)
+get_plans_for_host = _catalog_read(database.get_plans_for_host)
+get_plan_by_id = _catalog_read(database.get_plan_by_id)
+delete_plan = _offload(database.delete_plan)
+reload_catalog = _offload(database.reload_catalog)
+update_host_profile = _offload(database.update_host_profile)
+register_user_if_not_exists = _offload(database.register_user_if_not_exists)
+get_referral_count = _offload(database.get_referral_count)
+get_user = _offload(database.get_user)
+get_user_by_id = _offload(database.get_user_by_id)
+set_terms_agreed = _offload(database.set_terms_agreed)
+update_user_stats = _offload(database.update_user_stats)
+get_user_count = _offload(database.get_user_count)
+get_total_keys_count = _offload(database.get_total_keys_count)
+get_total_spent_sum = _offload(database.get_total_spent_sum)
+create_pending_transaction = _offload(database.create_pending_transaction)
+find_and_complete_ton_transaction = _offload(database.find_and_complete_ton_transaction)
+log_transaction = _offload(database.log_transaction)
+get_counter = _offload(database.get_counter)
+get_revenue_by_host = _offload(database.get_revenue_by_host)
+get_revenue_by_plan = _offload(database.get_revenue_by_plan)
+get_stats_counters = _offload(database.get_stats_counters)
+recompute_stats_counters = _offload(database.recompute_stats_counters)
+get_transactions_page = _offload(database.get_transactions_page)
+set_trial_used = _offload(database.set_trial_used)
+add_new_key = _offload(database.add_new_key)
+delete_key_by_email = _offload(database.delete_key_by_email)
+get_user_keys = _offload(database.get_user_keys)
+delete_key_by_id = _offload(database.delete_key_by_id)
+get_key_by_id = _offload(database.get_key_by_id)
+get_key_by_email = _offload(database.get_key_by_email)
+update_key_info = _offload(database.update_key_info)
+reserve_key_number = _offload(database.reserve_key_number)
+get_keys_for_host = _offload(database.get_keys_for_host)
+get_all_vpn_users = _offload(database.get_all_vpn_users)
+update_key_status_from_server = _offload(database.update_key_status_from_server)
+get_daily_stats_for_charts = _offload(database.get_daily_stats_for_charts)
+get_recent_transactions = _offload(database.get_recent_transactions)
+add_support_thread = _offload(database.add_support_thread)
+get_support_thread_id = _offload(database.get_support_thread_id)
+get_user_id_by_thread = _offload(database.get_user_id_by_thread)
+get_latest_transaction = _offload(database.get_latest_transaction)
+get_all_users = _offload(database.get_all_users)
+get_users_page = _offload(database.get_users_page)
+search_admin = _offload(database.search_admin)
+reload_banned_users = _offload(database.reload_banned_users)
+ban_user = _offload(database.ban_user)
+unban_user = _offload(database.unban_user)
+delete_user_keys = _offload(database.delete_user_keys)
+delete_user_and_related_data = _offload(database.delete_user_and_related_data)
+
+# These are already coroutines; they use this module for their own DB calls.
+grant_referral_bonus = database.grant_referral_bonus
+get_user_xui_keys = database.get_user_xui_keys
@@ -0,0 +1,226 @@
+import os
+import gzip
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
+import logging
+from datetime import datetime
+from pathlib import Path
+
+from shop_bot.data_manager import database
+
+logger = logging.getLogger(__name__)
+
+BACKUP_DIR = Path(os.getenv("BACKUP_DIR", str(database.PROJECT_ROOT / "backups")))
+BACKUP_KEEP = int(os.getenv("BACKUP_KEEP", "7"))
+BACKUP_INTERVAL_HOURS = float(os.getenv("BACKUP_INTERVAL_HOURS", "24"))
+# The online backup copies this many pages per step and sleeps in between,
+# so each step holds the source only briefly.
+BACKUP_PAGES_PER_STEP = 256
+BACKUP_STEP_SLEEP = 0.005
+# A write from another connection restarts the copy; after this many
+# restarts the rest is copied in one step from a single WAL snapshot.
+BACKUP_MAX_RESTARTS = 5
+# Tables whose row counts must match between a snapshot and the database
+# restored from it.
+VERIFY_TABLES = ("users", "vpn_keys", "transactions", "xui_hosts", "plans", "bot_settings")
+SNAPSHOT_PREFIX = "users-"
+SNAPSHOT_SUFFIX = ".db.gz"
+
+_backup_lock = threading.Lock()
+_status = {
+    'running': False,
+    'started_at': None,
+    'finished_at': None,
+    'file': None,
+    'size_bytes': None,
+    'duration_s': None,
+    'restarts': 0,
+    'error': None,
+}
+
+def get_backup_status() -> dict:
+    return dict(_status)
+
+def list_backups() -> list[dict]:
+    if not BACKUP_DIR.is_dir():
+        return []
+    snapshots = sorted(BACKUP_DIR.glob(f"{SNAPSHOT_PREFIX}*{SNAPSHOT_SUFFIX}"), reverse=True)
+    return [
+        {
+            'name': path.name,
+            'size_bytes': path.stat().st_size,
+            'created_at': datetime.fromtimestamp(path.stat().st_mtime).strftime('%Y-%m-%d %H:%M:%S'),
+        }
+        for path in snapshots
+    ]
+
+def _snapshot_path(name: str) -> Path:
+    path = BACKUP_DIR / Path(name).name
+    if not (path.name.startswith(SNAPSHOT_PREFIX) and path.name.endswith(SNAPSHOT_SUFFIX)):
+        raise ValueError(f"Not a backup snapshot: {name}")
+    return path
+
+def _new_snapshot_name() -> str:
+    # Microseconds keep snapshots taken within the same second apart; the
+    # suffix covers a clock that did not move.
+    stem = f"{SNAPSHOT_PREFIX}{datetime.now().strftime('%Y%m%d-%H%M%S-%f')}"
+    name, n = f"{stem}{SNAPSHOT_SUFFIX}", 1
+    while (BACKUP_DIR / name).exists():
+        name, n = f"{stem}-{n}{SNAPSHOT_SUFFIX}", n + 1
+    return name
+
+def _table_counts(conn: sqlite3.Connection) -> dict:
+    existing = {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+    return {table: conn.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0] for table in VERIFY_TABLES if table in existing}
+
+def _check_connection(conn: sqlite3.Connection, expected_counts: dict | None = None) -> dict:
+    """Integrity check of a database, optionally against expected row counts."""
+    integrity = conn.execute("PRAGMA integrity_check").fetchone()[0]
+    if integrity != "ok":
+        raise sqlite3.DatabaseError(f"integrity_check failed: {integrity}")
+    counts = _table_counts(conn)
+    user_version = conn.execute("PRAGMA user_version").fetchone()[0]
+    if expected_counts is not None and counts != expected_counts:
+        raise sqlite3.DatabaseError(f"row counts differ from the source: {counts} != {expected_counts}")
+    return {'integrity': integrity, 'counts': counts, 'user_version': user_version}
+
+def _check_database(path: Path, expected_counts: dict | None = None) -> dict:
+    conn = sqlite3.connect(f"{path.resolve().as_uri()}?mode=ro", uri=True)
+    try:
+        return _check_connection(conn, expected_counts)
+    finally:
+        conn.close()
+
+class _TooManyRestarts(Exception):
+    pass
+
+def _copy_online(source_file: Path, target_file: Path) -> int:
+    restarts = 0
+    last_remaining = None
+
+    def progress(status, remaining, total):
+        nonlocal restarts, last_remaining
+        if last_remaining is not None and remaining > last_remaining:
+            restarts += 1
+            if restarts > BACKUP_MAX_RESTARTS:
+                raise _TooManyRestarts()
+        last_remaining = remaining
+
+    source = sqlite3.connect(f"{source_file.resolve().as_uri()}?mode=ro", uri=True)
+    target = sqlite3.connect(target_file)
+    try:
+        try:
+            source.backup(target, pages=BACKUP_PAGES_PER_STEP, progress=progress, sleep=BACKUP_STEP_SLEEP)
+        except _TooManyRestarts:
+            logger.warning(f"Backup restarted {restarts} times under write load; copying in one step.")
+            source.backup(target)
+    finally:
+        target.close()
+        source.close()
+    return restarts
+
+def create_backup() -> dict | None:
+    """
+    Copy the live database with the online backup API, verify the copy,
+    gzip it into BACKUP_DIR and rotate old snapshots. Returns the status, or
+    None if a backup is already running.
+    """
+    if not _backup_lock.acquire(blocking=False):
+        return None
+    started = time.monotonic()
+    _status.update(running=True, started_at=datetime.now().strftime('%Y-%m-%d %H:%M:%S'), error=None)
+    try:
+        database.flush_deferred_writes()
+        BACKUP_DIR.mkdir(parents=True, exist_ok=True)
+        name = _new_snapshot_name()
+        with tempfile.TemporaryDirectory(dir=BACKUP_DIR) as work_dir:
+            raw_copy = Path(work_dir) / "users.db"
+            restarts = _copy_online(Path(database.DB_FILE), raw_copy)
+            _check_database(raw_copy)
+            compressed = Path(work_dir) / name
+            with open(raw_copy, 'rb') as src, gzip.open(compressed, 'wb', compresslevel=6) as dst:
+                shutil.copyfileobj(src, dst, 1024 * 1024)
+            compressed.replace(BACKUP_DIR / name)
+        _rotate_backups()
+        size = (BACKUP_DIR / name).stat().st_size
+        _status.update(file=name, size_bytes=size, restarts=restarts)
+        logger.info(f"Backup: created {name} ({size} bytes, {restarts} restarts).")
+    except (sqlite3.Error, OSError) as e:
+        _status['error'] = str(e)
+        logger.error(f"Backup failed: {e}", exc_info=True)
+    finally:
+        _status.update(
+            running=False,
+            finished_at=datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+            duration_s=round(time.monotonic() - started, 2),
+        )
+        _backup_lock.release()
+    return get_backup_status()
+
+def _rotate_backups():
+    snapshots = sorted(BACKUP_DIR.glob(f"{SNAPSHOT_PREFIX}*{SNAPSHOT_SUFFIX}"), reverse=True)
+    for old in snapshots[BACKUP_KEEP:]:
+        old.unlink(missing_ok=True)
+        logger.info(f"Backup: removed old snapshot {old.name}.")
+
+def _unpack(path: Path, work_dir: str) -> Path:
+    raw_copy = Path(work_dir) / "restore.db"
+    with gzip.open(path, 'rb') as src, open(raw_copy, 'wb') as dst:
+        shutil.copyfileobj(src, dst, 1024 * 1024)
+    return raw_copy
+
+def verify_backup(name: str) -> dict:
+    """Unpack a snapshot into a temporary file and run the integrity checks."""
+    path = _snapshot_path(name)
+    with tempfile.TemporaryDirectory() as work_dir:
+        return _check_database(_unpack(path, work_dir))
+
+def restore_backup(name: str) -> dict:
+    """
+    Replace the live database contents with a snapshot. The snapshot is
+    verified before the copy and the restored database is checked against
+    it afterwards; caches built from the old contents are dropped.
+    """
+    path = _snapshot_path(name)
+    if not _backup_lock.acquire(blocking=False):
+        raise RuntimeError("A backup is running; try the restore again later.")
+    try:
+        database.flush_deferred_writes()
+        with tempfile.TemporaryDirectory() as work_dir:
+            raw_copy = _unpack(path, work_dir)
+            expected = _check_database(raw_copy)
+            source = sqlite3.connect(raw_copy)
+            try:
+                # The copy and its checks run while no other thread can write,
+                # so the counts compared are exactly what was restored.
+                with database.exclusive_connection() as target:
+                    source.backup(target)
+                    restored = _check_connection(target, expected_counts=expected['counts'])
+            finally:
+                source.close()
+    finally:
+        _backup_lock.release()
+    database.invalidate_settings_cache()
+    database.invalidate_catalog()
+    database.reload_banned_users()
+    logger.info(f"Backup: restored database from {name}.")
+    return restored
+
+def run_scheduled_backup(now: float | None = None) -> dict | None:
+    """Run a backup if the newest snapshot is older than BACKUP_INTERVAL_HOURS."""
+    if BACKUP_INTERVAL_HOURS <= 0:
+        return None
+    snapshots = list(BACKUP_DIR.glob(f"{SNAPSHOT_PREFIX}*{SNAPSHOT_SUFFIX}")) if BACKUP_DIR.is_dir() else []
+    newest = max((p.stat().st_mtime for p in snapshots), default=0)
+    if (now or time.time()) - newest < BACKUP_INTERVAL_HOURS * 3600:
+        return None
+    return create_backup()
+
+def start_backup_in_background() -> bool:
+    if _backup_lock.locked():
+        return False
+    threading.Thread(target=create_backup, name="db-backup", daemon=True).start()
+    return True
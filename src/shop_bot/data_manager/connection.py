@@ -0,0 +1,201 @@
+import sqlite3
+import threading
+import time
+import logging
+from contextlib import contextmanager
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+
+# Tuned for a small, write-light but read-heavy database shared by the bot,
+# the Flask panel thread and the scheduler.
+CONNECTION_PRAGMAS = (
+    "PRAGMA journal_mode = WAL",
+    "PRAGMA synchronous = NORMAL",
+    "PRAGMA cache_size = -16000",
+    "PRAGMA mmap_size = 268435456",
+    "PRAGMA temp_store = MEMORY",
+    "PRAGMA busy_timeout = 5000",
+)
+
+# Read-only connections open the file with mode=ro and refuse writes even if
+# a caller tries one; journal_mode is left to the writers.
+READ_ONLY_PRAGMAS = tuple(p for p in CONNECTION_PRAGMAS if "journal_mode" not in p) + (
+    "PRAGMA query_only = 1",
+)
+
+STATEMENT_CACHE_SIZE = 256
+
+class ConnectionPool:
+    """
+    A small pool of long-lived SQLite connections.
+
+    Connections are created lazily up to `max_size` and handed out one per
+    caller, so they can be shared between threads without ever being used
+    by two threads at once.
+
+    A `read_only` pool opens the file with mode=ro and runs each checkout
+    inside one read transaction, so a block of queries sees a single WAL
+    snapshot and never takes a write lock.
+    """
+
+    def __init__(self, db_file: Path, max_size: int = 8, read_only: bool = False):
+        self.db_file = db_file
+        self.max_size = max_size
+        self.read_only = read_only
+        self._idle: list[sqlite3.Connection] = []
+        self._created = 0
+        self._closed = False
+        self._exclusive = False
+        self._exclusive_lock = threading.Lock()
+        self._condition = threading.Condition()
+        self._stats = {'checkouts': 0, 'waits': 0, 'wait_ms_total': 0.0, 'wait_ms_max': 0.0, 'busy_errors': 0}
+
+    def _create_connection(self) -> sqlite3.Connection:
+        if self.read_only:
+            database, pragmas = f"{Path(self.db_file).resolve().as_uri()}?mode=ro", READ_ONLY_PRAGMAS
+        else:
+            database, pragmas = self.db_file, CONNECTION_PRAGMAS
+        conn = sqlite3.connect(
+            database,
+            timeout=5,
+            check_same_thread=False,
+            cached_statements=STATEMENT_CACHE_SIZE,
+            uri=self.read_only,
+        )
+        conn.row_factory = sqlite3.Row
+        for pragma in pragmas:
+            conn.execute(pragma)
+        return conn
+
+    def _acquire(self) -> sqlite3.Connection:
+        with self._condition:
+            self._stats['checkouts'] += 1
+            waited_since = None
+            while True:
+                if self._closed:
+                    raise sqlite3.ProgrammingError("Connection pool is closed.")
+                if not self._exclusive and (self._idle or self._created < self.max_size):
+                    if waited_since is not None:
+                        self._record_wait(time.perf_counter() - waited_since)
+                    if self._idle:
+                        return self._idle.pop()
+                    self._created += 1
+                    break
+                if waited_since is None:
+                    waited_since = time.perf_counter()
+                self._condition.wait()
+        try:
+            return self._create_connection()
+        except Exception:
+            with self._condition:
+                self._created -= 1
+                self._condition.notify()
+            raise
+
+    def _release(self, conn: sqlite3.Connection):
+        with self._condition:
+            if self._closed:
+                self._created -= 1
+                conn.close()
+            else:
+                self._idle.append(conn)
+            # Wake everyone: an exclusive() caller waits for the last one back.
+            self._condition.notify_all()
+
+    def _record_wait(self, seconds: float):
+        wait_ms = seconds * 1000
+        self._stats['waits'] += 1
+        self._stats['wait_ms_total'] += wait_ms
+        self._stats['wait_ms_max'] = max(self._stats['wait_ms_max'], wait_ms)
+
+    def stats(self) -> dict:
+        """Checkout counts and time spent waiting for a free connection."""
+        with self._condition:
+            stats = dict(self._stats)
+            stats.update(
+                size=self._created,
+                max_size=self.max_size,
+                idle=len(self._idle),
+                in_use=self._created - len(self._idle),
+                wait_ms_total=round(stats['wait_ms_total'], 2),
+                wait_ms_max=round(stats['wait_ms_max'], 2),
+            )
+        return stats
+
+    @contextmanager
+    def connection(self):
+        """
+        Yields a pooled connection wrapped in a transaction: it is committed
+        when the block exits normally and rolled back on an exception.
+        """
+        conn = self._acquire()
+        try:
+            if self.read_only:
+                conn.execute("BEGIN")
+            with conn:
+                yield conn
+        except sqlite3.OperationalError as e:
+            if "locked" in str(e) or "busy" in str(e):
+                with self._condition:
+                    self._stats['busy_errors'] += 1
+            raise
+        finally:
+            if conn.in_transaction:
+                conn.rollback()
+            self._release(conn)
+
+    @contextmanager
+    def exclusive(self, timeout: float = 30.0):
+        """
+        Hold the whole pool: new checkouts wait, and once every connection in
+        use has been returned the block gets one of them to itself. Raises
+        OperationalError if connections are still in use after `timeout`.
+        """
+        with self._exclusive_lock:
+            deadline = time.monotonic() + timeout
+            with self._condition:
+                self._exclusive = True
+                try:
+                    while self._created > len(self._idle):
+                        remaining = deadline - time.monotonic()
+                        if self._closed or remaining <= 0:
+                            raise sqlite3.OperationalError("Timed out waiting for pooled connections to be returned.")
+                        self._condition.wait(remaining)
+                    conn = self._idle.pop() if self._idle else None
+                    if conn is None:
+                        self._created += 1
+                except BaseException:
+                    self._exclusive = False
+                    self._condition.notify_all()
+                    raise
+            try:
+                if conn is None:
+                    try:
+                        conn = self._create_connection()
+                    except Exception:
+                        with self._condition:
+                            self._created -= 1
+                        raise
+                yield conn
+            finally:
+                if conn is not None and conn.in_transaction:
+                    conn.rollback()
+                with self._condition:
+                    self._exclusive = False
+                    if conn is not None:
+                        if self._closed:
+                            self._created -= 1
+                            conn.close()
+                        else:
+                            self._idle.append(conn)
+                    self._condition.notify_all()
+
+    def close(self):
+        with self._condition:
+            self._closed = True
+            while self._idle:
+                self._idle.pop().close()
+                self._created -= 1
+            self._condition.notify_all()
+        logger.info(f"Connection pool for '{self.db_file}' closed.")
@@ -1,195 +1,631 @@
+import os
+import re
 import sqlite3
+import threading
+import time
 from datetime import datetime, timedelta
 import logging
 from pathlib import Path
 import json
 
+from shop_bot.data_manager.connection import ConnectionPool
+from shop_bot.data_manager.write_behind import WriteBehindQueue
+
 logger = logging.getLogger(__name__)
 
 #BASE_DIR = Path(__file__).resolve().parent.parent
 #PROJECT_ROOT = BASE_DIR
 PROJECT_ROOT = Path("/app/project")
 DB_FILE = PROJECT_ROOT / "users.db"
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "8"))
+# Read-only connections used by the admin panel for its reporting queries.
+DB_READ_POOL_SIZE = int(os.getenv("DB_READ_POOL_SIZE", "4"))
+# How long a settings snapshot is trusted before PRAGMA data_version is
+# consulted again to pick up changes committed by other connections.
+SETTINGS_RECHECK_SECONDS = 1.0
+
+# Durability of each class of bookkeeping write: "sync" commits before the
+# call returns, "deferred" goes through the write-behind queue and is
+# committed within WRITE_BEHIND_INTERVAL seconds and at shutdown, so a crash
+# can lose the last interval's worth of these writes. Terms and user stats
+# stay "sync": handlers and the per-update UserContext read them straight back
+# (total_spent decides the first-purchase discount).
+WRITE_DURABILITY = {
+    'username': 'deferred',
+    'terms': 'sync',
+    'user_stats': 'sync',
+    'transaction_log': 'sync',
+}
+WRITE_BEHIND_INTERVAL = 0.5
+
+_pool: ConnectionPool | None = None
+_read_pool: ConnectionPool | None = None
+_pool_lock = threading.Lock()
+# Per-thread switch set by the panel around read-only requests.
+_thread_state = threading.local()
+_write_queue: WriteBehindQueue | None = None
+
+_settings_cache: dict | None = None
+_settings_data_version: int | None = None
+_settings_checked_at = 0.0
+_settings_lock = threading.Lock()
+_data_version_conn: tuple[Path, sqlite3.Connection] | None = None
+
+# Telegram IDs of banned users, checked on every bot update. Loaded at bot
+# start and by the scheduler (reload_banned_users), kept current by ban_user /
+# unban_user. Bans made while a reload is reading are journaled with their
+# generation and replayed onto the reloaded set.
+_banned_ids: frozenset[int] | None = None
+_banned_lock = threading.Lock()
+_banned_generation = 0
+_banned_reloads = 0
+_banned_journal: list[tuple[int, int, bool]] = []
+
+# Hosts and plans, read on every purchase step but only changed from the
+# panel. Each create/delete rebuilds the snapshot and swaps it in whole, so
+# readers never see a half-built catalog; the version counts the rebuilds.
+_catalog: dict | None = None
+_catalog_version = 0
+_catalog_lock = threading.Lock()
+
+def _get_pool() -> ConnectionPool:
+    global _pool
+    with _pool_lock:
+        if _pool is None or _pool.db_file != DB_FILE:
+            if _pool is not None:
+                _pool.close()
+            _pool = ConnectionPool(DB_FILE, max_size=DB_POOL_SIZE)
+        return _pool
+
+def _get_read_pool() -> ConnectionPool:
+    global _read_pool
+    with _pool_lock:
+        if _read_pool is None or _read_pool.db_file != DB_FILE:
+            if _read_pool is not None:
+                _read_pool.close()
+            _read_pool = ConnectionPool(DB_FILE, max_size=DB_READ_POOL_SIZE, read_only=True)
+        return _read_pool
+
+def use_read_only_connections(enabled: bool):
+    """Route this thread's queries to the read-only pool until switched back."""
+    _thread_state.read_only = enabled
+
+def _connect():
+    if getattr(_thread_state, 'read_only', False):
+        return _get_read_pool().connection()
+    return _get_pool().connection()
+
+def exclusive_connection():
+    """
+    A write connection while no other thread can use the pool, for work that
+    must not interleave with the bot's writes (restoring a backup).
+    """
+    return _get_pool().exclusive()
+
+def get_pool_stats() -> dict:
+    with _pool_lock:
+        pools = {'write': _pool, 'read': _read_pool}
+    stats = {name: pool.stats() for name, pool in pools.items() if pool is not None}
+    stats['write_behind'] = get_write_queue_stats()
+    return stats
+
+def _get_write_queue() -> WriteBehindQueue:
+    global _write_queue
+    with _pool_lock:
+        if _write_queue is None:
+            _write_queue = WriteBehindQueue(_connect, interval=WRITE_BEHIND_INTERVAL)
+        return _write_queue
+
+def _write(write_class: str, sql: str, params: tuple):
+    if WRITE_DURABILITY.get(write_class, 'sync') == 'deferred':
+        _get_write_queue().submit(sql, params)
+        return
+    with _connect() as conn:
+        conn.execute(sql, params)
+        conn.commit()
+
+def flush_deferred_writes() -> int:
+    queue = _write_queue
+    return queue.flush() if queue is not None else 0
+
+def get_write_queue_stats() -> dict:
+    queue = _write_queue
+    return queue.stats() if queue is not None else {}
+
+def close_connections():
+    global _pool, _read_pool, _data_version_conn, _write_queue
+    with _pool_lock:
+        queue, _write_queue = _write_queue, None
+    if queue is not None:
+        queue.close()
+    with _pool_lock:
+        if _pool is not None:
+            _pool.close()
+            _pool = None
+        if _read_pool is not None:
+            _read_pool.close()
+            _read_pool = None
+    with _settings_lock:
+        if _data_version_conn is not None:
+            _data_version_conn[1].close()
+            _data_version_conn = None
+
+DEFAULT_SETTINGS = {
+    "panel_login": "admin",
+    "panel_password": "admin",
+    "about_text": None,
+    "terms_url": None,
+    "privacy_url": None,
+    "support_user": None,
+    "support_text": None,
+    "channel_url": None,
+    "force_subscription": "true",
+    "receipt_email": "example@example.com",
+    "telegram_bot_token": None,
+    "support_bot_token": None,
+    "telegram_bot_username": None,
+    "trial_enabled": "true",
+    "trial_duration_days": "3",
+    "enable_referrals": "true",
+    "referral_discount": "5",
+    "support_group_id": None,
+    "admin_telegram_id": None,
+    "yookassa_shop_id": None,
+    "yookassa_secret_key": None,
+    "sbp_enabled": "false",
+    "cryptobot_token": None,
+    "heleket_merchant_id": None,
+    "heleket_api_key": None,
+    "domain": None,
+    "ton_wallet_address": None,
+    "tonapi_key": None,
+}
 
 def initialize_db():
     try:
-        with sqlite3.connect(DB_FILE) as conn:
-            cursor = conn.cursor()
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS users (
-                    telegram_id INTEGER PRIMARY KEY, username TEXT, total_spent REAL DEFAULT 0,
-                    total_months INTEGER DEFAULT 0, trial_used BOOLEAN DEFAULT 0,
-                    agreed_to_terms BOOLEAN DEFAULT 0,
-                    registration_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    is_banned BOOLEAN DEFAULT 0,
-                    referred_by INTEGER
-                )
-            ''')
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS vpn_keys (
-                    key_id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    user_id INTEGER NOT NULL,
-                    host_name TEXT NOT NULL,
-                    xui_client_uuid TEXT NOT NULL,
-                    key_email TEXT NOT NULL UNIQUE,
-                    expiry_date TIMESTAMP,
-                    created_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    key_name TEXT
-                )
-            ''')
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS transactions (
-                    username TEXT,
-                    transaction_id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    payment_id TEXT UNIQUE NOT NULL,
-                    user_id INTEGER NOT NULL,
-                    status TEXT NOT NULL,
-                    amount_rub REAL NOT NULL,
-                    amount_currency REAL,
-                    currency_name TEXT,
-                    payment_method TEXT,
-                    metadata TEXT,
-                    created_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                )
-            ''')
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS bot_settings (
-                    key TEXT PRIMARY KEY,
-                    value TEXT
-                )
-            ''')
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS support_threads (
-                    user_id INTEGER PRIMARY KEY,
-                    thread_id INTEGER NOT NULL
-                )
-            ''')
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS xui_hosts(
-                    host_name TEXT NOT NULL,
-                    host_url TEXT NOT NULL,
-                    host_username TEXT NOT NULL,
-                    host_pass TEXT NOT NULL,
-                    host_inbound_id INTEGER NOT NULL
-                )
-            ''')
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS plans (
-                    plan_id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    host_name TEXT NOT NULL,
-                    plan_name TEXT NOT NULL,
-                    months INTEGER NOT NULL,
-                    price REAL NOT NULL,
-                    FOREIGN KEY (host_name) REFERENCES xui_hosts (host_name)
-                )
-            ''')            
-            default_settings = {
-                "panel_login": "admin",
-                "panel_password": "admin",
-                "about_text": None,
-                "terms_url": None,
-                "privacy_url": None,
-                "support_user": None,
-                "support_text": None,
-                "channel_url": None,
-                "force_subscription": "true",
-                "receipt_email": "example@example.com",
-                "telegram_bot_token": None,
-                "support_bot_token": None,
-                "telegram_bot_username": None,
-                "trial_enabled": "true",
-                "trial_duration_days": "3",
-                "enable_referrals": "true",
-                "referral_discount": "5",
-                "support_group_id": None,
-                "admin_telegram_id": None,
-                "yookassa_shop_id": None,
-                "yookassa_secret_key": None,
-                "sbp_enabled": "false",
-                "cryptobot_token": None,
-                "heleket_merchant_id": None,
-                "heleket_api_key": None,
-                "domain": None,
-                "ton_wallet_address": None,
-                "tonapi_key": None,
-            }
-            run_migration()
-            for key, value in default_settings.items():
-                cursor.execute("INSERT OR IGNORE INTO bot_settings (key, value) VALUES (?, ?)", (key, value))
-            conn.commit()
-            logging.info("Database initialized successfully.")
+        with _connect() as conn:
+            version = conn.execute("PRAGMA user_version").fetchone()[0]
+        if version >= SCHEMA_VERSION:
+            logging.info(f"Database schema is up to date (version {version}).")
+            return
+        run_migration(version)
+        logging.info("Database initialized successfully.")
     except sqlite3.Error as e:
         logging.error(f"Database error on initialization: {e}")
 
-def run_migration():
-    if not DB_FILE.exists():
-        logging.error("Users.db database file was not found. There is nothing to migrate.")
-        return
+def run_migration(current_version: int):
+    """
+    Applies every step from MIGRATIONS newer than `current_version`.
+    Each step runs in its own transaction together with the bump of
+    PRAGMA user_version, so a failed step is retried on the next start.
+    """
+    logging.info(f"Starting the migration of the database {DB_FILE} from version {current_version} to {SCHEMA_VERSION}")
+
+    with _connect() as conn:
+        for version, migration in MIGRATIONS:
+            if version <= current_version:
+                continue
+            logging.info(f"Applying migration {version}: {migration.__name__} ...")
+            conn.execute("BEGIN")
+            cursor = conn.cursor()
+            migration(cursor)
+            cursor.execute(f"PRAGMA user_version = {version}")
+            conn.commit()
+            logging.info(f" -> Migration {version} applied.")
 
-    logging.info(f"Starting the migration of the database: {DB_FILE}")
+    invalidate_settings_cache()
+    invalidate_catalog()
+    logging.info("--- The database is successfully completed! ---")
 
-    try:
-        conn = sqlite3.connect(DB_FILE)
-        cursor = conn.cursor()
-
-        logging.info("The migration of the table 'users' ...")
-    
-        cursor.execute("PRAGMA table_info(users)")
-        columns = [row[1] for row in cursor.fetchall()]
-        
-        if 'referred_by' not in columns:
-            cursor.execute("ALTER TABLE users ADD COLUMN referred_by INTEGER")
-            logging.info(" -> The column 'referred_by' is successfully added.")
-        else:
-            logging.info(" -> The column 'referred_by' already exists.")
-            
-        # Skip adding referral balance columns as they are no longer needed
-        logging.info("The table 'users' has been successfully updated.")
+def _migration_001_base_schema(cursor: sqlite3.Cursor):
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS users (
+            telegram_id INTEGER PRIMARY KEY, username TEXT, total_spent REAL DEFAULT 0,
+            total_months INTEGER DEFAULT 0, trial_used BOOLEAN DEFAULT 0,
+            agreed_to_terms BOOLEAN DEFAULT 0,
+            registration_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            is_banned BOOLEAN DEFAULT 0,
+            referred_by INTEGER
+        )
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS vpn_keys (
+            key_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            host_name TEXT NOT NULL,
+            xui_client_uuid TEXT NOT NULL,
+            key_email TEXT NOT NULL UNIQUE,
+            expiry_date TIMESTAMP,
+            created_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            key_name TEXT
+        )
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS bot_settings (
+            key TEXT PRIMARY KEY,
+            value TEXT
+        )
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS support_threads (
+            user_id INTEGER PRIMARY KEY,
+            thread_id INTEGER NOT NULL
+        )
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS xui_hosts(
+            host_name TEXT NOT NULL,
+            host_url TEXT NOT NULL,
+            host_username TEXT NOT NULL,
+            host_pass TEXT NOT NULL,
+            host_inbound_id INTEGER NOT NULL
+        )
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS plans (
+            plan_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            host_name TEXT NOT NULL,
+            plan_name TEXT NOT NULL,
+            months INTEGER NOT NULL,
+            price REAL NOT NULL,
+            FOREIGN KEY (host_name) REFERENCES xui_hosts (host_name)
+        )
+    ''')
 
-        logging.info("The migration of the table 'vpn_keys' ...")
-    
-        cursor.execute("PRAGMA table_info(vpn_keys)")
-        columns = [row[1] for row in cursor.fetchall()]
-        
-        if 'key_name' not in columns:
-            cursor.execute("ALTER TABLE vpn_keys ADD COLUMN key_name TEXT")
-            logging.info(" -> The column 'key_name' is successfully added.")
-        else:
-            logging.info(" -> The column 'key_name' already exists.")
+    # Databases created before versioned migrations may lack these columns.
+    cursor.execute("PRAGMA table_info(users)")
+    columns = [row[1] for row in cursor.fetchall()]
+    if 'referred_by' not in columns:
+        cursor.execute("ALTER TABLE users ADD COLUMN referred_by INTEGER")
+        logging.info(" -> The column 'referred_by' is successfully added.")
+
+    cursor.execute("PRAGMA table_info(vpn_keys)")
+    columns = [row[1] for row in cursor.fetchall()]
+    if 'key_name' not in columns:
+        cursor.execute("ALTER TABLE vpn_keys ADD COLUMN key_name TEXT")
+        logging.info(" -> The column 'key_name' is successfully added.")
+
+    cursor.execute("PRAGMA table_info(transactions)")
+    trans_columns = [row[1] for row in cursor.fetchall()]
+    if trans_columns and not ('payment_id' in trans_columns and 'status' in trans_columns and 'username' in trans_columns):
+        backup_name = f"transactions_backup_{datetime.now().strftime('%Y%m%d%H%M%S')}"
+        logging.warning(f"The old structure of the TRANSACTIONS table was discovered. I rename in '{backup_name}' ...")
+        cursor.execute(f"ALTER TABLE transactions RENAME TO {backup_name}")
+    create_new_transactions_table(cursor)
+
+    for key, value in DEFAULT_SETTINGS.items():
+        cursor.execute("INSERT OR IGNORE INTO bot_settings (key, value) VALUES (?, ?)", (key, value))
+
+def _migration_002_hot_path_indexes(cursor: sqlite3.Cursor):
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_vpn_keys_user_id ON vpn_keys (user_id)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_vpn_keys_host_name ON vpn_keys (host_name)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_vpn_keys_expiry_date ON vpn_keys (expiry_date)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_vpn_keys_created_date ON vpn_keys (created_date)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_transactions_user_created ON transactions (user_id, created_date)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_transactions_status ON transactions (status)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_users_referred_by ON users (referred_by)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_users_registration_date ON users (registration_date)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_support_threads_thread_id ON support_threads (thread_id)")
+    cursor.execute("ANALYZE")
+
+def _migration_003_transactions_keyset(cursor: sqlite3.Cursor):
+    cursor.execute("ALTER TABLE transactions ADD COLUMN host_name TEXT")
+    cursor.execute("ALTER TABLE transactions ADD COLUMN plan_name TEXT")
+    cursor.execute('''
+        UPDATE transactions SET
+            host_name = json_extract(metadata, '$.host_name'),
+            plan_name = json_extract(metadata, '$.plan_name')
+        WHERE json_valid(metadata)
+    ''')
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_transactions_created ON transactions (created_date, transaction_id)")
 
-        logging.info("The table 'vpn_keys' has been successfully updated.")
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS stats_counters (
+            name TEXT PRIMARY KEY,
+            value REAL NOT NULL DEFAULT 0
+        )
+    ''')
+    cursor.execute("INSERT OR REPLACE INTO stats_counters (name, value) SELECT 'transactions', COUNT(*) FROM transactions")
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_transactions_count_insert AFTER INSERT ON transactions
+        BEGIN
+            UPDATE stats_counters SET value = value + 1 WHERE name = 'transactions';
+        END
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_transactions_count_delete AFTER DELETE ON transactions
+        BEGIN
+            UPDATE stats_counters SET value = value - 1 WHERE name = 'transactions';
+        END
+    ''')
 
-        logging.info("The migration of the table 'Transactions' ...")
+# Source of truth for every counter in stats_counters; used to seed them and
+# by recompute_stats_counters() to repair drift.
+STATS_COUNTER_QUERIES = {
+    'transactions': "SELECT COUNT(*) FROM transactions",
+    'users': "SELECT COUNT(*) FROM users",
+    'vpn_keys': "SELECT COUNT(*) FROM vpn_keys",
+    'total_spent': "SELECT COALESCE(SUM(total_spent), 0) FROM users",
+    'hosts': "SELECT COUNT(*) FROM xui_hosts",
+}
+
+def _migration_004_dashboard_counters(cursor: sqlite3.Cursor):
+    for name in ('users', 'vpn_keys', 'total_spent', 'hosts'):
+        cursor.execute(
+            f"INSERT OR REPLACE INTO stats_counters (name, value) SELECT ?, ({STATS_COUNTER_QUERIES[name]})",
+            (name,)
+        )
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_users_count_insert AFTER INSERT ON users
+        BEGIN
+            UPDATE stats_counters SET value = value + 1 WHERE name = 'users';
+            UPDATE stats_counters SET value = value + COALESCE(NEW.total_spent, 0) WHERE name = 'total_spent';
+        END
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_users_count_delete AFTER DELETE ON users
+        BEGIN
+            UPDATE stats_counters SET value = value - 1 WHERE name = 'users';
+            UPDATE stats_counters SET value = value - COALESCE(OLD.total_spent, 0) WHERE name = 'total_spent';
+        END
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_users_total_spent_update AFTER UPDATE OF total_spent ON users
+        BEGIN
+            UPDATE stats_counters SET value = value + COALESCE(NEW.total_spent, 0) - COALESCE(OLD.total_spent, 0) WHERE name = 'total_spent';
+        END
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_vpn_keys_count_insert AFTER INSERT ON vpn_keys
+        BEGIN
+            UPDATE stats_counters SET value = value + 1 WHERE name = 'vpn_keys';
+        END
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_vpn_keys_count_delete AFTER DELETE ON vpn_keys
+        BEGIN
+            UPDATE stats_counters SET value = value - 1 WHERE name = 'vpn_keys';
+        END
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_hosts_count_insert AFTER INSERT ON xui_hosts
+        BEGIN
+            UPDATE stats_counters SET value = value + 1 WHERE name = 'hosts';
+        END
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_hosts_count_delete AFTER DELETE ON xui_hosts
+        BEGIN
+            UPDATE stats_counters SET value = value - 1 WHERE name = 'hosts';
+        END
+    ''')
 
-        cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='transactions'")
-        table_exists = cursor.fetchone()
+def _migration_005_daily_rollups(cursor: sqlite3.Cursor):
+    # Append-only per-day rollups for the dashboard charts. Deleting a user or
+    # key does not rewrite history, so rows are only ever incremented.
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS daily_stats (
+            day TEXT NOT NULL,
+            metric TEXT NOT NULL,
+            value REAL NOT NULL DEFAULT 0,
+            PRIMARY KEY (metric, day)
+        ) WITHOUT ROWID
+    ''')
+    cursor.execute('''
+        INSERT INTO daily_stats (day, metric, value)
+        SELECT date(registration_date), 'registrations', COUNT(*) FROM users
+        WHERE registration_date IS NOT NULL GROUP BY 1
+    ''')
+    cursor.execute('''
+        INSERT INTO daily_stats (day, metric, value)
+        SELECT date(created_date), 'keys', COUNT(*) FROM vpn_keys
+        WHERE created_date IS NOT NULL GROUP BY 1
+    ''')
+    cursor.execute('''
+        INSERT INTO daily_stats (day, metric, value)
+        SELECT date(created_date), 'revenue', SUM(amount_rub) FROM transactions
+        WHERE status = 'paid' AND created_date IS NOT NULL GROUP BY 1
+    ''')
+    cursor.execute('''
+        INSERT INTO daily_stats (day, metric, value)
+        SELECT date(created_date), 'revenue:' || payment_method, SUM(amount_rub) FROM transactions
+        WHERE status = 'paid' AND created_date IS NOT NULL AND payment_method IS NOT NULL GROUP BY 1, 2
+    ''')
 
-        if table_exists:
-            cursor.execute("PRAGMA table_info(transactions)")
-            trans_columns = [row[1] for row in cursor.fetchall()]
-            
-            if 'payment_id' in trans_columns and 'status' in trans_columns and 'username' in trans_columns:
-                logging.info("The 'Transactions' table already has a new structure. Migration is not required.")
-            else:
-                backup_name = f"transactions_backup_{datetime.now().strftime('%Y%m%d%H%M%S')}"
-                logging.warning(f"The old structure of the TRANSACTIONS table was discovered. I rename in '{backup_name}' ...")
-                cursor.execute(f"ALTER TABLE transactions RENAME TO {backup_name}")
-                
-                logging.info("I create a new table 'Transactions' with the correct structure ...")
-                create_new_transactions_table(cursor)
-                logging.info("The new table 'Transactions' has been successfully created. The old data is saved.")
-        else:
-            logging.info("TRANSACTIONS table was not found. I create a new one ...")
-            create_new_transactions_table(cursor)
-            logging.info("The new table 'Transactions' has been successfully created.")
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_users_daily_registrations AFTER INSERT ON users
+        BEGIN
+            INSERT INTO daily_stats (day, metric, value)
+            VALUES (date(COALESCE(NEW.registration_date, CURRENT_TIMESTAMP)), 'registrations', 1)
+            ON CONFLICT (metric, day) DO UPDATE SET value = value + 1;
+        END
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_vpn_keys_daily_keys AFTER INSERT ON vpn_keys
+        BEGIN
+            INSERT INTO daily_stats (day, metric, value)
+            VALUES (date(COALESCE(NEW.created_date, CURRENT_TIMESTAMP)), 'keys', 1)
+            ON CONFLICT (metric, day) DO UPDATE SET value = value + 1;
+        END
+    ''')
+    # Every completed payment is recorded by log_transaction as a new 'paid'
+    # row (TON invoices flip their pending row to 'paid' first, then get
+    # logged too), so only inserts count towards revenue.
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_transactions_daily_revenue AFTER INSERT ON transactions
+        WHEN NEW.status = 'paid'
+        BEGIN
+            INSERT INTO daily_stats (day, metric, value)
+            VALUES (date(COALESCE(NEW.created_date, CURRENT_TIMESTAMP)), 'revenue', COALESCE(NEW.amount_rub, 0))
+            ON CONFLICT (metric, day) DO UPDATE SET value = value + excluded.value;
+            INSERT INTO daily_stats (day, metric, value)
+            SELECT date(COALESCE(NEW.created_date, CURRENT_TIMESTAMP)), 'revenue:' || NEW.payment_method, COALESCE(NEW.amount_rub, 0)
+            WHERE NEW.payment_method IS NOT NULL
+            ON CONFLICT (metric, day) DO UPDATE SET value = value + excluded.value;
+        END
+    ''')
 
-        conn.commit()
-        conn.close()
-        
-        logging.info("--- The database is successfully completed! ---")
+def _migration_006_users_page_indexes(cursor: sqlite3.Cursor):
+    # The composite indexes cover the users page filters and make the
+    # single-column ones they extend redundant.
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_vpn_keys_user_expiry ON vpn_keys (user_id, expiry_date)")
+    cursor.execute("DROP INDEX IF EXISTS idx_vpn_keys_user_id")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_vpn_keys_host_user ON vpn_keys (host_name, user_id)")
+    cursor.execute("DROP INDEX IF EXISTS idx_vpn_keys_host_name")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_users_banned_registration ON users (is_banned, registration_date)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_users_total_spent ON users (total_spent)")
+    cursor.execute("ANALYZE")
+
+# External-content FTS5 indexes for the admin panel search. '@', '.', '_'
+# and '-' are token characters so emails and UUIDs stay single tokens that
+# can be matched by prefix.
+SEARCH_TOKENIZER = "unicode61 tokenchars '@._-'"
+
+SEARCH_INDEXES = {
+    'users_fts': ('users', 'telegram_id', ('username', 'telegram_id')),
+    'keys_fts': ('vpn_keys', 'key_id', ('key_email', 'key_name', 'xui_client_uuid')),
+    'transactions_fts': ('transactions', 'transaction_id', ('payment_id',)),
+}
+
+def _migration_007_search_indexes(cursor: sqlite3.Cursor):
+    for fts_table, (table, rowid, columns) in SEARCH_INDEXES.items():
+        column_list = ", ".join(columns)
+        new_values = ", ".join(f"NEW.{column}" for column in columns)
+        old_values = ", ".join(f"OLD.{column}" for column in columns)
+        cursor.execute(f'''
+            CREATE VIRTUAL TABLE IF NOT EXISTS {fts_table} USING fts5(
+                {column_list},
+                content='{table}', content_rowid='{rowid}',
+                tokenize="{SEARCH_TOKENIZER}", prefix='2 4'
+            )
+        ''')
+        cursor.execute(f"INSERT INTO {fts_table} ({fts_table}) VALUES ('rebuild')")
+        cursor.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS trg_{fts_table}_insert AFTER INSERT ON {table}
+            BEGIN
+                INSERT INTO {fts_table} (rowid, {column_list}) VALUES (NEW.{rowid}, {new_values});
+            END
+        ''')
+        cursor.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS trg_{fts_table}_delete AFTER DELETE ON {table}
+            BEGIN
+                INSERT INTO {fts_table} ({fts_table}, rowid, {column_list}) VALUES ('delete', OLD.{rowid}, {old_values});
+            END
+        ''')
+        cursor.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS trg_{fts_table}_update AFTER UPDATE OF {column_list} ON {table}
+            BEGIN
+                INSERT INTO {fts_table} ({fts_table}, rowid, {column_list}) VALUES ('delete', OLD.{rowid}, {old_values});
+                INSERT INTO {fts_table} (rowid, {column_list}) VALUES (NEW.{rowid}, {new_values});
+            END
+        ''')
+
+def _migration_008_key_numbers(cursor: sqlite3.Cursor):
+    cursor.execute("ALTER TABLE users ADD COLUMN key_seq INTEGER NOT NULL DEFAULT 0")
+    cursor.execute("ALTER TABLE vpn_keys ADD COLUMN key_number INTEGER")
+    # Keep the numbers users already see: keys were shown by position in key_id order.
+    cursor.execute('''
+        WITH ranked AS (
+            SELECT key_id, ROW_NUMBER() OVER (PARTITION BY user_id ORDER BY key_id) AS position
+            FROM vpn_keys
+        )
+        UPDATE vpn_keys SET key_number = ranked.position
+        FROM ranked WHERE ranked.key_id = vpn_keys.key_id
+    ''')
+    cursor.execute('''
+        UPDATE users SET key_seq = COALESCE(
+            (SELECT MAX(key_number) FROM vpn_keys WHERE vpn_keys.user_id = users.telegram_id), 0
+        )
+    ''')
+    # Emails embed the number that was current when the key was created
+    # ("user1-key3@host.bot", "user_1_key_3"), which can be higher than the
+    # position after deletions. Start the sequence past them to avoid clashes.
+    cursor.execute("SELECT user_id, key_email FROM vpn_keys")
+    issued = {}
+    for user_id, key_email in cursor.fetchall():
+        match = re.search(r"key_?(\d+)", key_email or "")
+        if match:
+            issued[user_id] = max(issued.get(user_id, 0), int(match.group(1)))
+    cursor.executemany(
+        "UPDATE users SET key_seq = MAX(key_seq, ?) WHERE telegram_id = ?",
+        [(number, user_id) for user_id, number in issued.items()]
+    )
+
+def _migration_009_expiry_ms(cursor: sqlite3.Cursor):
+    # Same representation as the 3x-ui panel's expiry_time: epoch milliseconds.
+    # expiry_date holds naive local time, hence the 'utc' modifier.
+    cursor.execute("ALTER TABLE vpn_keys ADD COLUMN expiry_ms INTEGER")
+    cursor.execute('''
+        UPDATE vpn_keys
+        SET expiry_ms = CAST(ROUND((julianday(expiry_date, 'utc') - 2440587.5) * 86400000) AS INTEGER)
+        WHERE expiry_date IS NOT NULL
+    ''')
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_vpn_keys_expiry_ms ON vpn_keys (expiry_ms)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_vpn_keys_host_expiry ON vpn_keys (host_name, expiry_ms)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_vpn_keys_user_expiry_ms ON vpn_keys (user_id, expiry_ms)")
+    cursor.execute("DROP INDEX IF EXISTS idx_vpn_keys_expiry_date")
+    cursor.execute("DROP INDEX IF EXISTS idx_vpn_keys_user_expiry")
+    cursor.execute("ANALYZE")
+
+def _migration_010_transaction_plan_columns(cursor: sqlite3.Cursor):
+    cursor.execute("ALTER TABLE transactions ADD COLUMN plan_id INTEGER")
+    cursor.execute('''
+        UPDATE transactions SET plan_id = CAST(json_extract(metadata, '$.plan_id') AS INTEGER)
+        WHERE json_valid(metadata) AND json_extract(metadata, '$.plan_id') IS NOT NULL
+    ''')
+    cursor.execute('''
+        UPDATE transactions SET plan_name = (SELECT plan_name FROM plans WHERE plans.plan_id = transactions.plan_id)
+        WHERE plan_name IS NULL AND plan_id IS NOT NULL
+    ''')
+    # Partial covering indexes for the revenue breakdowns, which only look at paid rows.
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_transactions_paid_host
+        ON transactions (host_name, created_date, amount_rub) WHERE status = 'paid'
+    ''')
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_transactions_paid_plan
+        ON transactions (plan_id, created_date, amount_rub) WHERE status = 'paid'
+    ''')
+    cursor.execute("ANALYZE")
+
+def _migration_011_host_inbound_profile(cursor: sqlite3.Cursor):
+    # What a connection string needs from the host's inbound (port and Reality
+    # settings) as JSON, so keys can be shown without calling the panel.
+    cursor.execute("ALTER TABLE xui_hosts ADD COLUMN inbound_profile TEXT")
+    cursor.execute("ALTER TABLE xui_hosts ADD COLUMN inbound_profile_updated_at TIMESTAMP")
+
+# A paid TON invoice leaves two 'paid' rows: the pending invoice flipped by
+# find_and_complete_ton_transaction (the only row with currency_name 'TON')
+# and the row log_transaction inserts for the payment. Revenue counts the latter.
+COUNTED_PAYMENT = "status = 'paid' AND currency_name IS NOT 'TON'"
+
+def _migration_012_counted_payment_indexes(cursor: sqlite3.Cursor):
+    cursor.execute("DROP INDEX IF EXISTS idx_transactions_paid_host")
+    cursor.execute("DROP INDEX IF EXISTS idx_transactions_paid_plan")
+    cursor.execute(f'''
+        CREATE INDEX IF NOT EXISTS idx_transactions_paid_host
+        ON transactions (host_name, created_date, amount_rub) WHERE {COUNTED_PAYMENT}
+    ''')
+    cursor.execute(f'''
+        CREATE INDEX IF NOT EXISTS idx_transactions_paid_plan
+        ON transactions (plan_id, created_date, amount_rub) WHERE {COUNTED_PAYMENT}
+    ''')
 
-    except sqlite3.Error as e:
-        logging.error(f"An error occurred during migration: {e}")
+MIGRATIONS = [
+    (1, _migration_001_base_schema),
+    (2, _migration_002_hot_path_indexes),
+    (3, _migration_003_transactions_keyset),
+    (4, _migration_004_dashboard_counters),
+    (5, _migration_005_daily_rollups),
+    (6, _migration_006_users_page_indexes),
+    (7, _migration_007_search_indexes),
+    (8, _migration_008_key_numbers),
+    (9, _migration_009_expiry_ms),
+    (10, _migration_010_transaction_plan_columns),
+    (11, _migration_011_host_inbound_profile),
+    (12, _migration_012_counted_payment_indexes),
+]
+SCHEMA_VERSION = MIGRATIONS[-1][0]
 
 def create_new_transactions_table(cursor: sqlite3.Cursor):
     cursor.execute('''
@@ -210,7 +646,7 @@ def create_new_transactions_table(cursor: sqlite3.Cursor):
 
 def create_host(name: str, url: str, user: str, passwd: str, inbound: int):
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _connect() as conn:
             cursor = conn.cursor()
             cursor.execute(
                 "INSERT INTO xui_hosts (host_name, host_url, host_username, host_pass, host_inbound_id) VALUES (?, ?, ?, ?, ?)",
@@ -220,10 +656,12 @@ def create_host(name: str, url: str, user: str, passwd: str, inbound: int):
             logging.info(f"Successfully created a new host: {name}")
     except sqlite3.Error as e:
         logging.error(f"Error creating host '{name}': {e}")
+    finally:
+        reload_catalog()
 
 def delete_host(host_name: str):
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _connect() as conn:
             cursor = conn.cursor()
             cursor.execute("DELETE FROM plans WHERE host_name = ?", (host_name,))
             cursor.execute("DELETE FROM xui_hosts WHERE host_name = ?", (host_name,))
@@ -231,35 +669,90 @@ def delete_host(host_name: str):
             logging.info(f"Successfully deleted host '{host_name}' and its plans.")
     except sqlite3.Error as e:
         logging.error(f"Error deleting host '{host_name}': {e}")
+    finally:
+        reload_catalog()
+
+def _build_catalog(conn: sqlite3.Connection, version: int) -> dict:
+    hosts = tuple(dict(row) for row in conn.execute("SELECT * FROM xui_hosts ORDER BY rowid"))
+    plans_by_host = {host['host_name']: [] for host in hosts}
+    plans_by_id = {}
+    for row in conn.execute("SELECT * FROM plans ORDER BY host_name, months, plan_id"):
+        plan = dict(row)
+        plans_by_host.setdefault(plan['host_name'], []).append(plan)
+        plans_by_id[plan['plan_id']] = plan
+    return {
+        'version': version,
+        'hosts': hosts,
+        'hosts_by_name': {host['host_name']: host for host in hosts},
+        'plans_by_host': {name: tuple(plans) for name, plans in plans_by_host.items()},
+        'plans_by_id': plans_by_id,
+    }
+
+def reload_catalog() -> int:
+    """Rebuild the hosts/plans snapshot and return its new version."""
+    global _catalog, _catalog_version
+    with _catalog_lock:
+        try:
+            with _connect() as conn:
+                catalog = _build_catalog(conn, _catalog_version + 1)
+        except sqlite3.Error as e:
+            logging.error(f"Failed to load hosts and plans catalog: {e}")
+            _catalog = None
+            return _catalog_version
+        _catalog_version = catalog['version']
+        _catalog = catalog
+        return _catalog_version
+
+def invalidate_catalog():
+    global _catalog
+    with _catalog_lock:
+        _catalog = None
+
+def is_catalog_loaded() -> bool:
+    return _catalog is not None
+
+def _get_catalog() -> dict | None:
+    catalog = _catalog
+    if catalog is None:
+        reload_catalog()
+        catalog = _catalog
+    return catalog
+
+def get_catalog_version() -> int:
+    catalog = _get_catalog()
+    return catalog['version'] if catalog else 0
 
 def get_host(host_name: str) -> dict | None:
-    try:
-        with sqlite3.connect(DB_FILE) as conn:
-            conn.row_factory = sqlite3.Row
-            cursor = conn.cursor()
-            cursor.execute("SELECT * FROM xui_hosts WHERE host_name = ?", (host_name,))
-            result = cursor.fetchone()
-            return dict(result) if result else None
-    except sqlite3.Error as e:
-        logging.error(f"Error getting host '{host_name}': {e}")
-        return None
+    catalog = _get_catalog()
+    host = catalog['hosts_by_name'].get(host_name) if catalog else None
+    return dict(host) if host else None
 
 def get_all_hosts() -> list[dict]:
+    catalog = _get_catalog()
+    return [dict(host) for host in catalog['hosts']] if catalog else []
+
+def update_host_profile(host_name: str, profile: dict | None) -> bool:
+    """Store a host's inbound profile; returns True if the stored value changed."""
+    profile_json = json.dumps(profile, sort_keys=True) if profile is not None else None
     try:
-        with sqlite3.connect(DB_FILE) as conn:
-            conn.row_factory = sqlite3.Row
+        with _connect() as conn:
             cursor = conn.cursor()
-            cursor.execute("SELECT * FROM xui_hosts")
-            hosts = cursor.fetchall()
-            return [dict(row) for row in hosts]
+            cursor.execute(
+                "UPDATE xui_hosts SET inbound_profile = ?, inbound_profile_updated_at = ? WHERE host_name = ? AND inbound_profile IS NOT ?",
+                (profile_json, datetime.now(), host_name, profile_json)
+            )
+            conn.commit()
+            changed = cursor.rowcount > 0
     except sqlite3.Error as e:
-        logging.error(f"Error getting list of all hosts: {e}")
-        return []
+        logging.error(f"Failed to update inbound profile for host '{host_name}': {e}")
+        return False
+    if changed:
+        reload_catalog()
+    return changed
 
 def get_all_keys() -> list[dict]:
     try:
-        with sqlite3.connect(DB_FILE) as conn:
-            conn.row_factory = sqlite3.Row
+        with _connect() as conn:
             cursor = conn.cursor()
             cursor.execute("SELECT * FROM vpn_keys")
             return [dict(row) for row in cursor.fetchall()]
@@ -267,44 +760,133 @@ def get_all_keys() -> list[dict]:
         logging.error(f"Failed to get all keys: {e}")
         return []
 
+ITER_BATCH_SIZE = 500
+
+def fetch_batch(table: str, key_column: str, columns: tuple[str, ...], after=None, batch_size: int = ITER_BATCH_SIZE, where: str | None = None, params: tuple = ()) -> list[dict]:
+    """
+    Returns the next `batch_size` rows of `table` ordered by `key_column`,
+    starting after the key value `after`. Each batch is its own short read,
+    so no connection or snapshot is held between batches.
+    """
+    if key_column not in columns:
+        columns = (key_column, *columns)
+    conditions = [f"({where})"] if where else []
+    query_params = list(params)
+    if after is not None:
+        conditions.append(f"{key_column} > ?")
+        query_params.append(after)
+    where_clause = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+    with _connect() as conn:
+        cursor = conn.cursor()
+        cursor.execute(
+            f"SELECT {', '.join(columns)} FROM {table} {where_clause} ORDER BY {key_column} LIMIT ?",
+            (*query_params, batch_size)
+        )
+        return [dict(row) for row in cursor.fetchmany(batch_size)]
+
+def iter_batches(table: str, key_column: str, columns: tuple[str, ...], batch_size: int, where: str | None, params: tuple):
+    """Yields `table` a batch at a time; each step runs one fetch_batch."""
+    after = None
+    while True:
+        try:
+            batch = fetch_batch(table, key_column, columns, after, batch_size, where, params)
+        except sqlite3.Error as e:
+            logging.error(f"Failed to iterate over {table}: {e}")
+            return
+        if batch:
+            yield batch
+        if len(batch) < batch_size:
+            return
+        after = batch[-1][key_column]
+
+def _iter_table(table: str, key_column: str, columns: tuple[str, ...], batch_size: int, where: str | None, params: tuple):
+    for batch in iter_batches(table, key_column, columns, batch_size, where, params):
+        yield from batch
+
+USER_ITER_COLUMNS = ("telegram_id", "username", "is_banned")
+KEY_ITER_COLUMNS = ("key_id", "user_id", "host_name", "key_email", "expiry_ms")
+# iter_keys conditions used by the scheduler (params: window start and end /
+# host name and stale cutoff).
+KEYS_EXPIRING_BETWEEN = "expiry_ms > ? AND expiry_ms <= ?"
+HOST_KEYS_EXPIRED_BEFORE = "host_name = ? AND expiry_ms < ?"
+HOST_KEYS_EXPIRING_AFTER = "host_name = ? AND expiry_ms >= ?"
+
+def iter_users(batch_size: int = ITER_BATCH_SIZE, where: str | None = None, params: tuple = (), columns: tuple[str, ...] = USER_ITER_COLUMNS):
+    """Streams users in telegram_id order; `where` is an SQL condition on users."""
+    return _iter_table("users", "telegram_id", columns, batch_size, where, params)
+
+def iter_keys(batch_size: int = ITER_BATCH_SIZE, where: str | None = None, params: tuple = (), columns: tuple[str, ...] = KEY_ITER_COLUMNS):
+    """Streams keys in key_id order; `where` is an SQL condition on vpn_keys."""
+    return _iter_table("vpn_keys", "key_id", columns, batch_size, where, params)
+
+def _read_data_version() -> int:
+    """
+    PRAGMA data_version changes whenever another connection (in this or any
+    other process) commits to the database. It is only comparable between
+    calls on the same connection, hence the dedicated monitor connection.
+    """
+    global _data_version_conn
+    if _data_version_conn is None or _data_version_conn[0] != DB_FILE:
+        if _data_version_conn is not None:
+            _data_version_conn[1].close()
+        _data_version_conn = (DB_FILE, sqlite3.connect(DB_FILE, check_same_thread=False))
+    return _data_version_conn[1].execute("PRAGMA data_version").fetchone()[0]
+
+def _load_settings_snapshot() -> dict:
+    global _settings_cache, _settings_data_version, _settings_checked_at
+    data_version = _read_data_version()
+    with _connect() as conn:
+        rows = conn.execute("SELECT key, value FROM bot_settings").fetchall()
+    _settings_cache = {row['key']: row['value'] for row in rows}
+    _settings_data_version = data_version
+    _settings_checked_at = time.monotonic()
+    return _settings_cache
+
+def _get_settings_snapshot() -> dict:
+    global _settings_checked_at
+    with _settings_lock:
+        if _settings_cache is not None:
+            if time.monotonic() - _settings_checked_at < SETTINGS_RECHECK_SECONDS:
+                return _settings_cache
+            if _read_data_version() == _settings_data_version:
+                _settings_checked_at = time.monotonic()
+                return _settings_cache
+        return _load_settings_snapshot()
+
+def invalidate_settings_cache():
+    global _settings_cache
+    with _settings_lock:
+        _settings_cache = None
+
 def get_setting(key: str) -> str | None:
     try:
-        with sqlite3.connect(DB_FILE) as conn:
-            cursor = conn.cursor()
-            cursor.execute("SELECT value FROM bot_settings WHERE key = ?", (key,))
-            result = cursor.fetchone()
-            return result[0] if result else None
+        return _get_settings_snapshot().get(key)
     except sqlite3.Error as e:
         logging.error(f"Failed to get setting '{key}': {e}")
         return None
         
 def get_all_settings() -> dict:
-    settings = {}
     try:
-        with sqlite3.connect(DB_FILE) as conn:
-            conn.row_factory = sqlite3.Row
-            cursor = conn.cursor()
-            cursor.execute("SELECT key, value FROM bot_settings")
-            rows = cursor.fetchall()
-            for row in rows:
-                settings[row['key']] = row['value']
+        return dict(_get_settings_snapshot())
     except sqlite3.Error as e:
         logging.error(f"Failed to get all settings: {e}")
-    return settings
+        return {}
 
 def update_setting(key: str, value: str):
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _connect() as conn:
             cursor = conn.cursor()
             cursor.execute("INSERT OR REPLACE INTO bot_settings (key, value) VALUES (?, ?)", (key, value))
             conn.commit()
             logging.info(f"Setting '{key}' updated.")
     except sqlite3.Error as e:
         logging.error(f"Failed to update setting '{key}': {e}")
+    finally:
+        invalidate_settings_cache()
 
 def create_plan(host_name: str, plan_name: str, months: int, price: float):
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _connect() as conn:
             cursor = conn.cursor()
             cursor.execute(
                 "INSERT INTO plans (host_name, plan_name, months, price) VALUES (?, ?, ?, ?)",
@@ -314,62 +896,77 @@ def create_plan(host_name: str, plan_name: str, months: int, price: float):
             logging.info(f"Created new plan '{plan_name}' for host '{host_name}'.")
     except sqlite3.Error as e:
         logging.error(f"Failed to create plan for host '{host_name}': {e}")
+    finally:
+        reload_catalog()
 
 def get_plans_for_host(host_name: str) -> list[dict]:
-    try:
-        with sqlite3.connect(DB_FILE) as conn:
-            conn.row_factory = sqlite3.Row
-            cursor = conn.cursor()
-            cursor.execute("SELECT * FROM plans WHERE host_name = ? ORDER BY months", (host_name,))
-            plans = cursor.fetchall()
-            return [dict(plan) for plan in plans]
-    except sqlite3.Error as e:
-        logging.error(f"Failed to get plans for host '{host_name}': {e}")
-        return []
+    catalog = _get_catalog()
+    return [dict(plan) for plan in catalog['plans_by_host'].get(host_name, ())] if catalog else []
 
 def get_plan_by_id(plan_id: int) -> dict | None:
-    try:
-        with sqlite3.connect(DB_FILE) as conn:
-            conn.row_factory = sqlite3.Row
-            cursor = conn.cursor()
-            cursor.execute("SELECT * FROM plans WHERE plan_id = ?", (plan_id,))
-            plan = cursor.fetchone()
-            return dict(plan) if plan else None
-    except sqlite3.Error as e:
-        logging.error(f"Failed to get plan by id '{plan_id}': {e}")
-        return None
+    catalog = _get_catalog()
+    plan = catalog['plans_by_id'].get(_as_plan_id(plan_id)) if catalog else None
+    return dict(plan) if plan else None
 
 def delete_plan(plan_id: int):
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _connect() as conn:
             cursor = conn.cursor()
             cursor.execute("DELETE FROM plans WHERE plan_id = ?", (plan_id,))
             conn.commit()
             logging.info(f"Deleted plan with id {plan_id}.")
     except sqlite3.Error as e:
         logging.error(f"Failed to delete plan with id {plan_id}: {e}")
+    finally:
+        reload_catalog()
 
-def register_user_if_not_exists(telegram_id: int, username: str, referrer_id):
+def register_user_if_not_exists(telegram_id: int, username: str, referrer_id) -> tuple[dict | None, bool]:
+    """
+    Insert the user or refresh their username and return (user, is_new).
+    A repeat /start with an unchanged username writes nothing; when username
+    refreshes are "sync" they go through the same conditional upsert.
+    """
+    registered_at = datetime.now()
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _connect() as conn:
             cursor = conn.cursor()
-            cursor.execute("SELECT telegram_id FROM users WHERE telegram_id = ?", (telegram_id,))
-            if not cursor.fetchone():
-                cursor.execute(
-                    "INSERT INTO users (telegram_id, username, registration_date, referred_by) VALUES (?, ?, ?, ?)",
-                    (telegram_id, username, datetime.now(), referrer_id)
-                )
-            else:
-                cursor.execute("UPDATE users SET username = ? WHERE telegram_id = ?", (username, telegram_id))
+            if WRITE_DURABILITY.get('username') == 'deferred':
+                # Known users only need a username refresh, which can wait.
+                cursor.execute("SELECT * FROM users WHERE telegram_id = ?", (telegram_id,))
+                row = cursor.fetchone()
+                if row is not None:
+                    user = dict(row)
+                    if user['username'] != username:
+                        _write('username', "UPDATE users SET username = ? WHERE telegram_id = ?", (username, telegram_id))
+                        user['username'] = username
+                    return user, False
+            cursor.execute(
+                """
+                INSERT INTO users (telegram_id, username, registration_date, referred_by)
+                VALUES (:telegram_id, :username, :registered_at, :referrer_id)
+                ON CONFLICT (telegram_id) DO UPDATE SET username = excluded.username
+                WHERE username IS NOT excluded.username
+                RETURNING *, registration_date IS :registered_at AS is_new
+                """,
+                {'telegram_id': telegram_id, 'username': username, 'registered_at': registered_at, 'referrer_id': referrer_id}
+            )
+            row = cursor.fetchone()
             conn.commit()
+            if row is None:
+                cursor.execute("SELECT * FROM users WHERE telegram_id = ?", (telegram_id,))
+                user = cursor.fetchone()
+                return (dict(user) if user else None), False
+            user = dict(row)
+            return user, bool(user.pop('is_new'))
     except sqlite3.Error as e:
         logging.error(f"Failed to register user {telegram_id}: {e}")
+        return None, False
 
 # Removed referral balance functions as they are no longer needed
 
 def get_referral_count(user_id: int) -> int:
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _connect() as conn:
             cursor = conn.cursor()
             cursor.execute("SELECT COUNT(*) FROM users WHERE referred_by = ?", (user_id,))
             return cursor.fetchone()[0] or 0
@@ -379,8 +976,7 @@ def get_referral_count(user_id: int) -> int:
 
 def get_user(telegram_id: int):
     try:
-        with sqlite3.connect(DB_FILE) as conn:
-            conn.row_factory = sqlite3.Row
+        with _connect() as conn:
             cursor = conn.cursor()
             cursor.execute("SELECT * FROM users WHERE telegram_id = ?", (telegram_id,))
             user_data = cursor.fetchone()
@@ -394,60 +990,45 @@ def get_user_by_id(telegram_id: int):
 
 def set_terms_agreed(telegram_id: int):
     try:
-        with sqlite3.connect(DB_FILE) as conn:
-            cursor = conn.cursor()
-            cursor.execute("UPDATE users SET agreed_to_terms = 1 WHERE telegram_id = ?", (telegram_id,))
-            conn.commit()
-            logging.info(f"User {telegram_id} has agreed to terms.")
+        _write('terms', "UPDATE users SET agreed_to_terms = 1 WHERE telegram_id = ?", (telegram_id,))
+        logging.info(f"User {telegram_id} has agreed to terms.")
     except sqlite3.Error as e:
         logging.error(f"Failed to set terms agreed for user {telegram_id}: {e}")
 
 def update_user_stats(telegram_id: int, amount_spent: float, months_purchased: int):
     try:
-        with sqlite3.connect(DB_FILE) as conn:
-            cursor = conn.cursor()
-            cursor.execute("UPDATE users SET total_spent = total_spent + ?, total_months = total_months + ? WHERE telegram_id = ?", (amount_spent, months_purchased, telegram_id))
-            conn.commit()
+        _write(
+            'user_stats',
+            "UPDATE users SET total_spent = total_spent + ?, total_months = total_months + ? WHERE telegram_id = ?",
+            (amount_spent, months_purchased, telegram_id)
+        )
     except sqlite3.Error as e:
         logging.error(f"Failed to update user stats for {telegram_id}: {e}")
 
 def get_user_count() -> int:
-    try:
-        with sqlite3.connect(DB_FILE) as conn:
-            cursor = conn.cursor()
-            cursor.execute("SELECT COUNT(*) FROM users")
-            return cursor.fetchone()[0] or 0
-    except sqlite3.Error as e:
-        logging.error(f"Failed to get user count: {e}")
-        return 0
+    return int(get_counter('users'))
 
 def get_total_keys_count() -> int:
-    try:
-        with sqlite3.connect(DB_FILE) as conn:
-            cursor = conn.cursor()
-            cursor.execute("SELECT COUNT(*) FROM vpn_keys")
-            return cursor.fetchone()[0] or 0
-    except sqlite3.Error as e:
-        logging.error(f"Failed to get total keys count: {e}")
-        return 0
+    return int(get_counter('vpn_keys'))
 
 def get_total_spent_sum() -> float:
+    return float(get_counter('total_spent'))
+
+def _as_plan_id(value) -> int | None:
     try:
-        with sqlite3.connect(DB_FILE) as conn:
-            cursor = conn.cursor()
-            cursor.execute("SELECT SUM(total_spent) FROM users")
-            return cursor.fetchone()[0] or 0.0
-    except sqlite3.Error as e:
-        logging.error(f"Failed to get total spent sum: {e}")
-        return 0.0
+        return int(value) if value is not None else None
+    except (TypeError, ValueError):
+        return None
 
 def create_pending_transaction(payment_id: str, user_id: int, amount_rub: float, metadata: dict) -> int:
+    plan_id = _as_plan_id(metadata.get('plan_id'))
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _connect() as conn:
             cursor = conn.cursor()
             cursor.execute(
-                "INSERT INTO transactions (payment_id, user_id, status, amount_rub, metadata) VALUES (?, ?, ?, ?)",
-                (payment_id, user_id, 'pending', amount_rub, json.dumps(metadata))
+                """INSERT INTO transactions (payment_id, user_id, status, amount_rub, metadata, host_name, plan_id, plan_name)
+                   VALUES (?, ?, ?, ?, ?, ?, ?, (SELECT plan_name FROM plans WHERE plan_id = ?))""",
+                (payment_id, user_id, 'pending', amount_rub, json.dumps(metadata), metadata.get('host_name'), plan_id, plan_id)
             )
             conn.commit()
             return cursor.lastrowid
@@ -457,8 +1038,7 @@ def create_pending_transaction(payment_id: str, user_id: int, amount_rub: float,
 
 def find_and_complete_ton_transaction(payment_id: str, amount_ton: float) -> dict | None:
     try:
-        with sqlite3.connect(DB_FILE) as conn:
-            conn.row_factory = sqlite3.Row
+        with _connect() as conn:
             cursor = conn.cursor()
             
             cursor.execute("SELECT * FROM transactions WHERE payment_id = ? AND status = 'pending'", (payment_id,))
@@ -479,61 +1059,157 @@ def find_and_complete_ton_transaction(payment_id: str, amount_ton: float) -> dic
         logging.error(f"Failed to complete TON transaction {payment_id}: {e}")
         return None
 
-def log_transaction(username: str, transaction_id: str | None, payment_id: str | None, user_id: int, status: str, amount_rub: float, amount_currency: float | None, currency_name: str | None, payment_method: str, metadata: str):
+def log_transaction(username: str, transaction_id: str | None, payment_id: str | None, user_id: int, status: str, amount_rub: float, amount_currency: float | None, currency_name: str | None, payment_method: str, metadata: str, host_name: str | None = None, plan_name: str | None = None, plan_id: int | None = None):
+    try:
+        _write(
+            'transaction_log',
+            """INSERT INTO transactions
+               (username, transaction_id, payment_id, user_id, status, amount_rub, amount_currency, currency_name, payment_method, metadata, host_name, plan_name, plan_id, created_date)
+               VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+            (username, transaction_id, payment_id, user_id, status, amount_rub, amount_currency, currency_name, payment_method, metadata, host_name, plan_name, _as_plan_id(plan_id), datetime.now())
+        )
+    except sqlite3.Error as e:
+        logging.error(f"Failed to log transaction for user {user_id}: {e}")
+
+def get_counter(name: str) -> float:
+    try:
+        with _connect() as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT value FROM stats_counters WHERE name = ?", (name,))
+            result = cursor.fetchone()
+            return result[0] if result else 0
+    except sqlite3.Error as e:
+        logging.error(f"Failed to get counter '{name}': {e}")
+        return 0
+
+def get_revenue_by_host(days: int | None = None) -> list[dict]:
+    date_filter = "AND created_date >= date('now', ?)" if days else ""
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _connect() as conn:
             cursor = conn.cursor()
             cursor.execute(
-                """INSERT INTO transactions
-                   (username, transaction_id, payment_id, user_id, status, amount_rub, amount_currency, currency_name, payment_method, metadata, created_date)
-                   VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
-                (username, transaction_id, payment_id, user_id, status, amount_rub, amount_currency, currency_name, payment_method, metadata, datetime.now())
+                f"""
+                SELECT host_name, COUNT(*) AS payments, SUM(amount_rub) AS revenue
+                FROM transactions
+                WHERE {COUNTED_PAYMENT} {date_filter}
+                GROUP BY host_name
+                ORDER BY revenue DESC
+                """,
+                (f'-{days} days',) if days else ()
             )
+            return [dict(row) for row in cursor.fetchall()]
+    except sqlite3.Error as e:
+        logging.error(f"Failed to get revenue by host: {e}")
+        return []
+
+def get_revenue_by_plan(days: int | None = None) -> list[dict]:
+    date_filter = "AND t.created_date >= date('now', ?)" if days else ""
+    try:
+        with _connect() as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                f"""
+                SELECT r.plan_id,
+                       COALESCE(p.plan_name, (
+                           SELECT plan_name FROM transactions
+                           WHERE plan_id = r.plan_id AND status = 'paid' AND plan_name IS NOT NULL LIMIT 1
+                       )) AS plan_name,
+                       p.host_name, r.payments, r.revenue
+                FROM (
+                    SELECT t.plan_id, COUNT(*) AS payments, SUM(t.amount_rub) AS revenue
+                    FROM transactions t
+                    WHERE {COUNTED_PAYMENT} {date_filter}
+                    GROUP BY t.plan_id
+                ) r
+                LEFT JOIN plans p ON p.plan_id = r.plan_id
+                ORDER BY r.revenue DESC
+                """,
+                (f'-{days} days',) if days else ()
+            )
+            return [dict(row) for row in cursor.fetchall()]
+    except sqlite3.Error as e:
+        logging.error(f"Failed to get revenue by plan: {e}")
+        return []
+
+def get_stats_counters() -> dict:
+    try:
+        with _connect() as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT name, value FROM stats_counters")
+            return {row['name']: row['value'] for row in cursor.fetchall()}
+    except sqlite3.Error as e:
+        logging.error(f"Failed to get stats counters: {e}")
+        return {}
+
+def recompute_stats_counters() -> bool:
+    try:
+        with _connect() as conn:
+            cursor = conn.cursor()
+            cursor.execute("BEGIN IMMEDIATE")
+            for name, query in STATS_COUNTER_QUERIES.items():
+                cursor.execute(
+                    f"INSERT OR REPLACE INTO stats_counters (name, value) SELECT ?, ({query})",
+                    (name,)
+                )
             conn.commit()
+            logging.info("Stats counters have been recomputed.")
+            return True
     except sqlite3.Error as e:
-        logging.error(f"Failed to log transaction for user {user_id}: {e}")
+        logging.error(f"Failed to recompute stats counters: {e}")
+        return False
+
+def get_transactions_page(per_page: int = 15, before_id: int | None = None, after_id: int | None = None) -> tuple[list[dict], int, bool, bool]:
+    """
+    Keyset pagination over (created_date, transaction_id), newest first.
 
-def get_paginated_transactions(page: int = 1, per_page: int = 15) -> tuple[list[dict], int]:
-    offset = (page - 1) * per_page
+    `before_id` returns the page of transactions older than that transaction,
+    `after_id` the page newer than it. Returns the rows, the total number of
+    transactions and whether newer and older pages exist.
+    """
     transactions = []
-    total = 0
+    has_newer = has_older = False
+    total = int(get_counter('transactions'))
+    columns = "transaction_id, username, user_id, status, amount_rub, payment_method, host_name, plan_name, created_date"
     try:
-        with sqlite3.connect(DB_FILE) as conn:
-            conn.row_factory = sqlite3.Row
+        with _connect() as conn:
             cursor = conn.cursor()
-            
-            cursor.execute("SELECT COUNT(*) FROM transactions")
-            total = cursor.fetchone()[0]
-
-            query = "SELECT * FROM transactions ORDER BY created_date DESC LIMIT ? OFFSET ?"
-            cursor.execute(query, (per_page, offset))
-            
-            for row in cursor.fetchall():
-                transaction_dict = dict(row)
-                
-                metadata_str = transaction_dict.get('metadata')
-                if metadata_str:
-                    try:
-                        metadata = json.loads(metadata_str)
-                        transaction_dict['host_name'] = metadata.get('host_name', 'N/A')
-                        transaction_dict['plan_name'] = metadata.get('plan_name', 'N/A')
-                    except json.JSONDecodeError:
-                        transaction_dict['host_name'] = 'Error'
-                        transaction_dict['plan_name'] = 'Error'
+            if after_id is not None:
+                cursor.execute(
+                    f"""SELECT {columns} FROM transactions
+                        WHERE (created_date, transaction_id) > (SELECT created_date, transaction_id FROM transactions WHERE transaction_id = ?)
+                        ORDER BY created_date ASC, transaction_id ASC LIMIT ?""",
+                    (after_id, per_page + 1)
+                )
+                rows = cursor.fetchall()
+                has_newer = len(rows) > per_page
+                has_older = True
+                rows = list(reversed(rows[:per_page]))
+            else:
+                if before_id is not None:
+                    cursor.execute(
+                        f"""SELECT {columns} FROM transactions
+                            WHERE (created_date, transaction_id) < (SELECT created_date, transaction_id FROM transactions WHERE transaction_id = ?)
+                            ORDER BY created_date DESC, transaction_id DESC LIMIT ?""",
+                        (before_id, per_page + 1)
+                    )
+                    has_newer = True
                 else:
-                    transaction_dict['host_name'] = 'N/A'
-                    transaction_dict['plan_name'] = 'N/A'
-                
-                transactions.append(transaction_dict)
-            
+                    cursor.execute(
+                        f"SELECT {columns} FROM transactions ORDER BY created_date DESC, transaction_id DESC LIMIT ?",
+                        (per_page + 1,)
+                    )
+                rows = cursor.fetchall()
+                has_older = len(rows) > per_page
+                rows = rows[:per_page]
+            transactions = [dict(row) for row in rows]
     except sqlite3.Error as e:
-        logging.error(f"Failed to get paginated transactions: {e}")
-    
-    return transactions, total
+        logging.error(f"Failed to get transactions page: {e}")
+
+    return transactions, total, has_newer, has_older
 
 def set_trial_used(telegram_id: int):
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _connect() as conn:
             cursor = conn.cursor()
             cursor.execute("UPDATE users SET trial_used = 1 WHERE telegram_id = ?", (telegram_id,))
             conn.commit()
@@ -541,21 +1217,46 @@ def set_trial_used(telegram_id: int):
     except sqlite3.Error as e:
         logging.error(f"Failed to set trial used for user {telegram_id}: {e}")
 
-def add_new_key(user_id: int, email: str, xui_client_uuid: str, host_name: str, days: int, key_email: str | None = None, expiry_timestamp_ms: int | None = None, key_name: str | None = None):
+def _allocate_key_number(cursor: sqlite3.Cursor, user_id: int) -> int | None:
+    cursor.execute("UPDATE users SET key_seq = key_seq + 1 WHERE telegram_id = ? RETURNING key_seq", (user_id,))
+    result = cursor.fetchone()
+    return result[0] if result else None
+
+def reserve_key_number(user_id: int) -> int | None:
+    """
+    Atomically hands out the user's next key number. Numbers are never
+    reused, so concurrent purchases cannot collide on the key email.
+    """
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _connect() as conn:
             cursor = conn.cursor()
+            key_number = _allocate_key_number(cursor, user_id)
+            conn.commit()
+            return key_number
+    except sqlite3.Error as e:
+        logging.error(f"Failed to reserve key number for user {user_id}: {e}")
+        return None
+
+def add_new_key(user_id: int, email: str, xui_client_uuid: str, host_name: str, days: int, key_email: str | None = None, expiry_timestamp_ms: int | None = None, key_name: str | None = None, key_number: int | None = None):
+    try:
+        with _connect() as conn:
+            cursor = conn.cursor()
+            # Callers that had to build the key email first pass the number they
+            # reserved; otherwise it is allocated in this transaction.
+            if key_number is None:
+                key_number = _allocate_key_number(cursor, user_id)
             # Use expiry_timestamp_ms if provided, otherwise calculate from days
             if expiry_timestamp_ms is not None:
                 expiry_date = datetime.fromtimestamp(expiry_timestamp_ms / 1000)
             else:
                 expiry_date = datetime.now() + timedelta(days=days)
+                expiry_timestamp_ms = int(expiry_date.timestamp() * 1000)
             # Use key_email if provided, otherwise fall back to email parameter
             # Since key_email field in DB is NOT NULL, we must ensure a value is always provided
             actual_email = key_email if key_email is not None else email
             cursor.execute(
-                "INSERT INTO vpn_keys (user_id, host_name, xui_client_uuid, key_email, expiry_date, key_name) VALUES (?, ?, ?, ?, ?, ?)",
-                (user_id, host_name, xui_client_uuid, actual_email, expiry_date, key_name)
+                "INSERT INTO vpn_keys (user_id, host_name, xui_client_uuid, key_email, expiry_date, expiry_ms, key_name, key_number) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (user_id, host_name, xui_client_uuid, actual_email, expiry_date, expiry_timestamp_ms, key_name, key_number)
             )
             new_key_id = cursor.lastrowid
             conn.commit()
@@ -566,12 +1267,12 @@ def add_new_key(user_id: int, email: str, xui_client_uuid: str, host_name: str,
 
 def add_new_key_original(user_id: int, host_name: str, xui_client_uuid: str, key_email: str, expiry_timestamp_ms: int):
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _connect() as conn:
             cursor = conn.cursor()
             expiry_date = datetime.fromtimestamp(expiry_timestamp_ms / 1000)
             cursor.execute(
-                "INSERT INTO vpn_keys (user_id, host_name, xui_client_uuid, key_email, expiry_date) VALUES (?, ?, ?, ?, ?)",
-                (user_id, host_name, xui_client_uuid, key_email, expiry_date)
+                "INSERT INTO vpn_keys (user_id, host_name, xui_client_uuid, key_email, expiry_date, expiry_ms) VALUES (?, ?, ?, ?, ?, ?)",
+                (user_id, host_name, xui_client_uuid, key_email, expiry_date, expiry_timestamp_ms)
             )
             new_key_id = cursor.lastrowid
             conn.commit()
@@ -582,7 +1283,7 @@ def add_new_key_original(user_id: int, host_name: str, xui_client_uuid: str, key
 
 def delete_key_by_email(email: str):
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _connect() as conn:
             cursor = conn.cursor()
             cursor.execute("DELETE FROM vpn_keys WHERE key_email = ?", (email,))
             conn.commit()
@@ -591,10 +1292,9 @@ def delete_key_by_email(email: str):
 
 def get_user_keys(user_id: int):
     try:
-        with sqlite3.connect(DB_FILE) as conn:
-            conn.row_factory = sqlite3.Row
+        with _connect() as conn:
             cursor = conn.cursor()
-            cursor.execute("SELECT key_id, user_id, host_name, xui_client_uuid, key_email, expiry_date, created_date, key_name FROM vpn_keys WHERE user_id = ? ORDER BY key_id", (user_id,))
+            cursor.execute("SELECT key_id, user_id, host_name, xui_client_uuid, key_email, expiry_date, expiry_ms, created_date, key_name, key_number FROM vpn_keys WHERE user_id = ? ORDER BY key_id", (user_id,))
             keys = cursor.fetchall()
             return [dict(key) for key in keys]
     except sqlite3.Error as e:
@@ -603,7 +1303,7 @@ def get_user_keys(user_id: int):
 
 def delete_key_by_id(key_id: int):
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _connect() as conn:
             cursor = conn.cursor()
             cursor.execute("DELETE FROM vpn_keys WHERE key_id = ?", (key_id,))
             conn.commit()
@@ -613,8 +1313,7 @@ def delete_key_by_id(key_id: int):
 
 def get_key_by_id(key_id: int):
     try:
-        with sqlite3.connect(DB_FILE) as conn:
-            conn.row_factory = sqlite3.Row
+        with _connect() as conn:
             cursor = conn.cursor()
             cursor.execute("SELECT * FROM vpn_keys WHERE key_id = ?", (key_id,))
             key_data = cursor.fetchone()
@@ -625,8 +1324,7 @@ def get_key_by_id(key_id: int):
 
 def get_key_by_email(key_email: str):
     try:
-        with sqlite3.connect(DB_FILE) as conn:
-            conn.row_factory = sqlite3.Row
+        with _connect() as conn:
             cursor = conn.cursor()
             cursor.execute("SELECT * FROM vpn_keys WHERE key_email = ?", (key_email,))
             key_data = cursor.fetchone()
@@ -638,25 +1336,20 @@ def get_key_by_email(key_email: str):
 def update_key_info(key_id: int, new_xui_uuid: str, new_expiry_ms: int):
     try:
         logging.info(f"update_key_info called with key_id={key_id}, new_xui_uuid={new_xui_uuid}, new_expiry_ms={new_expiry_ms}")
-        with sqlite3.connect(DB_FILE) as conn:
+        with _connect() as conn:
             cursor = conn.cursor()
             expiry_date = datetime.fromtimestamp(new_expiry_ms / 1000)
             logging.info(f"Calculated expiry_date: {expiry_date}")
             logging.info("Executing UPDATE statement...")
-            cursor.execute("UPDATE vpn_keys SET xui_client_uuid = ?, expiry_date = ?, key_name = 'BONUS_APPLIED_TEST' WHERE key_id = ?", (new_xui_uuid, expiry_date, key_id))
+            cursor.execute("UPDATE vpn_keys SET xui_client_uuid = ?, expiry_date = ?, expiry_ms = ?, key_name = 'BONUS_APPLIED_TEST' WHERE key_id = ?", (new_xui_uuid, expiry_date, new_expiry_ms, key_id))
             conn.commit()
             logging.info("Commit successful.")
     except sqlite3.Error as e:
         logging.error(f"Failed to update key {key_id}: {e}")
 
-def get_next_key_number(user_id: int) -> int:
-    keys = get_user_keys(user_id)
-    return len(keys) + 1
-
 def get_keys_for_host(host_name: str) -> list[dict]:
     try:
-        with sqlite3.connect(DB_FILE) as conn:
-            conn.row_factory = sqlite3.Row
+        with _connect() as conn:
             cursor = conn.cursor()
             cursor.execute("SELECT * FROM vpn_keys WHERE host_name = ?", (host_name,))
             keys = cursor.fetchall()
@@ -667,8 +1360,7 @@ def get_keys_for_host(host_name: str) -> list[dict]:
 
 def get_all_vpn_users():
     try:
-        with sqlite3.connect(DB_FILE) as conn:
-            conn.row_factory = sqlite3.Row
+        with _connect() as conn:
             cursor = conn.cursor()
             cursor.execute("SELECT DISTINCT user_id FROM vpn_keys")
             users = cursor.fetchall()
@@ -679,43 +1371,35 @@ def get_all_vpn_users():
 
 def update_key_status_from_server(key_email: str, xui_client_data):
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _connect() as conn:
             cursor = conn.cursor()
             if xui_client_data:
                 expiry_date = datetime.fromtimestamp(xui_client_data.expiry_time / 1000)
-                cursor.execute("UPDATE vpn_keys SET xui_client_uuid = ?, expiry_date = ? WHERE key_email = ?", (xui_client_data.id, expiry_date, key_email))
+                cursor.execute("UPDATE vpn_keys SET xui_client_uuid = ?, expiry_date = ?, expiry_ms = ? WHERE key_email = ?", (xui_client_data.id, expiry_date, xui_client_data.expiry_time, key_email))
             else:
                 cursor.execute("DELETE FROM vpn_keys WHERE key_email = ?", (key_email,))
             conn.commit()
     except sqlite3.Error as e:
         logging.error(f"Failed to update key status for {key_email}: {e}")
 
+CHART_RANGES = (7, 30, 90, 365)
+
 def get_daily_stats_for_charts(days: int = 30) -> dict:
-    stats = {'users': {}, 'keys': {}}
+    stats = {'users': {}, 'keys': {}, 'revenue': {}}
+    metrics = {'registrations': 'users', 'keys': 'keys', 'revenue': 'revenue'}
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _connect() as conn:
             cursor = conn.cursor()
-            query_users = """
-                SELECT date(registration_date) as day, COUNT(*)
-                FROM users
-                WHERE registration_date >= date('now', ?)
-                GROUP BY day
-                ORDER BY day;
-            """
-            cursor.execute(query_users, (f'-{days} days',))
-            for row in cursor.fetchall():
-                stats['users'][row[0]] = row[1]
-            
-            query_keys = """
-                SELECT date(created_date) as day, COUNT(*)
-                FROM vpn_keys
-                WHERE created_date >= date('now', ?)
-                GROUP BY day
-                ORDER BY day;
-            """
-            cursor.execute(query_keys, (f'-{days} days',))
+            cursor.execute(
+                """
+                SELECT metric, day, value FROM daily_stats
+                WHERE metric IN ('registrations', 'keys', 'revenue') AND day >= date('now', ?)
+                ORDER BY metric, day
+                """,
+                (f'-{days} days',)
+            )
             for row in cursor.fetchall():
-                stats['keys'][row[0]] = row[1]
+                stats[metrics[row['metric']]][row['day']] = row['value']
     except sqlite3.Error as e:
         logging.error(f"Failed to get daily stats for charts: {e}")
     return stats
@@ -724,8 +1408,7 @@ def get_daily_stats_for_charts(days: int = 30) -> dict:
 def get_recent_transactions(limit: int = 15) -> list[dict]:
     transactions = []
     try:
-        with sqlite3.connect(DB_FILE) as conn:
-            conn.row_factory = sqlite3.Row
+        with _connect() as conn:
             cursor = conn.cursor()
             query = """
                 SELECT
@@ -747,7 +1430,7 @@ def get_recent_transactions(limit: int = 15) -> list[dict]:
 
 def add_support_thread(user_id: int, thread_id: int):
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _connect() as conn:
             cursor = conn.cursor()
             cursor.execute("INSERT OR REPLACE INTO support_threads (user_id, thread_id) VALUES (?, ?)", (user_id, thread_id))
             conn.commit()
@@ -756,7 +1439,7 @@ def add_support_thread(user_id: int, thread_id: int):
 
 def get_support_thread_id(user_id: int) -> int | None:
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _connect() as conn:
             cursor = conn.cursor()
             cursor.execute("SELECT thread_id FROM support_threads WHERE user_id = ?", (user_id,))
             result = cursor.fetchone()
@@ -767,7 +1450,7 @@ def get_support_thread_id(user_id: int) -> int | None:
 
 def get_user_id_by_thread(thread_id: int) -> int | None:
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _connect() as conn:
             cursor = conn.cursor()
             cursor.execute("SELECT user_id FROM support_threads WHERE thread_id = ?", (thread_id,))
             result = cursor.fetchone()
@@ -778,8 +1461,7 @@ def get_user_id_by_thread(thread_id: int) -> int | None:
 
 def get_latest_transaction(user_id: int) -> dict | None:
     try:
-        with sqlite3.connect(DB_FILE) as conn:
-            conn.row_factory = sqlite3.Row
+        with _connect() as conn:
             cursor = conn.cursor()
             cursor.execute("SELECT * FROM transactions WHERE user_id = ? ORDER BY created_date DESC LIMIT 1", (user_id,))
             transaction = cursor.fetchone()
@@ -790,8 +1472,7 @@ def get_latest_transaction(user_id: int) -> dict | None:
 
 def get_all_users() -> list[dict]:
     try:
-        with sqlite3.connect(DB_FILE) as conn:
-            conn.row_factory = sqlite3.Row
+        with _connect() as conn:
             cursor = conn.cursor()
             cursor.execute("SELECT * FROM users ORDER BY registration_date DESC")
             return [dict(row) for row in cursor.fetchall()]
@@ -799,27 +1480,200 @@ def get_all_users() -> list[dict]:
         logging.error(f"Failed to get all users: {e}")
         return []
 
+USERS_PAGE_SORTS = {
+    'registered': 'registration_date',
+    'id': 'telegram_id',
+    'username': 'username',
+    'spent': 'total_spent',
+}
+
+def get_users_page(
+    page: int = 1,
+    per_page: int = 50,
+    sort: str = 'registered',
+    descending: bool = True,
+    banned: bool | None = None,
+    has_active_key: bool | None = None,
+    host_name: str | None = None,
+    registered_since: str | None = None,
+) -> tuple[list[dict], int]:
+    """
+    Returns one page of users with their key summary (key_count,
+    nearest_expiry of an active key, comma-separated hosts) and the number
+    of users matching the filters.
+    """
+    conditions = []
+    params = []
+    now_ms = int(time.time() * 1000)
+    if banned is not None:
+        conditions.append("u.is_banned = ?")
+        params.append(1 if banned else 0)
+    if has_active_key is not None:
+        conditions.append(
+            f"{'' if has_active_key else 'NOT '}EXISTS (SELECT 1 FROM vpn_keys k WHERE k.user_id = u.telegram_id AND k.expiry_ms > ?)"
+        )
+        params.append(now_ms)
+    if host_name:
+        conditions.append("u.telegram_id IN (SELECT user_id FROM vpn_keys WHERE host_name = ?)")
+        params.append(host_name)
+    if registered_since:
+        conditions.append("u.registration_date >= ?")
+        params.append(registered_since)
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+
+    sort_column = USERS_PAGE_SORTS.get(sort, USERS_PAGE_SORTS['registered'])
+    direction = "DESC" if descending else "ASC"
+    order_by = f"ORDER BY {sort_column} {direction}, telegram_id {direction}"
+    page = max(page, 1)
+
+    try:
+        with _connect() as conn:
+            cursor = conn.cursor()
+            if conditions:
+                cursor.execute(f"SELECT COUNT(*) FROM users u {where}", params)
+                total = cursor.fetchone()[0]
+            else:
+                cursor.execute("SELECT value FROM stats_counters WHERE name = 'users'")
+                result = cursor.fetchone()
+                total = int(result[0]) if result else 0
+
+            # Page through users first, then aggregate keys only for that page.
+            cursor.execute(
+                f"""
+                WITH page AS (
+                    SELECT u.telegram_id, u.username, u.is_banned, u.registration_date, u.total_spent
+                    FROM users u {where}
+                    {order_by}
+                    LIMIT ? OFFSET ?
+                )
+                SELECT
+                    page.*,
+                    COUNT(k.key_id) AS key_count,
+                    MIN(CASE WHEN k.expiry_ms > ? THEN k.expiry_date END) AS nearest_expiry,
+                    group_concat(DISTINCT k.host_name) AS hosts
+                FROM page
+                LEFT JOIN vpn_keys k ON k.user_id = page.telegram_id
+                GROUP BY page.telegram_id
+                {order_by}
+                """,
+                (*params, per_page, (page - 1) * per_page, now_ms)
+            )
+            return [dict(row) for row in cursor.fetchall()], total
+    except sqlite3.Error as e:
+        logging.error(f"Failed to get users page: {e}")
+        return [], 0
+
+def _build_search_query(text: str) -> str | None:
+    terms = [term.replace('"', '') for term in text.split()]
+    terms = [term for term in terms if term]
+    if not terms:
+        return None
+    return " ".join(f'"{term}"*' for term in terms)
+
+def search_admin(text: str, limit: int = 20) -> dict:
+    """
+    Prefix search over usernames, Telegram IDs, key emails/names/UUIDs and
+    payment IDs. Every whitespace-separated term must match.
+    """
+    results = {'users': [], 'keys': [], 'transactions': []}
+    query = _build_search_query(text)
+    if query is None:
+        return results
+    try:
+        with _connect() as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                """
+                SELECT u.telegram_id, u.username, u.is_banned
+                FROM users_fts JOIN users u ON u.telegram_id = users_fts.rowid
+                WHERE users_fts MATCH ? ORDER BY rank LIMIT ?
+                """,
+                (query, limit)
+            )
+            results['users'] = [dict(row) for row in cursor.fetchall()]
+            cursor.execute(
+                """
+                SELECT k.key_id, k.user_id, k.host_name, k.key_email, k.key_name, k.xui_client_uuid
+                FROM keys_fts JOIN vpn_keys k ON k.key_id = keys_fts.rowid
+                WHERE keys_fts MATCH ? ORDER BY rank LIMIT ?
+                """,
+                (query, limit)
+            )
+            results['keys'] = [dict(row) for row in cursor.fetchall()]
+            cursor.execute(
+                """
+                SELECT t.transaction_id, t.payment_id, t.user_id, t.status, t.amount_rub, t.created_date
+                FROM transactions_fts JOIN transactions t ON t.transaction_id = transactions_fts.rowid
+                WHERE transactions_fts MATCH ? ORDER BY rank LIMIT ?
+                """,
+                (query, limit)
+            )
+            results['transactions'] = [dict(row) for row in cursor.fetchall()]
+    except sqlite3.Error as e:
+        logging.error(f"Failed to search for '{text}': {e}")
+    return results
+
+def reload_banned_users() -> int:
+    global _banned_ids, _banned_reloads
+    with _banned_lock:
+        started_at = _banned_generation
+        _banned_reloads += 1
+    banned = None
+    try:
+        with _connect() as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT telegram_id FROM users WHERE is_banned = 1")
+            banned = set(row[0] for row in cursor.fetchall())
+    except sqlite3.Error as e:
+        logging.error(f"Failed to load banned users: {e}")
+    with _banned_lock:
+        if banned is not None:
+            for generation, telegram_id, is_banned in _banned_journal:
+                if generation >= started_at:
+                    (banned.add if is_banned else banned.discard)(telegram_id)
+            _banned_ids = frozenset(banned)
+        _banned_reloads -= 1
+        if not _banned_reloads:
+            _banned_journal.clear()
+        return len(_banned_ids or ())
+
+def is_user_banned(telegram_id: int) -> bool:
+    # Never queries the database: this runs on the event loop for every update.
+    banned = _banned_ids
+    return banned is not None and telegram_id in banned
+
+def _set_banned(telegram_id: int, banned: bool):
+    global _banned_ids, _banned_generation
+    with _banned_lock:
+        if _banned_reloads:
+            _banned_journal.append((_banned_generation, telegram_id, banned))
+        _banned_generation += 1
+        if _banned_ids is not None:
+            _banned_ids = _banned_ids | {telegram_id} if banned else _banned_ids - {telegram_id}
+
 def ban_user(telegram_id: int):
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _connect() as conn:
             cursor = conn.cursor()
             cursor.execute("UPDATE users SET is_banned = 1 WHERE telegram_id = ?", (telegram_id,))
             conn.commit()
+        _set_banned(telegram_id, True)
     except sqlite3.Error as e:
         logging.error(f"Failed to ban user {telegram_id}: {e}")
 
 def unban_user(telegram_id: int):
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _connect() as conn:
             cursor = conn.cursor()
             cursor.execute("UPDATE users SET is_banned = 0 WHERE telegram_id = ?", (telegram_id,))
             conn.commit()
+        _set_banned(telegram_id, False)
     except sqlite3.Error as e:
         logging.error(f"Failed to unban user {telegram_id}: {e}")
 
 def delete_user_keys(user_id: int):
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _connect() as conn:
             cursor = conn.cursor()
             cursor.execute("DELETE FROM vpn_keys WHERE user_id = ?", (user_id,))
             conn.commit()
@@ -833,11 +1687,12 @@ async def grant_referral_bonus(referrer_id: int):
     """
     from shop_bot.modules.xui_api import create_or_update_key_on_host
     from shop_bot.config import REFERRAL_BONUS_DAYS
+    from shop_bot.data_manager import async_database
     
     print(f"Attempting to grant referral bonus to referrer_id: {referrer_id}")
     
     # Get all keys for the referrer from the database
-    user_keys_db = get_user_keys(referrer_id)
+    user_keys_db = await async_database.get_user_keys(referrer_id)
     
     if not user_keys_db:
         print(f"No active keys found for referrer_id: {referrer_id}. No bonus granted.")
@@ -850,7 +1705,7 @@ async def grant_referral_bonus(referrer_id: int):
         key_email = key['key_email']
         
         # Get the current key details from the XUI panel
-        host_data = get_host(host_name)
+        host_data = await async_database.get_host(host_name)
         if not host_data:
             print(f"Host {host_name} not found for key {key_email}")
             continue
@@ -864,7 +1719,7 @@ async def grant_referral_bonus(referrer_id: int):
             
             # Update the local database with the new expiry information
             new_expiry_ms = result['expiry_timestamp_ms']
-            update_key_info(key['key_id'], result['client_uuid'], new_expiry_ms)
+            await async_database.update_key_info(key['key_id'], result['client_uuid'], new_expiry_ms)
         else:
             print(f"Failed to update expiry for key {key_email}")
     
@@ -888,7 +1743,7 @@ def delete_user_and_related_data(user_id: int):
         bool: True если удаление прошло успешно, False в случае ошибки
     """
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _connect() as conn:
             cursor = conn.cursor()
             
             # Логирование начала процесса удаления
@@ -916,6 +1771,7 @@ def delete_user_and_related_data(user_id: int):
             
             # Фиксируем изменения
             conn.commit()
+            _set_banned(user_id, False)
             
             logger.info(f"Успешно завершён процесс удаления пользователя {user_id} и всех связанных данных")
             return True
@@ -932,9 +1788,10 @@ async def get_user_xui_keys(user_id: int):
     fetches the corresponding details from the XUI panel.
     """
     from shop_bot.modules.xui_api import get_key_details_from_host
+    from shop_bot.data_manager import async_database
     
     # First, get all key records for this user from the local database
-    user_keys_db = get_user_keys(user_id)
+    user_keys_db = await async_database.get_user_keys(user_id)
     
     # For each key in the database, fetch the actual client data from XUI panel
     xui_keys = []
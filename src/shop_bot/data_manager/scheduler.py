@@ -1,17 +1,20 @@
 import asyncio
 import logging
+import time
 
-from datetime import datetime, timedelta
+from datetime import datetime
 
 from aiogram.utils.keyboard import InlineKeyboardBuilder
 from aiogram import Bot
 
 from shop_bot.bot_controller import BotController
-from shop_bot.data_manager import database
+from shop_bot.data_manager import async_database, backup, database
 from shop_bot.modules import xui_api
 from shop_bot.bot import keyboards
 
 CHECK_INTERVAL_SECONDS = 300
+HOUR_MS = 3600 * 1000
+STALE_KEY_DAYS = 5
 NOTIFY_BEFORE_HOURS = {72, 48, 24, 1}
 notified_users = {}
 
@@ -57,14 +60,12 @@ async def send_subscription_notification(bot: Bot, user_id: int, key_id: int, ti
     except Exception as e:
         logger.error(f"Error sending subscription notification to user {user_id}: {e}")
 
-def _cleanup_notified_users(all_db_keys: list[dict]):
+def _cleanup_notified_users(active_key_ids: set[int]):
     if not notified_users:
         return
 
     logger.info("Scheduler: Cleaning up the notification cache...")
     
-    active_key_ids = {key['key_id'] for key in all_db_keys}
-    
     users_to_check = list(notified_users.keys())
     
     cleaned_users = 0
@@ -86,20 +87,20 @@ def _cleanup_notified_users(all_db_keys: list[dict]):
 
 async def check_expiring_subscriptions(bot: Bot):
     logger.info("Scheduler: Checking for expiring subscriptions...")
-    current_time = datetime.now()
-    all_keys = database.get_all_keys()
-    
-    _cleanup_notified_users(all_keys)
-    
-    for key in all_keys:
+    now_ms = int(time.time() * 1000)
+    notify_until_ms = now_ms + (max(NOTIFY_BEFORE_HOURS) + 1) * HOUR_MS
+    # Only keys inside the notification window can need a message; keys that
+    # left it were renewed, expired or deleted, so their cache entries go too.
+    active_key_ids = set()
+
+    async for key in async_database.iter_keys(
+        where=database.KEYS_EXPIRING_BETWEEN,
+        params=(now_ms, notify_until_ms),
+        columns=("key_id", "user_id", "expiry_ms"),
+    ):
+        active_key_ids.add(key['key_id'])
         try:
-            expiry_date = datetime.fromisoformat(key['expiry_date'])
-            time_left = expiry_date - current_time
-
-            if time_left.total_seconds() < 0:
-                continue
-
-            total_hours_left = int(time_left.total_seconds() / 3600)
+            total_hours_left = (key['expiry_ms'] - now_ms) // HOUR_MS
             user_id = key['user_id']
             key_id = key['key_id']
 
@@ -108,6 +109,7 @@ async def check_expiring_subscriptions(bot: Bot):
                     notified_users.setdefault(user_id, {}).setdefault(key_id, set())
                     
                     if hours_mark not in notified_users[user_id][key_id]:
+                        expiry_date = datetime.fromtimestamp(key['expiry_ms'] / 1000)
                         await send_subscription_notification(bot, user_id, key_id, hours_mark, expiry_date)
                         notified_users[user_id][key_id].add(hours_mark)
                     break 
@@ -115,11 +117,13 @@ async def check_expiring_subscriptions(bot: Bot):
         except Exception as e:
             logger.error(f"Error processing expiry for key {key.get('key_id')}: {e}")
 
+    _cleanup_notified_users(active_key_ids)
+
 async def sync_keys_with_panels():
     logger.info("Scheduler: Starting sync with XUI panels...")
     total_affected_records = 0
     
-    all_hosts = database.get_all_hosts()
+    all_hosts = await async_database.get_all_hosts()
     if not all_hosts:
         logger.info("Scheduler: No hosts configured in the database. Sync skipped.")
         return
@@ -129,7 +133,7 @@ async def sync_keys_with_panels():
         logger.info(f"Scheduler: Processing host: '{host_name}'")
         
         try:
-            api, inbound = xui_api.login_to_host(
+            api, inbound = await xui_api.login_to_host(
                 host_url=host['host_url'],
                 username=host['host_username'],
                 password=host['host_pass'],
@@ -140,41 +144,42 @@ async def sync_keys_with_panels():
                 logger.error(f"Scheduler: Could not log in to host '{host_name}'. Skipping this host.")
                 continue
             
-            full_inbound_details = api.inbound.get_by_id(inbound.id)
-            clients_on_server = {client.email: client for client in (full_inbound_details.settings.clients or [])}
+            await xui_api.remember_inbound_profile(host, inbound)
+            clients_on_server = {client.email: client for client in (inbound.settings.clients or [])}
             logger.info(f"Scheduler: Found {len(clients_on_server)} clients on the '{host_name}' panel.")
 
-            keys_in_db = database.get_keys_for_host(host_name)
-            
-            for db_key in keys_in_db:
-                key_email = db_key['key_email']
-                expiry_date = datetime.fromisoformat(db_key['expiry_date'])
-                now = datetime.now()
-                if expiry_date < now - timedelta(days=5):
-                    logger.info(f"Scheduler: Key '{key_email}' expired more than 5 days ago. Deleting from panel and DB.")
-                    try:
-                        await xui_api.delete_client_on_host(host_name, key_email)
-                    except Exception as e:
-                        logger.error(f"Scheduler: Failed to delete client '{key_email}' from panel: {e}")
-                    database.delete_key_by_email(key_email)
-                    total_affected_records += 1
-                    continue
+            stale_before_ms = int(time.time() * 1000) - STALE_KEY_DAYS * 24 * HOUR_MS
 
+            async for db_key in async_database.iter_keys(
+                where=database.HOST_KEYS_EXPIRED_BEFORE, params=(host_name, stale_before_ms)
+            ):
+                key_email = db_key['key_email']
+                logger.info(f"Scheduler: Key '{key_email}' expired more than {STALE_KEY_DAYS} days ago. Deleting from panel and DB.")
+                clients_on_server.pop(key_email, None)
+                try:
+                    await xui_api.delete_client_on_host(host_name, key_email)
+                except Exception as e:
+                    logger.error(f"Scheduler: Failed to delete client '{key_email}' from panel: {e}")
+                await async_database.delete_key_by_email(key_email)
+                total_affected_records += 1
+
+            async for db_key in async_database.iter_keys(
+                where=database.HOST_KEYS_EXPIRING_AFTER, params=(host_name, stale_before_ms)
+            ):
+                key_email = db_key['key_email']
                 server_client = clients_on_server.pop(key_email, None)
 
                 if server_client:
                     reset_days = server_client.reset if server_client.reset is not None else 0
-                    server_expiry_ms = server_client.expiry_time + reset_days * 24 * 3600 * 1000
-                    local_expiry_dt = expiry_date
-                    local_expiry_ms = int(local_expiry_dt.timestamp() * 1000)
+                    server_expiry_ms = server_client.expiry_time + reset_days * 24 * HOUR_MS
 
-                    if abs(server_expiry_ms - local_expiry_ms) > 1000:
-                        database.update_key_status_from_server(key_email, server_client)
+                    if abs(server_expiry_ms - db_key['expiry_ms']) > 1000:
+                        await async_database.update_key_status_from_server(key_email, server_client)
                         total_affected_records += 1
                         logger.info(f"Scheduler: Synced (updated) key '{key_email}' for host '{host_name}'.")
                 else:
                     logger.warning(f"Scheduler: Key '{key_email}' for host '{host_name}' not found on server. Deleting from local DB.")
-                    database.update_key_status_from_server(key_email, None)
+                    await async_database.update_key_status_from_server(key_email, None)
                     total_affected_records += 1
 
             if clients_on_server:
@@ -185,6 +190,7 @@ async def sync_keys_with_panels():
             logger.error(f"Scheduler: An unexpected error occurred while processing host '{host_name}': {e}", exc_info=True)
             
     logger.info(f"Scheduler: Sync with XUI panels finished. Total records affected: {total_affected_records}.")
+    logger.info(f"Scheduler: XUI session pool: {xui_api.get_session_stats()}")
 
 async def periodic_subscription_check(bot_controller: BotController):
     logger.info("Scheduler has been started.")
@@ -192,8 +198,15 @@ async def periodic_subscription_check(bot_controller: BotController):
 
     while True:
         try:
+            banned_count = await async_database.reload_banned_users()
+            logger.info(f"Scheduler: Reconciled banned users cache ({banned_count} banned).")
+
             await sync_keys_with_panels()
 
+            backup_status = await asyncio.to_thread(backup.run_scheduled_backup)
+            if backup_status:
+                logger.info(f"Scheduler: Scheduled backup finished: {backup_status.get('file') or backup_status.get('error')}")
+
             if bot_controller.get_status().get("is_running"):
                 bot = bot_controller.get_bot_instance()
                 if bot:
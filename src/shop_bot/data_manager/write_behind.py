@@ -0,0 +1,116 @@
+import sqlite3
+import threading
+import time
+import logging
+from itertools import groupby
+from typing import Callable, ContextManager
+
+logger = logging.getLogger(__name__)
+
+class WriteBehindQueue:
+    """
+    Buffers non-critical writes and commits them from a background thread.
+
+    Statements are applied in submission order; consecutive runs of the same
+    statement go through one `executemany`, and everything pending is
+    committed in a single transaction every `interval` seconds, when more
+    than `max_pending` writes are waiting, and on `close()`.
+    """
+
+    def __init__(self, connect: Callable[[], ContextManager[sqlite3.Connection]], interval: float = 0.5, max_pending: int = 1000):
+        self.interval = interval
+        self.max_pending = max_pending
+        self._connect = connect
+        self._pending: list[tuple[str, tuple]] = []
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread: threading.Thread | None = None
+        self._closed = False
+        self._stats = {'submitted': 0, 'flushed': 0, 'batches': 0, 'retried': 0, 'dropped': 0, 'last_flush_ms': 0.0}
+
+    def submit(self, sql: str, params: tuple):
+        with self._lock:
+            if self._closed:
+                raise sqlite3.ProgrammingError("Write-behind queue is closed.")
+            self._pending.append((sql, params))
+            self._stats['submitted'] += 1
+            pending = len(self._pending)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="db-write-behind", daemon=True)
+                self._thread.start()
+        if pending >= self.max_pending:
+            self._wake.set()
+
+    def _run(self):
+        while True:
+            self._wake.wait(self.interval)
+            self._wake.clear()
+            self.flush()
+            with self._lock:
+                if self._closed:
+                    return
+
+    def _apply(self, batch: list[tuple[str, tuple]]):
+        with self._connect() as conn:
+            for sql, group in groupby(batch, key=lambda item: item[0]):
+                conn.executemany(sql, [params for _, params in group])
+            conn.commit()
+
+    def _apply_one_by_one(self, batch: list[tuple[str, tuple]]) -> int:
+        dropped = 0
+        for sql, params in batch:
+            try:
+                with self._connect() as conn:
+                    conn.execute(sql, params)
+                    conn.commit()
+            except sqlite3.Error as e:
+                dropped += 1
+                logger.error(f"Dropping deferred write '{sql.split()[0]} ...' with {params}: {e}")
+        return dropped
+
+    def flush(self) -> int:
+        """Commit everything pending now; returns the number of writes applied."""
+        with self._flush_lock:
+            with self._lock:
+                batch, self._pending = self._pending, []
+            if not batch:
+                return 0
+            started = time.perf_counter()
+            dropped = 0
+            try:
+                self._apply(batch)
+            except sqlite3.Error as e:
+                if isinstance(e, sqlite3.OperationalError) and ("locked" in str(e) or "busy" in str(e)):
+                    # Busy or locked: keep the writes and try again on the next tick.
+                    logger.warning(f"Deferred writes postponed ({len(batch)} pending): {e}")
+                    with self._lock:
+                        self._pending[:0] = batch
+                        self._stats['retried'] += len(batch)
+                    return 0
+                logger.error(f"Deferred batch of {len(batch)} writes failed, applying individually: {e}")
+                dropped = self._apply_one_by_one(batch)
+            with self._lock:
+                self._stats['flushed'] += len(batch) - dropped
+                self._stats['dropped'] += dropped
+                self._stats['batches'] += 1
+                self._stats['last_flush_ms'] = round((time.perf_counter() - started) * 1000, 2)
+            return len(batch) - dropped
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {**self._stats, 'pending': len(self._pending)}
+
+    def close(self):
+        with self._lock:
+            self._closed = True
+            thread = self._thread
+        self._wake.set()
+        if thread is not None:
+            thread.join()
+        self.flush()
+        with self._lock:
+            lost = len(self._pending)
+        if lost:
+            logger.error(f"Write-behind queue closed with {lost} writes that could not be committed.")
+        logger.info("Write-behind queue flushed and closed.")
@@ -1,103 +1,201 @@
+import json
 import uuid
+import asyncio
 from datetime import datetime, timedelta
 import logging
 from urllib.parse import urlparse
-from typing import List, Dict
+from typing import Dict
 
-from py3xui import Api, Client, Inbound
+from py3xui import Client, Inbound
 
-from shop_bot.data_manager.database import get_host, get_key_by_email
+from shop_bot.data_manager import async_database
+from shop_bot.data_manager.database import get_host
+from shop_bot.modules.xui_client import XuiApiError, XuiClient
 
 logger = logging.getLogger(__name__)
 
-def login_to_host(host_url: str, username: str, password: str, inbound_id: int) -> tuple[Api | None, Inbound | None]:
+# One XuiClient per panel URL, each with its own connection pool and login.
+# They belong to the bot's event loop; other threads submit work to it.
+_clients: dict[str, XuiClient] = {}
+_retiring: set[asyncio.Task] = set()
+
+async def get_panel(host_url: str, username: str, password: str) -> XuiClient:
+    panel = _clients.get(host_url)
+    if panel is not None and (panel.username, panel.password) == (username, password):
+        return panel
+    _clients[host_url] = XuiClient(host_url, username, password)
+    if panel is not None:
+        # Credentials changed: new calls use the new client, calls already
+        # running on the old one finish before it is closed.
+        task = asyncio.create_task(panel.close_when_idle())
+        _retiring.add(task)
+        task.add_done_callback(_retiring.discard)
+    return _clients[host_url]
+
+async def _panel_for(host_data: dict) -> XuiClient:
+    return await get_panel(host_data['host_url'], host_data['host_username'], host_data['host_pass'])
+
+async def close_panels():
+    panels = list(_clients.values())
+    _clients.clear()
+    for panel in panels:
+        await panel.close()
+    if _retiring:
+        await asyncio.gather(*_retiring, return_exceptions=True)
+
+def get_session_stats() -> dict:
+    """Request counts, login reuse and latency across all panel clients."""
+    totals = {'hosts': len(_clients), 'requests': 0, 'logins': 0, 'relogins': 0, 'errors': 0}
+    request_ms = login_ms = 0.0
+    for panel in list(_clients.values()):
+        for key in ('requests', 'logins', 'relogins', 'errors'):
+            totals[key] += panel.stats[key]
+        request_ms += panel.stats['request_ms_total']
+        login_ms += panel.stats['login_ms_total']
+    requests, logins = totals['requests'], totals['logins']
+    totals['hit_rate'] = round(max(requests - logins, 0) / requests, 3) if requests else None
+    totals['request_ms_avg'] = round(request_ms / requests, 1) if requests else None
+    totals['login_ms_avg'] = round(login_ms / logins, 1) if logins else None
+    totals['queues'] = {url: panel.queue_stats() for url, panel in list(_clients.items())}
+    return totals
+
+async def login_to_host(host_url: str, username: str, password: str, inbound_id: int) -> tuple[XuiClient | None, Inbound | None]:
     try:
-        api = Api(host=host_url, username=username, password=password)
-        api.login()
-        inbounds: List[Inbound] = api.inbound.get_list()
-        target_inbound = next((inbound for inbound in inbounds if inbound.id == inbound_id), None)
-        
-        if target_inbound is None:
-            logger.error(f"Inbound with ID '{inbound_id}' not found on host '{host_url}'")
-            return api, None
-        return api, target_inbound
+        panel = await get_panel(host_url, username, password)
+        target_inbound = await panel.get_inbound(inbound_id)
     except Exception as e:
         logger.error(f"Login or inbound retrieval failed for host '{host_url}': {e}", exc_info=True)
         return None, None
 
-def get_connection_string(inbound: Inbound, user_uuid: str, host_url: str, remark: str) -> str | None:
+    if target_inbound is None:
+        logger.error(f"Inbound with ID '{inbound_id}' not found on host '{host_url}'")
+        return panel, None
+    return panel, target_inbound
+
+def build_inbound_profile(inbound: Inbound) -> dict | None:
+    """The parts of an inbound that a connection string needs."""
     if not inbound: return None
-    settings = inbound.stream_settings.reality_settings.get("settings")
+    reality_settings = inbound.stream_settings.reality_settings
+    settings = reality_settings.get("settings")
     if not settings: return None
-    
-    public_key = settings.get("publicKey")
-    fp = settings.get("fingerprint")
-    server_names = inbound.stream_settings.reality_settings.get("serverNames")
-    short_ids = inbound.stream_settings.reality_settings.get("shortIds")
-    port = inbound.port
-    
-    if not all([public_key, server_names, short_ids]): return None
-    
+
+    profile = {
+        "inbound_id": inbound.id,
+        "port": inbound.port,
+        "public_key": settings.get("publicKey"),
+        "fingerprint": settings.get("fingerprint"),
+        "server_names": reality_settings.get("serverNames"),
+        "short_ids": reality_settings.get("shortIds"),
+    }
+    if not all([profile["public_key"], profile["server_names"], profile["short_ids"]]): return None
+    return profile
+
+def connection_string_from_profile(profile: dict | None, user_uuid: str, host_url: str, remark: str) -> str | None:
+    if not profile: return None
     parsed_url = urlparse(host_url)
-    short_id = short_ids[0]
     
     connection_string = (
-        f"vless://{user_uuid}@{parsed_url.hostname}:{port}"
-        f"?type=tcp&security=reality&pbk={public_key}&fp={fp}&sni={server_names[0]}"
-        f"&sid={short_id}&spx=%2F&flow=xtls-rprx-vision#{remark}"
+        f"vless://{user_uuid}@{parsed_url.hostname}:{profile['port']}"
+        f"?type=tcp&security=reality&pbk={profile['public_key']}&fp={profile['fingerprint']}&sni={profile['server_names'][0]}"
+        f"&sid={profile['short_ids'][0]}&spx=%2F&flow=xtls-rprx-vision#{remark}"
     )
     return connection_string
 
-def update_or_create_client_on_panel(api: Api, inbound_id: int, email: str, days_to_add: int) -> tuple[str | None, int | None]:
+def get_connection_string(inbound: Inbound, user_uuid: str, host_url: str, remark: str) -> str | None:
+    return connection_string_from_profile(build_inbound_profile(inbound), user_uuid, host_url, remark)
+
+def get_cached_profile(host_data: dict) -> dict | None:
+    """The inbound profile stored for a host, if it is still for the host's inbound."""
+    raw_profile = host_data.get('inbound_profile')
+    if not raw_profile:
+        return None
     try:
-        inbound_to_modify = api.inbound.get_by_id(inbound_id)
-        if not inbound_to_modify:
-            raise ValueError(f"Could not find inbound with ID {inbound_id}")
-
-        if inbound_to_modify.settings.clients is None:
-            inbound_to_modify.settings.clients = []
-            
-        client_index = -1
-        for i, client in enumerate(inbound_to_modify.settings.clients):
-            if client.email == email:
-                client_index = i
-                break
-        
-        if client_index != -1:
-            existing_client = inbound_to_modify.settings.clients[client_index]
-            if existing_client.expiry_time > int(datetime.now().timestamp() * 1000):
-                current_expiry_dt = datetime.fromtimestamp(existing_client.expiry_time / 1000)
-                new_expiry_dt = current_expiry_dt + timedelta(days=days_to_add)
-            else:
-                new_expiry_dt = datetime.now() + timedelta(days=days_to_add)
-        else:
-            new_expiry_dt = datetime.now() + timedelta(days=days_to_add)
-
-        new_expiry_ms = int(new_expiry_dt.timestamp() * 1000)
-
-        if client_index != -1:
-            inbound_to_modify.settings.clients[client_index].reset = days_to_add
-            inbound_to_modify.settings.clients[client_index].enable = True
-            
-            client_uuid = inbound_to_modify.settings.clients[client_index].id
-        else:
-            client_uuid = str(uuid.uuid4())
-            new_client = Client(
-                id=client_uuid,
-                email=email,
-                enable=True,
-                flow="xtls-rprx-vision",
-                expiry_time=new_expiry_ms
-            )
-            inbound_to_modify.settings.clients.append(new_client)
-
-        api.inbound.update(inbound_id, inbound_to_modify)
+        profile = json.loads(raw_profile)
+    except ValueError:
+        return None
+    if profile.get('inbound_id') != host_data.get('host_inbound_id'):
+        return None
+    return profile
 
-        return client_uuid, new_expiry_ms
+async def remember_inbound_profile(host_data: dict, inbound: Inbound) -> dict | None:
+    """Store the host's inbound profile when it differs from the cached one."""
+    profile = build_inbound_profile(inbound)
+    if profile != get_cached_profile(host_data):
+        if await async_database.update_host_profile(host_data['host_name'], profile):
+            logger.info(f"Inbound profile for host '{host_data['host_name']}' changed and was updated.")
+    return profile
 
-    except Exception as e:
-        logger.error(f"Error in update_or_create_client_on_panel: {e}", exc_info=True)
-        return None, None
+CLIENT_FLOW = "xtls-rprx-vision"
+DAY_MS = 24 * 3600 * 1000
+
+def _extended_expiry_ms(current_expiry_ms: int | None, days_to_add: int) -> int:
+    now = datetime.now()
+    if current_expiry_ms and current_expiry_ms > int(now.timestamp() * 1000):
+        base = datetime.fromtimestamp(current_expiry_ms / 1000)
+    else:
+        base = now
+    return int((base + timedelta(days=days_to_add)).timestamp() * 1000)
+
+async def _extend_client(panel: XuiClient, inbound_id: int, panel_client: dict, days_to_add: int) -> tuple[str, int]:
+    # Same reading of a panel client as the scheduler's sync: expiry plus any
+    # renewal days still recorded in `reset`. Those days move into expiryTime;
+    # every other field the panel stores is sent back unchanged.
+    current_expiry_ms = (panel_client.get('expiryTime') or 0) + (panel_client.get('reset') or 0) * DAY_MS
+    new_expiry_ms = _extended_expiry_ms(current_expiry_ms, days_to_add)
+    await panel.update_client(inbound_id, {**panel_client, 'expiryTime': new_expiry_ms, 'reset': 0, 'enable': True})
+    return panel_client['id'], new_expiry_ms
+
+async def _extend_indexed_client(panel: XuiClient, inbound_id: int, known_key: dict, traffic: Client, days_to_add: int) -> tuple[str, int]:
+    # The client as the bot created it (vpn_keys row) with its current expiry
+    # and traffic limit from the panel's traffic record.
+    new_expiry_ms = _extended_expiry_ms(traffic.expiry_time + (traffic.reset or 0) * DAY_MS, days_to_add)
+    client = Client(
+        id=known_key['xui_client_uuid'], email=known_key['key_email'], enable=True, flow=CLIENT_FLOW,
+        expiry_time=new_expiry_ms, reset=0, total_gb=traffic.total,
+    )
+    await panel.update_client(inbound_id, client)
+    return known_key['xui_client_uuid'], new_expiry_ms
+
+async def _extend_from_inbound(panel: XuiClient, inbound_id: int, email: str, days_to_add: int) -> tuple[str, int] | None:
+    panel_client = await panel.find_client(inbound_id, email)
+    if panel_client is None:
+        return None
+    return await _extend_client(panel, inbound_id, panel_client, days_to_add)
+
+async def _update_or_create_client(panel: XuiClient, inbound_id: int, email: str, days_to_add: int) -> tuple[str, int]:
+    """
+    Add or extend one client with the panel's per-client endpoints. Our
+    vpn_keys table is the email -> UUID index: a new key is one addClient, an
+    extension one traffic lookup plus one updateClient. The whole inbound is
+    read only when the panel and the index disagree.
+    """
+    known_key = await async_database.get_key_by_email(email)
+    if known_key:
+        traffic = await panel.get_client_traffic(email)
+        if traffic is not None:
+            try:
+                return await _extend_indexed_client(panel, inbound_id, known_key, traffic, days_to_add)
+            except XuiApiError as e:
+                # The panel's client no longer has our UUID (recreated or edited).
+                logger.warning(f"Updating client '{email}' by its stored UUID failed ({e}); looking it up in the inbound.")
+                result = await _extend_from_inbound(panel, inbound_id, email, days_to_add)
+                if result is None:
+                    raise
+                return result
+
+    client_uuid = known_key['xui_client_uuid'] if known_key else str(uuid.uuid4())
+    new_expiry_ms = _extended_expiry_ms(None, days_to_add)
+    new_client = Client(id=client_uuid, email=email, enable=True, flow=CLIENT_FLOW, expiry_time=new_expiry_ms)
+    try:
+        await panel.add_client(inbound_id, new_client)
+        return client_uuid, new_expiry_ms
+    except XuiApiError:
+        # Rare: the panel has this email but our index does not (e.g. the key
+        # row was removed). Extend the panel's client instead.
+        result = await _extend_from_inbound(panel, inbound_id, email, days_to_add)
+        if result is None:
+            raise
+        return result
 
 async def create_or_update_key_on_host(host_name: str, email: str, days_to_add: int) -> Dict | None:
     host_data = get_host(host_name)
@@ -105,22 +203,18 @@ async def create_or_update_key_on_host(host_name: str, email: str, days_to_add:
         logger.error(f"Workflow failed: Host '{host_name}' not found in the database.")
         return None
 
-    api, inbound = login_to_host(
-        host_url=host_data['host_url'],
-        username=host_data['host_username'],
-        password=host_data['host_pass'],
-        inbound_id=host_data['host_inbound_id']
-    )
-    if not api or not inbound:
-        logger.error(f"Workflow failed: Could not log in or find inbound on host '{host_name}'.")
-        return None
-        
-    client_uuid, new_expiry_ms = update_or_create_client_on_panel(api, inbound.id, email, days_to_add)
-    if not client_uuid:
-        logger.error(f"Workflow failed: Could not create/update client '{email}' on host '{host_name}'.")
+    try:
+        panel = await _panel_for(host_data)
+        async with panel.write_lane():
+            client_uuid, new_expiry_ms = await _update_or_create_client(panel, host_data['host_inbound_id'], email, days_to_add)
+        profile = get_cached_profile(host_data)
+        if profile is None:
+            profile = await remember_inbound_profile(host_data, await panel.get_inbound(host_data['host_inbound_id']))
+    except Exception as e:
+        logger.error(f"Workflow failed: Could not create/update client '{email}' on host '{host_name}': {e}", exc_info=True)
         return None
     
-    connection_string = get_connection_string(inbound, client_uuid, host_data['host_url'], remark=host_name)
+    connection_string = connection_string_from_profile(profile, client_uuid, host_data['host_url'], remark=host_name)
     
     logger.info(f"Successfully processed key for '{email}' on host '{host_name}'.")
     
@@ -143,15 +237,20 @@ async def get_key_details_from_host(key_data: dict) -> dict | None:
         logger.error(f"Could not get key details: Host '{host_name}' not found in the database.")
         return None
 
-    api, inbound = login_to_host(
-        host_url=host_db_data['host_url'],
-        username=host_db_data['host_username'],
-        password=host_db_data['host_pass'],
-        inbound_id=host_db_data['host_inbound_id']
-    )
-    if not api or not inbound: return None
+    # The inbound profile is cached with the host, so showing a key normally
+    # needs no panel call and keeps working while the panel is down.
+    profile = get_cached_profile(host_db_data)
+    if profile is None:
+        try:
+            panel = await _panel_for(host_db_data)
+            inbound = await panel.get_inbound(host_db_data['host_inbound_id'])
+        except Exception as e:
+            logger.error(f"Could not get key details: inbound lookup failed on host '{host_name}': {e}", exc_info=True)
+            return None
+        if not inbound: return None
+        profile = await remember_inbound_profile(host_db_data, inbound)
 
-    connection_string = get_connection_string(inbound, key_data['xui_client_uuid'], host_db_data['host_url'], remark=host_name)
+    connection_string = connection_string_from_profile(profile, key_data['xui_client_uuid'], host_db_data['host_url'], remark=host_name)
     return {"connection_string": connection_string}
 
 async def delete_client_on_host(host_name: str, client_email: str) -> bool:
@@ -160,27 +259,17 @@ async def delete_client_on_host(host_name: str, client_email: str) -> bool:
         logger.error(f"Cannot delete client: Host '{host_name}' not found.")
         return False
 
-    api, inbound = login_to_host(
-        host_url=host_data['host_url'],
-        username=host_data['host_username'],
-        password=host_data['host_pass'],
-        inbound_id=host_data['host_inbound_id']
-    )
+    client_to_delete = await async_database.get_key_by_email(client_email)
+    if not client_to_delete:
+        logger.warning(f"Client '{client_email}' not found on host '{host_name}' for deletion (already gone).")
+        return True
 
-    if not api or not inbound:
-        logger.error(f"Cannot delete client: Login or inbound lookup failed for host '{host_name}'.")
-        return False
-        
     try:
-        client_to_delete = get_key_by_email(client_email)
-        if client_to_delete:
-            api.client.delete(inbound.id, client_to_delete['xui_client_uuid'])
-            logger.info(f"Successfully deleted client '{client_to_delete['xui_client_uuid']}' from host '{host_name}'.")
-            return True
-        else:
-            logger.warning(f"Client '{client_to_delete['xui_client_uuid']}' not found on host '{host_name}' for deletion (already gone).")
-            return True
-            
+        panel = await _panel_for(host_data)
+        async with panel.write_lane():
+            await panel.delete_client(host_data['host_inbound_id'], client_to_delete['xui_client_uuid'])
+        logger.info(f"Successfully deleted client '{client_to_delete['xui_client_uuid']}' from host '{host_name}'.")
+        return True
     except Exception as e:
         logger.error(f"Failed to delete client '{client_to_delete['xui_client_uuid']}' from host '{host_name}': {e}", exc_info=True)
-        return False
\ No newline at end of file
+        return False
@@ -0,0 +1,243 @@
+import os
+import json
+import time
+import asyncio
+import logging
+from contextlib import asynccontextmanager
+
+import aiohttp
+from py3xui import Client, Inbound
+
+logger = logging.getLogger(__name__)
+
+REQUEST_TIMEOUT_SECONDS = 15
+CONNECT_TIMEOUT_SECONDS = 5
+# Requests in flight to one panel at a time; the rest wait their turn.
+MAX_CONCURRENCY_PER_HOST = int(os.getenv("XUI_MAX_CONCURRENCY", "4"))
+# 3x-ui expires panel sessions after 60 minutes by default; log in again a
+# little earlier instead of waiting for a call to fail.
+SESSION_MAX_AGE_SECONDS = 50 * 60
+# Statuses 3x-ui answers API calls with once the login cookie is gone
+# (redirects are not followed, see XuiClient._request).
+AUTH_FAILURE_STATUSES = {301, 302, 303, 307, 308, 401, 403, 404}
+
+class XuiApiError(Exception):
+    pass
+
+class XuiAuthError(XuiApiError):
+    pass
+
+class XuiClient:
+    """
+    Async client for the 3x-ui panel API of one host.
+
+    Holds one aiohttp session per host, so connections and the login cookie
+    are reused. It logs in on first use, again once the session is
+    `session_max_age` seconds old, and again (retrying the call once) when
+    the panel stops accepting the cookie. Responses are parsed into py3xui
+    models so callers keep working with `Inbound` and `Client`.
+
+    At most `max_concurrency` requests run against the panel at once.
+    Operations that change clients take `write_lane()` for their whole
+    read-modify-write: the panel rewrites the inbound's settings on every
+    client change, so parallel changes to one panel could drop each other.
+    """
+
+    def __init__(self, host_url: str, username: str, password: str, session_max_age: float = SESSION_MAX_AGE_SECONDS, max_concurrency: int = MAX_CONCURRENCY_PER_HOST):
+        self.host_url = host_url.rstrip('/')
+        self.username = username
+        self.password = password
+        self.session_max_age = session_max_age
+        self.max_concurrency = max(1, max_concurrency)
+        self._slots = asyncio.Semaphore(self.max_concurrency)
+        # asyncio.Lock hands itself to waiters in arrival order, which makes
+        # the write lane FIFO.
+        self._write_lock = asyncio.Lock()
+        self.queue = {
+            'in_flight': 0, 'waiting': 0, 'waiting_max': 0, 'slot_wait_ms_total': 0.0,
+            'writes': 0, 'writes_waiting': 0, 'writes_waiting_max': 0, 'write_wait_ms_total': 0.0, 'write_wait_ms_max': 0.0,
+        }
+        self._session: aiohttp.ClientSession | None = None
+        self._closed = False
+        self._logged_in_at: float | None = None
+        self._login_lock: asyncio.Lock | None = None
+        self.stats = {'requests': 0, 'request_ms_total': 0.0, 'logins': 0, 'login_ms_total': 0.0, 'relogins': 0, 'errors': 0}
+
+    def _get_session(self) -> aiohttp.ClientSession:
+        if self._closed:
+            # A retired or shut-down client must not open a session nobody closes.
+            raise XuiApiError(f"XUI client for '{self.host_url}' is closed.")
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit_per_host=self.max_concurrency),
+                # Panels are often addressed by IP, which the default jar ignores.
+                cookie_jar=aiohttp.CookieJar(unsafe=True),
+                timeout=aiohttp.ClientTimeout(total=REQUEST_TIMEOUT_SECONDS, connect=CONNECT_TIMEOUT_SECONDS),
+            )
+        return self._session
+
+    @staticmethod
+    async def _read_payload(response: aiohttp.ClientResponse) -> dict:
+        response.raise_for_status()
+        try:
+            return await response.json(content_type=None)
+        except (ValueError, aiohttp.ContentTypeError) as e:
+            raise XuiAuthError(f"Unexpected non-JSON response from {response.url}") from e
+
+    async def login(self):
+        if self._login_lock is None:
+            self._login_lock = asyncio.Lock()
+        stale_since = self._logged_in_at
+        async with self._login_lock:
+            if self._logged_in_at is not None and self._logged_in_at != stale_since:
+                return
+            session = self._get_session()
+            session.cookie_jar.clear()
+            started = time.perf_counter()
+            async with session.post(
+                f"{self.host_url}/login", data={"username": self.username, "password": self.password}
+            ) as response:
+                payload = await self._read_payload(response)
+            self.stats['logins'] += 1
+            self.stats['login_ms_total'] += (time.perf_counter() - started) * 1000
+            if not payload.get("success"):
+                raise XuiAuthError(f"Login to '{self.host_url}' failed: {payload.get('msg')}")
+            self._logged_in_at = time.monotonic()
+            logger.info(f"Logged in to XUI panel '{self.host_url}'.")
+
+    @asynccontextmanager
+    async def _slot(self):
+        queue = self.queue
+        queue['waiting'] += 1
+        queue['waiting_max'] = max(queue['waiting_max'], queue['waiting'])
+        started = time.perf_counter()
+        try:
+            await self._slots.acquire()
+        finally:
+            queue['waiting'] -= 1
+        queue['slot_wait_ms_total'] += (time.perf_counter() - started) * 1000
+        queue['in_flight'] += 1
+        try:
+            yield
+        finally:
+            queue['in_flight'] -= 1
+            self._slots.release()
+
+    @asynccontextmanager
+    async def write_lane(self):
+        """Run one client-changing operation at a time against this panel, in arrival order."""
+        queue = self.queue
+        queue['writes_waiting'] += 1
+        queue['writes_waiting_max'] = max(queue['writes_waiting_max'], queue['writes_waiting'])
+        started = time.perf_counter()
+        try:
+            await self._write_lock.acquire()
+        finally:
+            queue['writes_waiting'] -= 1
+        waited_ms = (time.perf_counter() - started) * 1000
+        queue['writes'] += 1
+        queue['write_wait_ms_total'] += waited_ms
+        queue['write_wait_ms_max'] = max(queue['write_wait_ms_max'], waited_ms)
+        try:
+            yield
+        finally:
+            self._write_lock.release()
+
+    def queue_stats(self) -> dict:
+        """Queue depth and wait times, with the ms figures rounded for display."""
+        queue = self.queue
+        requests, writes = self.stats['requests'], queue['writes']
+        return {
+            **{key: round(value, 1) if isinstance(value, float) else value for key, value in queue.items()},
+            'slot_wait_ms_avg': round(queue['slot_wait_ms_total'] / requests, 1) if requests else None,
+            'write_wait_ms_avg': round(queue['write_wait_ms_total'] / writes, 1) if writes else None,
+        }
+
+    async def _request(self, method: str, path: str, **kwargs):
+        async with self._slot():
+            return await self._send(method, path, **kwargs)
+
+    async def _send(self, method: str, path: str, **kwargs):
+        started = time.perf_counter()
+        try:
+            for attempt in (1, 2):
+                if self._logged_in_at is None or time.monotonic() - self._logged_in_at > self.session_max_age:
+                    await self.login()
+                try:
+                    async with self._get_session().request(
+                        method, f"{self.host_url}{path}", allow_redirects=False, **kwargs
+                    ) as response:
+                        if response.status in AUTH_FAILURE_STATUSES:
+                            raise XuiAuthError(f"HTTP {response.status} for {method} {path}")
+                        payload = await self._read_payload(response)
+                except XuiAuthError:
+                    if attempt == 2:
+                        raise
+                    logger.warning(f"XUI session for '{self.host_url}' was rejected; logging in again.")
+                    self._logged_in_at = None
+                    self.stats['relogins'] += 1
+                    continue
+                if not payload.get("success"):
+                    raise XuiApiError(f"{method} {path} failed: {payload.get('msg')}")
+                return payload.get("obj")
+        except Exception:
+            self.stats['errors'] += 1
+            raise
+        finally:
+            self.stats['requests'] += 1
+            self.stats['request_ms_total'] += (time.perf_counter() - started) * 1000
+
+    async def get_inbound(self, inbound_id: int) -> Inbound | None:
+        obj = await self._request("GET", f"/panel/api/inbounds/get/{inbound_id}")
+        return Inbound.model_validate(obj) if obj else None
+
+    async def update_inbound(self, inbound: Inbound):
+        await self._request("POST", f"/panel/api/inbounds/update/{inbound.id}", json=inbound.to_json())
+
+    async def find_client(self, inbound_id: int, email: str) -> dict | None:
+        """The inbound's settings entry for `email`, with every field the panel stores."""
+        obj = await self._request("GET", f"/panel/api/inbounds/get/{inbound_id}")
+        if not obj:
+            return None
+        clients = json.loads(obj.get("settings") or "{}").get("clients") or []
+        return next((client for client in clients if client.get("email") == email), None)
+
+    @staticmethod
+    def _client_payload(inbound_id: int, client: Client | dict) -> dict:
+        entry = client if isinstance(client, dict) else client.model_dump(by_alias=True, exclude_defaults=True)
+        return {"id": inbound_id, "settings": json.dumps({"clients": [entry]})}
+
+    async def add_client(self, inbound_id: int, client: Client):
+        await self._request("POST", "/panel/api/inbounds/addClient", json=self._client_payload(inbound_id, client))
+
+    async def update_client(self, inbound_id: int, client: Client | dict):
+        client_uuid = client["id"] if isinstance(client, dict) else client.id
+        await self._request(
+            "POST", f"/panel/api/inbounds/updateClient/{client_uuid}", json=self._client_payload(inbound_id, client)
+        )
+
+    async def delete_client(self, inbound_id: int, client_uuid: str):
+        await self._request("POST", f"/panel/api/inbounds/{inbound_id}/delClient/{client_uuid}")
+
+    async def get_client_traffic(self, email: str) -> Client | None:
+        """Traffic and expiry of one client, without downloading its inbound."""
+        obj = await self._request("GET", f"/panel/api/inbounds/getClientTraffics/{email}")
+        return Client.model_validate(obj) if obj else None
+
+    async def close_when_idle(self):
+        """Close once the running write and all in-flight requests have finished."""
+        async with self._write_lock:
+            for _ in range(self.max_concurrency):
+                await self._slots.acquire()
+            try:
+                await self.close()
+            finally:
+                for _ in range(self.max_concurrency):
+                    self._slots.release()
+
+    async def close(self):
+        self._closed = True
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
+        self._logged_in_at = None
@@ -4,10 +4,11 @@ import asyncio
 import json
 import hashlib
 import base64
+import sqlite3
 from hmac import compare_digest
+from math import ceil
 from datetime import datetime
 from functools import wraps
-from math import ceil
 from flask import Flask, request, render_template, redirect, url_for, flash, session, current_app, jsonify
 
 logging.basicConfig(level=logging.INFO)
@@ -15,14 +16,16 @@ logger = logging.getLogger(__name__)
 
 from shop_bot.modules import xui_api
 from shop_bot.bot import handlers
+from shop_bot.data_manager import backup
 from shop_bot.data_manager.database import (
     get_all_settings, update_setting, get_all_hosts, get_plans_for_host,
-    create_host, delete_host, create_plan, delete_plan, get_user_count,
-    get_total_keys_count, get_total_spent_sum, get_daily_stats_for_charts,
-    get_recent_transactions, get_paginated_transactions, get_all_users, get_user_keys,
+    create_host, delete_host, create_plan, delete_plan, get_stats_counters, get_revenue_by_host, get_revenue_by_plan,
+    recompute_stats_counters, get_daily_stats_for_charts,
+    get_recent_transactions, get_transactions_page, get_users_page, search_admin, get_user_keys,
     ban_user, unban_user, delete_user_keys, get_setting, find_and_complete_ton_transaction,
-    get_user, get_key_by_id, delete_key_by_email, get_next_key_number, add_new_key,
-    delete_key_by_id, delete_user_and_related_data
+    get_user, get_key_by_id, delete_key_by_email, reserve_key_number, add_new_key,
+    delete_key_by_id, delete_user_and_related_data, CHART_RANGES,
+    use_read_only_connections, get_pool_stats
 )
 from shop_bot.data_manager.database import get_user_by_id
 
@@ -65,6 +68,25 @@ def create_webhook_app(bot_controller_instance):
     
     flask_app.config['SECRET_KEY'] = 'lolkek4eburek'
 
+    def run_on_bot_loop(coro, timeout: float = 60):
+        # Panel clients live on the bot's event loop; run the coroutine there
+        # and wait for the result instead of spinning up a loop per request.
+        loop = current_app.config.get('EVENT_LOOP')
+        if not loop or not loop.is_running():
+            coro.close()
+            raise RuntimeError("Event loop is not running.")
+        return asyncio.run_coroutine_threadsafe(coro, loop).result(timeout=timeout)
+
+    @flask_app.before_request
+    def select_connection_pool():
+        # Page views and reports only read, so they go to the read-only pool
+        # and never wait on (or hold up) the bot's payment writes.
+        use_read_only_connections(request.method in ('GET', 'HEAD'))
+
+    @flask_app.teardown_request
+    def reset_connection_pool(exc):
+        use_read_only_connections(False)
+
     @flask_app.context_processor
     def inject_current_year():
         return {'current_year': datetime.utcnow().year}
@@ -126,41 +148,94 @@ def create_webhook_app(bot_controller_instance):
     @flask_app.route('/dashboard')
     @login_required
     def dashboard_page():
+        counters = get_stats_counters()
         stats = {
-            "user_count": get_user_count(),
-            "total_keys": get_total_keys_count(),
-            "total_spent": get_total_spent_sum(),
-            "host_count": len(get_all_hosts())
+            "user_count": int(counters.get('users', 0)),
+            "total_keys": int(counters.get('vpn_keys', 0)),
+            "total_spent": counters.get('total_spent', 0.0),
+            "host_count": int(counters.get('hosts', 0))
         }
         
-        page = request.args.get('page', 1, type=int)
+        before_id = request.args.get('before', type=int)
+        after_id = request.args.get('after', type=int)
         per_page = 8
         
-        transactions, total_transactions = get_paginated_transactions(page=page, per_page=per_page)
-        total_pages = ceil(total_transactions / per_page)
+        transactions, total_transactions, has_newer, has_older = get_transactions_page(
+            per_page=per_page, before_id=before_id, after_id=after_id
+        )
         
-        chart_data = get_daily_stats_for_charts(days=30)
+        chart_days = request.args.get('days', 30, type=int)
+        if chart_days not in CHART_RANGES:
+            chart_days = 30
+        chart_data = get_daily_stats_for_charts(days=chart_days)
+        revenue_by_host = get_revenue_by_host(days=chart_days)
+        revenue_by_plan = get_revenue_by_plan(days=chart_days)
         common_data = get_common_template_data()
         
         return render_template(
             'dashboard.html',
             stats=stats,
             chart_data=chart_data,
+            chart_days=chart_days,
+            chart_ranges=CHART_RANGES,
+            revenue_by_host=revenue_by_host,
+            revenue_by_plan=revenue_by_plan,
             transactions=transactions,
-            current_page=page,
-            total_pages=total_pages,
+            total_transactions=total_transactions,
+            has_newer=has_newer,
+            has_older=has_older,
             **common_data
         )
 
+    @flask_app.route('/dashboard/recompute-stats', methods=['POST'])
+    @login_required
+    def recompute_stats_route():
+        if recompute_stats_counters():
+            flash('Счётчики статистики пересчитаны.', 'success')
+        else:
+            flash('Не удалось пересчитать счётчики статистики.', 'danger')
+        return redirect(url_for('dashboard_page'))
+
     @flask_app.route('/users')
     @login_required
     def users_page():
-        users = get_all_users()
-        for user in users:
-            user['user_keys'] = get_user_keys(user['telegram_id'])
-        
+        def yes_no(value):
+            return {'yes': True, 'no': False}.get(value)
+
+        filters = {
+            'sort': request.args.get('sort', 'registered'),
+            'order': request.args.get('order', 'desc'),
+            'banned': request.args.get('banned', ''),
+            'active': request.args.get('active', ''),
+            'host': request.args.get('host', ''),
+            'since': request.args.get('since', ''),
+        }
+        page = request.args.get('page', 1, type=int)
+        per_page = 50
+
+        users, total_users = get_users_page(
+            page=page,
+            per_page=per_page,
+            sort=filters['sort'],
+            descending=filters['order'] != 'asc',
+            banned=yes_no(filters['banned']),
+            has_active_key=yes_no(filters['active']),
+            host_name=filters['host'] or None,
+            registered_since=filters['since'] or None,
+        )
+        total_pages = max(ceil(total_users / per_page), 1)
+
         common_data = get_common_template_data()
-        return render_template('users.html', users=users, **common_data)
+        return render_template(
+            'users.html',
+            users=users,
+            total_users=total_users,
+            current_page=page,
+            total_pages=total_pages,
+            filters=filters,
+            hosts=get_all_hosts(),
+            **common_data
+        )
 
     @flask_app.route('/settings', methods=['GET', 'POST'])
     @login_required
@@ -188,7 +263,48 @@ def create_webhook_app(bot_controller_instance):
             host['plans'] = get_plans_for_host(host['host_name'])
         
         common_data = get_common_template_data()
-        return render_template('settings.html', settings=current_settings, hosts=hosts, **common_data)
+        return render_template(
+            'settings.html',
+            settings=current_settings,
+            hosts=hosts,
+            backup_status=backup.get_backup_status(),
+            backups=backup.list_backups(),
+            **common_data
+        )
+
+    @flask_app.route('/backup/run', methods=['POST'])
+    @login_required
+    def run_backup_route():
+        if backup.start_backup_in_background():
+            flash('Резервное копирование запущено. Обновите страницу через несколько секунд.', 'success')
+        else:
+            flash('Резервное копирование уже выполняется.', 'warning')
+        return redirect(url_for('settings_page'))
+
+    @flask_app.route('/backup/verify/<name>', methods=['POST'])
+    @login_required
+    def verify_backup_route(name):
+        try:
+            result = backup.verify_backup(name)
+            flash(f"Копия {name} проверена: integrity_check = {result['integrity']}, пользователей: {result['counts'].get('users', 0)}.", 'success')
+        except (ValueError, OSError, EOFError, sqlite3.Error) as e:
+            flash(f"Копия {name} не прошла проверку: {e}", 'danger')
+        return redirect(url_for('settings_page'))
+
+    @flask_app.route('/backup/restore/<name>', methods=['POST'])
+    @login_required
+    def restore_backup_route(name):
+        if request.form.get('confirm_name') != name:
+            flash('Восстановление не подтверждено: введите имя копии полностью.', 'warning')
+            return redirect(url_for('settings_page'))
+        try:
+            result = backup.restore_backup(name)
+            flash(f"База восстановлена из {name}: пользователей: {result['counts'].get('users', 0)}, ключей: {result['counts'].get('vpn_keys', 0)}.", 'success')
+        except RuntimeError as e:
+            flash(f"Восстановление не выполнено: {e}", 'warning')
+        except (ValueError, OSError, EOFError, sqlite3.Error) as e:
+            flash(f"Не удалось восстановить базу из {name}: {e}", 'danger')
+        return redirect(url_for('settings_page'))
 
     @flask_app.route('/start-shop-bot', methods=['POST'])
     @login_required
@@ -236,12 +352,17 @@ def create_webhook_app(bot_controller_instance):
     @login_required
     def revoke_keys_route(user_id):
         keys_to_revoke = get_user_keys(user_id)
-        success_count = 0
-        
-        for key in keys_to_revoke:
-            result = asyncio.run(xui_api.delete_client_on_host(key['host_name'], key['key_email']))
-            if result:
-                success_count += 1
+
+        async def revoke_all():
+            return await asyncio.gather(*(
+                xui_api.delete_client_on_host(key['host_name'], key['key_email']) for key in keys_to_revoke
+            ))
+
+        try:
+            success_count = sum(1 for result in run_on_bot_loop(revoke_all()) if result)
+        except Exception as e:
+            logger.error(f"Error revoking keys for user {user_id}: {e}", exc_info=True)
+            success_count = 0
         
         delete_user_keys(user_id)
         
@@ -262,6 +383,23 @@ def create_webhook_app(bot_controller_instance):
             flash(f'Произошла ошибка при удалении пользователя {user_id} и его данных.', 'danger')
         return redirect(url_for('users_page'))
     
+    @flask_app.route('/api/search')
+    @login_required
+    def search_api():
+        query = request.args.get('q', '').strip()
+        limit = min(request.args.get('limit', 20, type=int), 100)
+        return jsonify(search_admin(query, limit=limit))
+
+    @flask_app.route('/api/db-stats')
+    @login_required
+    def db_stats_api():
+        return jsonify(get_pool_stats())
+
+    @flask_app.route('/api/xui-stats')
+    @login_required
+    def xui_stats_api():
+        return jsonify(xui_api.get_session_stats())
+
     @flask_app.route('/user/<int:user_id>')
     @login_required
     def user_profile_page(user_id):
@@ -293,7 +431,7 @@ def create_webhook_app(bot_controller_instance):
         
         try:
             # Удаляем ключ с XUI сервера
-            xui_result = asyncio.run(xui_api.delete_client_on_host(key_info['host_name'], key_info['key_email']))
+            xui_result = run_on_bot_loop(xui_api.delete_client_on_host(key_info['host_name'], key_info['key_email']))
             
             if xui_result:
                 # Удаляем ключ из базы данных
@@ -328,11 +466,14 @@ def create_webhook_app(bot_controller_instance):
                 return redirect(url_for('user_profile_page', user_id=user_id))
             
             # Генерируем уникальный email для ключа
-            key_number = get_next_key_number(user_id)
+            key_number = reserve_key_number(user_id)
+            if key_number is None:
+                flash("Не удалось выделить номер ключа для пользователя", 'danger')
+                return redirect(url_for('user_profile_page', user_id=user_id))
             key_email = f"user_{user_id}_key_{key_number}"
             
             # Создаем ключ на XUI сервере
-            xui_result = asyncio.run(xui_api.create_or_update_key_on_host(server_id, key_email, days))
+            xui_result = run_on_bot_loop(xui_api.create_or_update_key_on_host(server_id, key_email, days))
             
             if xui_result:
                 # Сохраняем информацию о ключе в базе данных
@@ -346,7 +487,8 @@ def create_webhook_app(bot_controller_instance):
                     days=days,
                     key_email=key_email,
                     expiry_timestamp_ms=xui_result['expiry_timestamp_ms'],
-                    key_name=key_name  # передаем имя ключа в функцию добавления
+                    key_name=key_name,  # передаем имя ключа в функцию добавления
+                    key_number=key_number
                 )
                 
                 if new_key_id:
@@ -66,8 +66,9 @@ document.addEventListener('DOMContentLoaded', function () {
 			const labels = []
 			const values = []
 			const today = new Date()
+			const days = typeof CHART_DAYS === 'undefined' ? 30 : CHART_DAYS
 
-			for (let i = 29; i >= 0; i--) {
+			for (let i = days - 1; i >= 0; i--) {
 				const date = new Date(today)
 				date.setDate(today.getDate() - i)
 				const dateString = date.toISOString().split('T')[0]
@@ -222,8 +223,65 @@ document.addEventListener('DOMContentLoaded', function () {
 		})
 	}
 
+	function initializeAdminSearch() {
+		const searchInput = document.getElementById('adminSearch')
+		const resultsList = document.getElementById('adminSearchResults')
+		if (!searchInput || !resultsList) return
+
+		const profileUrl = userId =>
+			searchInput.dataset.profileUrl.replace(/0$/, String(userId))
+		let debounceTimer = null
+		let lastQuery = ''
+
+		function addResult(userId, text) {
+			const item = document.createElement('li')
+			const link = document.createElement('a')
+			link.href = profileUrl(userId)
+			link.textContent = text
+			item.appendChild(link)
+			resultsList.appendChild(item)
+		}
+
+		async function runSearch() {
+			const query = searchInput.value.trim()
+			if (query === lastQuery) return
+			lastQuery = query
+			if (!query) {
+				resultsList.innerHTML = ''
+				return
+			}
+
+			const url = `${searchInput.dataset.searchUrl}?q=${encodeURIComponent(query)}`
+			const response = await fetch(url)
+			if (!response.ok || query !== lastQuery) return
+			const data = await response.json()
+
+			resultsList.innerHTML = ''
+			data.users.forEach(user =>
+				addResult(user.telegram_id, `👤 @${user.username || 'N/A'} (${user.telegram_id})`)
+			)
+			data.keys.forEach(key =>
+				addResult(key.user_id, `🔑 ${key.key_email} — ${key.host_name} (${key.user_id})`)
+			)
+			data.transactions.forEach(tx =>
+				addResult(tx.user_id, `💳 ${tx.payment_id} — ${tx.amount_rub} RUB, ${tx.status} (${tx.user_id})`)
+			)
+			if (!resultsList.children.length) {
+				const item = document.createElement('li')
+				item.textContent = 'Ничего не найдено'
+				resultsList.appendChild(item)
+			}
+		}
+
+		searchInput.addEventListener('input', () => {
+			clearTimeout(debounceTimer)
+			debounceTimer = setTimeout(runSearch, 250)
+		})
+	}
+
 	initializePasswordToggles()
 	setupBotControlForms()
 	setupConfirmationForms()
 	initializeDashboardCharts()
+	initializeAdminSearch()
 })
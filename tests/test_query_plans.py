@@ -0,0 +1,69 @@
+import sqlite3
+from contextlib import contextmanager
+
+import pytest
+
+from shop_bot.data_manager import database
+
+# Hot-path lookups, called through the functions that serve them. Every
+# SELECT they run must search an index instead of scanning its table.
+HOT_PATH_CALLS = [
+    ("keys by user", lambda: database.get_user_keys(1)),
+    ("key by email", lambda: database.get_key_by_email("user1-key1@host.bot")),
+    ("keys by host", lambda: database.get_keys_for_host("host")),
+    ("keys in expiry window", lambda: list(database.iter_keys(where=database.KEYS_EXPIRING_BETWEEN, params=(0, 1), columns=("key_id", "user_id", "expiry_ms")))),
+    ("stale keys of a host", lambda: list(database.iter_keys(where=database.HOST_KEYS_EXPIRED_BEFORE, params=("host", 1)))),
+    ("live keys of a host", lambda: list(database.iter_keys(where=database.HOST_KEYS_EXPIRING_AFTER, params=("host", 1)))),
+    ("transactions first page", lambda: database.get_transactions_page()),
+    ("transactions older page", lambda: database.get_transactions_page(before_id=1)),
+    ("transactions newer page", lambda: database.get_transactions_page(after_id=1)),
+    ("latest transaction of a user", lambda: database.get_latest_transaction(1)),
+    ("revenue by host", lambda: database.get_revenue_by_host(30)),
+    ("referral count", lambda: database.get_referral_count(1)),
+    ("user by support thread", lambda: database.get_user_id_by_thread(1)),
+]
+
+@pytest.fixture(scope="module")
+def migrated_db(tmp_path_factory):
+    db_file = tmp_path_factory.mktemp("db") / "users.db"
+    original_db_file = database.DB_FILE
+    database.DB_FILE = db_file
+    database.initialize_db()
+    conn = sqlite3.connect(db_file)
+    yield conn
+    conn.close()
+    database.close_connections()
+    database.DB_FILE = original_db_file
+
+@pytest.fixture
+def traced_selects(migrated_db, monkeypatch):
+    """SELECTs (with parameters bound) run through database._connect."""
+    statements = []
+    connect = database._connect
+
+    @contextmanager
+    def tracing_connect():
+        with connect() as conn:
+            conn.set_trace_callback(statements.append)
+            try:
+                yield conn
+            finally:
+                conn.set_trace_callback(None)
+
+    monkeypatch.setattr(database, "_connect", tracing_connect)
+    return statements
+
+def test_migrations_reach_latest_version(migrated_db):
+    assert migrated_db.execute("PRAGMA user_version").fetchone()[0] == database.SCHEMA_VERSION
+
+@pytest.mark.parametrize("name, call", HOT_PATH_CALLS, ids=[name for name, _ in HOT_PATH_CALLS])
+def test_hot_path_uses_index(migrated_db, traced_selects, name, call):
+    call()
+    selects = [sql for sql in traced_selects if sql.lstrip().upper().startswith(("SELECT", "WITH"))]
+    assert selects, f"{name} ran no SELECT"
+    for sql in selects:
+        plan = [row[3] for row in migrated_db.execute(f"EXPLAIN QUERY PLAN {sql}")]
+        assert any("INDEX" in step or "PRIMARY KEY" in step for step in plan), (sql, plan)
+        # An ordered walk of an index ("SCAN ... USING INDEX") is fine with LIMIT;
+        # a bare SCAN reads the whole table.
+        assert not any(step.startswith("SCAN") and "INDEX" not in step for step in plan), (sql, plan)
@@ -0,0 +1,193 @@
+import asyncio
+import json
+import time
+
+import pytest
+
+web = pytest.importorskip("aiohttp.web")
+pytest.importorskip("py3xui")
+from aiohttp.test_utils import TestServer
+
+from shop_bot.modules import xui_api
+from shop_bot.modules.xui_client import XuiApiError, XuiClient
+
+SESSION_COOKIE = "3x-ui"
+INBOUND_ID = 1
+DAY_MS = 24 * 3600 * 1000
+
+def fake_panel(clients: dict) -> tuple[web.Application, list[str]]:
+    """
+    The slice of the 3x-ui API the bot uses, for one inbound whose clients
+    are `clients` (email -> settings entry). Like the panel, updateClient
+    replaces the whole entry and fails for an unknown UUID.
+    """
+    app = web.Application()
+    requests = []
+
+    def ok(obj=None):
+        return web.json_response({"success": True, "msg": "", "obj": obj})
+
+    def failed(msg):
+        return web.json_response({"success": False, "msg": msg, "obj": None})
+
+    @web.middleware
+    async def logged_in(request, handler):
+        if request.path != "/login":
+            requests.append(f"{request.method} {request.path}")
+            if request.cookies.get(SESSION_COOKIE) != "session":
+                raise web.HTTPFound("/")
+        return await handler(request)
+
+    async def login(request):
+        response = ok()
+        response.set_cookie(SESSION_COOKIE, "session")
+        return response
+
+    async def get_inbound(request):
+        return ok({"id": INBOUND_ID, "settings": json.dumps({"clients": list(clients.values())})})
+
+    async def client_traffics(request):
+        client = clients.get(request.match_info['email'])
+        if client is None:
+            return ok(None)
+        return ok({
+            "id": 7, "inboundId": INBOUND_ID, "enable": client.get("enable", True), "email": client["email"],
+            "up": 0, "down": 0, "expiryTime": client.get("expiryTime", 0),
+            "total": client.get("totalGB", 0), "reset": client.get("reset", 0),
+        })
+
+    async def add_client(request):
+        entry = json.loads((await request.json())["settings"])["clients"][0]
+        if entry["email"] in clients:
+            return failed(f"Duplicate email: {entry['email']}")
+        clients[entry["email"]] = entry
+        return ok()
+
+    async def update_client(request):
+        entry = json.loads((await request.json())["settings"])["clients"][0]
+        current = next((c for c in clients.values() if c["id"] == request.match_info['uuid']), None)
+        if current is None:
+            return failed("Client Not Found In Inbound For ID")
+        del clients[current["email"]]
+        clients[entry["email"]] = entry
+        return ok()
+
+    app.middlewares.append(logged_in)
+    app.router.add_post("/login", login)
+    app.router.add_get("/panel/api/inbounds/get/{id}", get_inbound)
+    app.router.add_get("/panel/api/inbounds/getClientTraffics/{email}", client_traffics)
+    app.router.add_post("/panel/api/inbounds/addClient", add_client)
+    app.router.add_post("/panel/api/inbounds/updateClient/{uuid}", update_client)
+    return app, requests
+
+def run_against(app: web.Application, scenario):
+    async def main():
+        server = TestServer(app)
+        await server.start_server()
+        panel = XuiClient(str(server.make_url("/")), "admin", "admin")
+        try:
+            return await scenario(panel)
+        finally:
+            await panel.close()
+            await server.close()
+    return asyncio.run(main())
+
+def now_ms() -> int:
+    return int(time.time() * 1000)
+
+def days_left(expiry_ms: int) -> int:
+    return round((expiry_ms - now_ms()) / DAY_MS)
+
+@pytest.fixture
+def key_index(monkeypatch):
+    """vpn_keys rows by key_email, as async_database.get_key_by_email returns them."""
+    keys = {}
+
+    async def get_key_by_email(email):
+        return keys.get(email)
+
+    monkeypatch.setattr(xui_api.async_database, "get_key_by_email", get_key_by_email)
+    return keys
+
+def test_get_client_traffic():
+    clients = {"user1-key1@host.bot": {"id": "uuid-1", "email": "user1-key1@host.bot", "expiryTime": 1700000000000, "reset": 2}}
+    app, requests = fake_panel(clients)
+
+    async def scenario(panel):
+        found = await panel.get_client_traffic("user1-key1@host.bot")
+        missing = await panel.get_client_traffic("nobody@host.bot")
+        return found, missing, dict(panel.stats)
+
+    found, missing, stats = run_against(app, scenario)
+    assert found.email == "user1-key1@host.bot"
+    assert found.expiry_time == 1700000000000
+    assert found.reset == 2
+    assert missing is None
+    assert stats['logins'] == 1
+    assert requests == [
+        "GET /panel/api/inbounds/getClientTraffics/user1-key1@host.bot",
+        "GET /panel/api/inbounds/getClientTraffics/nobody@host.bot",
+    ]
+
+def test_closed_client_does_not_reopen_its_session():
+    app, requests = fake_panel({})
+
+    async def scenario(panel):
+        await panel.get_client_traffic("user1-key1@host.bot")
+        await panel.close()
+        with pytest.raises(XuiApiError):
+            await panel.get_client_traffic("user1-key1@host.bot")
+        return panel._session
+
+    assert run_against(app, scenario) is None
+    assert len(requests) == 1
+
+def test_new_key_is_one_add_client(key_index):
+    clients = {}
+    app, requests = fake_panel(clients)
+
+    client_uuid, expiry_ms = run_against(app, lambda panel: xui_api._update_or_create_client(panel, INBOUND_ID, "new@host.bot", 30))
+
+    assert requests == ["POST /panel/api/inbounds/addClient"]
+    assert clients["new@host.bot"]["id"] == client_uuid
+    assert days_left(expiry_ms) == 30
+
+def test_extension_does_not_read_the_inbound(key_index):
+    email = "user1-key1@host.bot"
+    key_index[email] = {"xui_client_uuid": "uuid-1", "key_email": email}
+    clients = {email: {
+        "id": "uuid-1", "email": email, "enable": True, "flow": xui_api.CLIENT_FLOW,
+        "expiryTime": now_ms() + 10 * DAY_MS, "reset": 5, "totalGB": 1024,
+    }}
+    app, requests = fake_panel(clients)
+
+    client_uuid, expiry_ms = run_against(app, lambda panel: xui_api._update_or_create_client(panel, INBOUND_ID, email, 30))
+
+    assert requests == [
+        f"GET /panel/api/inbounds/getClientTraffics/{email}",
+        "POST /panel/api/inbounds/updateClient/uuid-1",
+    ]
+    assert client_uuid == "uuid-1"
+    assert days_left(expiry_ms) == 45
+    assert clients[email]["expiryTime"] == expiry_ms
+    assert clients[email]["reset"] == 0
+    assert clients[email]["totalGB"] == 1024
+
+def test_extension_with_stale_uuid_falls_back_to_the_inbound(key_index):
+    email = "user1-key1@host.bot"
+    key_index[email] = {"xui_client_uuid": "uuid-old", "key_email": email}
+    clients = {email: {"id": "uuid-new", "email": email, "enable": True, "expiryTime": 0, "limitIp": 2, "subId": "sub"}}
+    app, requests = fake_panel(clients)
+
+    client_uuid, expiry_ms = run_against(app, lambda panel: xui_api._update_or_create_client(panel, INBOUND_ID, email, 30))
+
+    assert requests == [
+        f"GET /panel/api/inbounds/getClientTraffics/{email}",
+        "POST /panel/api/inbounds/updateClient/uuid-old",
+        f"GET /panel/api/inbounds/get/{INBOUND_ID}",
+        "POST /panel/api/inbounds/updateClient/uuid-new",
+    ]
+    assert client_uuid == "uuid-new"
+    assert days_left(expiry_ms) == 30
+    assert clients[email]["limitIp"] == 2
+    assert clients[email]["subId"] == "sub"